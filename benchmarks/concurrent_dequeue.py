@@ -0,0 +1,90 @@
+"""Measure how many messages per second a pool of workers can claim from a single queue
+
+    python benchmarks/concurrent_dequeue.py --uri mongo://127.0.0.1:8123 --workers 1 4 16 64 --window 1 16
+
+Each worker pops and acknowledges messages until the queue is empty.
+With `window=1` every worker competes for the oldest message, with a larger window
+the claims are spread across the oldest `window` messages.
+"""
+import time
+from multiprocessing import Process, Event
+
+from msgqueue import new_server, new_client
+
+DB = 'benchmark'
+QUEUE = 'work'
+NAMESPACE = 'bench'
+
+
+def with_window(uri, window):
+    return f'{uri}?window={window}'
+
+
+def consumer(uri, start):
+    client = new_client(uri, DB)
+    start.wait()
+
+    message = client.pop(QUEUE, NAMESPACE)
+    while message is not None:
+        client.mark_actioned(QUEUE, message)
+        message = client.pop(QUEUE, NAMESPACE)
+
+
+def fill_queue(uri, count):
+    client = new_client(uri, DB)
+    client.monitor().clear(QUEUE, NAMESPACE)
+
+    for i in range(0, count):
+        client.push(QUEUE, NAMESPACE, {'value': i})
+
+
+def run(uri, workers, messages):
+    fill_queue(uri, messages)
+
+    start = Event()
+    pool = [Process(target=consumer, args=(uri, start)) for _ in range(0, workers)]
+    for p in pool:
+        p.start()
+
+    # give some time for the clients to connect
+    time.sleep(1)
+
+    s = time.time()
+    start.set()
+    for p in pool:
+        p.join()
+
+    return messages / (time.time() - s)
+
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--uri', type=str, default='mongo://127.0.0.1:8123')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--window', type=int, nargs='+', default=[1, 16])
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--no-server', action='store_true', default=False,
+                        help='do not start a local server, use an already running one')
+    args = parser.parse_args()
+
+    broker = None
+    if not args.no_server:
+        broker = new_server(args.uri, DB)
+        broker.start()
+
+    try:
+        print(f'{"workers":>8} {"window":>8} {"claims/s":>12}')
+        for window in args.window:
+            for workers in args.workers:
+                rate = run(with_window(args.uri, window), workers, args.messages)
+                print(f'{workers:>8} {window:>8} {rate:>12.2f}')
+
+    finally:
+        if broker is not None:
+            broker.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,8 @@ SCRIPT_PATH=$(dirname "$0")
 
 mkdir -p $SCRIPT_PATH/msgqueue/backends/cockroach/bin
 
-wget -qO- https://binaries.cockroachdb.com/cockroach-v19.2.2.linux-amd64.tgz | tar  xvz
+wget -qO- https://binaries.cockroachdb.com/cockroach-v21.2.17.linux-amd64.tgz | tar  xvz
 
-cp -i cockroach-v19.2.2.linux-amd64/cockroach $SCRIPT_PATH/msgqueue/backends/cockroach/bin
+cp -i cockroach-v21.2.17.linux-amd64/cockroach $SCRIPT_PATH/msgqueue/backends/cockroach/bin
 
-rm -rf cockroach-v19.2.2.linux-amd64/cockroach
+rm -rf cockroach-v21.2.17.linux-amd64/cockroach
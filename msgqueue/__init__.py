@@ -11,6 +11,7 @@ __url__ = 'https://github.com/Delaunay/cqueue'
 from msgqueue.backends.queue import QueueServer
 from msgqueue.backends.queue import MessageQueue
 from msgqueue.backends.queue import QueueMonitor
+from msgqueue.backends.queue import RPCError
 
 from msgqueue.backends import new_monitor, new_client, new_server
-from msgqueue.future import Future
+from msgqueue.future import Future, FutureSet, gather, as_completed
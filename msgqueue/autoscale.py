@@ -0,0 +1,190 @@
+"""Local worker pool sized from the backlog of a queue
+
+The autoscaler periodically looks at the number of unread and unactioned messages of a queue
+and at the rate at which messages are actioned, and spawns or stops local worker processes
+to keep the backlog drainable within ``drain_time`` seconds.
+
+Workers are stopped by pushing ``SHUTDOWN`` messages to the queue so they finish their current
+work item before leaving.
+
+.. code-block:: python
+
+    from msgqueue.autoscale import Autoscaler
+
+    scaler = Autoscaler(
+        uri, 'example', 'work', 'example',
+        spawn=lambda i: WorkerReceiver.async_worker(uri, 'example', i),
+        min_workers=1, max_workers=16)
+
+    scaler.run()
+"""
+import math
+import threading
+import time
+
+from msgqueue.logs import info, warning
+from msgqueue.backends import new_client
+from msgqueue.worker import SHUTDOWN
+
+
+class Autoscaler:
+    """Grow or shrink a pool of local worker processes with the backlog of a queue
+
+    Parameters
+    ----------
+    uri: str
+        uri of the message queue
+
+    database: str
+        database of the queue
+
+    queue: str
+        queue the workers pull their work items from
+
+    namespace: str
+        namespace the workers pull their work items from
+
+    spawn: Callable[[int], multiprocessing.Process]
+        start a new worker process, it receives the index of the worker i.e ``WorkerReceiver.async_worker``
+
+    min_workers: int
+        the pool never goes below this number of workers
+
+    max_workers: int
+        the pool never goes above this number of workers
+
+    drain_time: float
+        time in seconds the pool should take to process the current backlog
+
+    target_backlog: int
+        number of pending messages per worker used until the throughput of the workers is known
+
+    interval: float
+        time in seconds between two checks of the backlog
+
+    cooldown: float
+        time in seconds to wait after resizing the pool before resizing it again
+    """
+    def __init__(self, uri, database, queue, namespace, spawn, min_workers=1, max_workers=8,
+                 drain_time=60, target_backlog=10, interval=5, cooldown=30):
+        self.client = new_client(uri, database, name='autoscaler', log_capture=False)
+        self.monitor = self.client.monitor()
+        self.queue = queue
+        self.namespace = namespace
+        self.spawn = spawn
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.drain_time = drain_time
+        self.target_backlog = target_backlog
+        self.interval = interval
+        self.cooldown = cooldown
+        self.stopped = threading.Event()
+
+        self.workers = []
+        # number of SHUTDOWN messages sent that were not acted on yet
+        self.draining = 0
+        self.spawned = 0
+        self.last_resize = 0
+        self.last_actioned = None
+        self.last_time = None
+        self.throughput = 0
+
+    def _reap(self):
+        """Forget the worker processes that exited"""
+        alive = [p for p in self.workers if p.is_alive()]
+        exited = len(self.workers) - len(alive)
+
+        for p in self.workers:
+            if not p.is_alive():
+                p.join()
+
+        self.workers = alive
+        self.draining = max(self.draining - exited, 0)
+
+    def _measure(self):
+        """Return the backlog of the queue and update the throughput estimate"""
+        unread = self.monitor.unread_count(self.queue, self.namespace)
+        unactioned = self.monitor.unactioned_count(self.queue, self.namespace)
+        actioned = self.monitor.actioned_count(self.queue, self.namespace)
+        now = time.time()
+
+        if self.last_actioned is not None and now > self.last_time:
+            self.throughput = max(actioned - self.last_actioned, 0) / (now - self.last_time)
+
+        self.last_actioned = actioned
+        self.last_time = now
+        return unread, unactioned
+
+    def desired_workers(self, unread, unactioned):
+        """Number of workers needed to drain the backlog in `drain_time` seconds, within the pool bounds"""
+        active = len(self.workers) - self.draining
+
+        if self.throughput > 0 and active > 0:
+            per_worker = self.throughput / active
+            desired = math.ceil(unread / (per_worker * self.drain_time))
+        else:
+            desired = math.ceil((unread + unactioned) / self.target_backlog)
+
+        return min(max(desired, self.min_workers), self.max_workers)
+
+    def step(self):
+        """Check the backlog and resize the pool if needed, returns the number of workers added or removed"""
+        self._reap()
+        unread, unactioned = self._measure()
+
+        active = len(self.workers) - self.draining
+        desired = self.desired_workers(unread, unactioned)
+
+        # the minimum is restored right away if workers died or timed out
+        cooling = time.time() - self.last_resize < self.cooldown
+        if desired == active or (cooling and active >= self.min_workers):
+            return 0
+
+        if desired > active:
+            self.scale_up(desired - active)
+        else:
+            self.scale_down(active - desired)
+
+        info(f'{self.queue}: {unread} unread, {unactioned} unactioned, '
+             f'{self.throughput:.2f} msg/s, {active} -> {desired} workers')
+
+        self.last_resize = time.time()
+        return desired - active
+
+    def scale_up(self, n):
+        for _ in range(n):
+            self.workers.append(self.spawn(self.spawned))
+            self.spawned += 1
+
+    def scale_down(self, n):
+        """Ask `n` workers to stop once they are done with their current work item"""
+        for _ in range(n):
+            self.client.push(self.queue, self.namespace, {}, mtype=SHUTDOWN)
+
+        self.draining += n
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                try:
+                    self.step()
+                except Exception as e:
+                    warning(f'autoscaling failed: {e}')
+
+                self.stopped.wait(self.interval)
+
+        finally:
+            self.shutdown()
+
+    def stop(self):
+        self.stopped.set()
+
+    def shutdown(self, timeout=None):
+        """Stop all the workers gracefully and wait for them to exit"""
+        self._reap()
+        self.scale_down(len(self.workers) - self.draining)
+
+        for p in self.workers:
+            p.join(timeout)
+
+        self._reap()
@@ -1,5 +1,3 @@
-from glob import glob
-import os
 from multiprocessing import RLock
 
 from msgqueue.logs import info
@@ -8,77 +6,156 @@ from msgqueue.backends.queue import QueueMonitor, QueueServer, MessageQueue
 
 
 def make_delayed_import_error(error):
-    def raise_import_error():
+    def raise_import_error(*args, **kwargs):
         raise error
-    return raise_import_error()
+    return raise_import_error
 
 
-def fetch_factories(base_module, base_file_name, function_name):
-    factories = {}
-    module_path = os.path.dirname(os.path.abspath(base_file_name))
+# scheme -> module implementing the backend, modules are only imported when their scheme is used
+# so using one backend does not pull the dependencies of the others
+BACKENDS = {
+    'cockroach': 'msgqueue.backends.cockroach',
+    'mongo': 'msgqueue.backends.mongo',
+    'local+mongo': 'msgqueue.backends.local',
+    'local+cockroach': 'msgqueue.backends.local',
+    'zip': 'msgqueue.backends.zip',
+}
+
+# backends that can only be monitored
+MONITOR_ONLY = {'zip'}
+
+# name of the module -> scheme, backends used to be selected by the name of their module i.e `main('local')`
+ALIASES = {module.rsplit('.', 1)[-1]: scheme for scheme, module in reversed(list(BACKENDS.items()))}
 
-    for module_path in glob(os.path.join(module_path, '[A-Za-z]*')):
-        module_file = module_path.split(os.sep)[-1]
+# Third party backends register their module under this entry point group, the name of the entry point is the scheme
+#
+#   entry_points={'msgqueue.backends': ['redis = msgqueue_redis']}
+#
+ENTRY_POINT_GROUP = 'msgqueue.backends'
 
-        if module_file == base_file_name:
-            continue
+_modules = dict()
+_entry_points = None
 
-        module_name = module_file.split(".py")[0]
+
+def _backend_entry_points():
+    global _entry_points
+
+    if _entry_points is None:
+        _entry_points = dict()
 
         try:
-            module = __import__(".".join([base_module, module_name]), fromlist=[''])
+            from importlib.metadata import entry_points
+        except ImportError:
+            return _entry_points
 
-            if hasattr(module, function_name):
-                builders = getattr(module, function_name)
+        eps = entry_points()
+        if hasattr(eps, 'select'):
+            eps = eps.select(group=ENTRY_POINT_GROUP)
+        else:
+            eps = eps.get(ENTRY_POINT_GROUP, [])
 
-                if not isinstance(builders, dict):
-                    builders = {module_name: builders}
+        for ep in eps:
+            _entry_points[ep.name] = ep
 
-                for key, builder in builders.items():
-                    factories[key] = builder
+    return _entry_points
 
-        except ImportError as e:
-            factories[module_name] = make_delayed_import_error(e)
 
-    return factories
+def _load_backend(scheme):
+    """Import the module of a backend the first time it is used"""
+    module = _modules.get(scheme)
+    if module is not None:
+        return module
 
+    if scheme in BACKENDS:
+        module = __import__(BACKENDS[scheme], fromlist=[''])
 
-client_factory = fetch_factories('msgqueue.backends', __file__, 'new_client')
-broker_factory = fetch_factories('msgqueue.backends', __file__, 'new_server')
-monitor_factory = fetch_factories('msgqueue.backends', __file__, 'new_monitor')
-main_factory = fetch_factories('msgqueue.backends', __file__, 'start_server_main')
+    elif scheme in _backend_entry_points():
+        module = _backend_entry_points()[scheme].load()
 
+    else:
+        raise KeyError(f'`{scheme}` backend was not found; pick among the known backends: {known_backends()}')
 
-def known_backends():
-    return list(client_factory.keys())
+    _modules[scheme] = module
+    return module
 
 
-def _maybe(dictionary, key):
-    fun = dictionary.get(key)
+def _factory(scheme, function_name):
+    try:
+        module = _load_backend(scheme)
+    except ImportError as e:
+        return make_delayed_import_error(e)
 
-    if fun is None:
-        raise KeyError(f'`{key}` backend was not found; pick among the known backends: {list(dictionary.keys())}')
+    builders = getattr(module, function_name, None)
 
-    return fun
+    if isinstance(builders, dict):
+        builders = builders.get(scheme)
+
+    if builders is None:
+        raise KeyError(f'`{scheme}` backend does not implement `{function_name}`')
+
+    return builders
+
+
+def fetch_factories(base_module, base_file_name, function_name):
+    """Import every backend and return their `function_name`, prefer `_factory` which only imports what is used"""
+    factories = {}
+
+    for scheme in known_backends(monitor_only=True):
+        try:
+            factories[scheme] = _factory(scheme, function_name)
+        except KeyError:
+            pass
+
+    for alias, scheme in ALIASES.items():
+        if scheme in factories:
+            factories.setdefault(alias, factories[scheme])
+
+    return factories
+
+
+def __getattr__(name):
+    # the factory dictionaries used to be built at import time, build them on demand for compatibility
+    functions = {
+        'client_factory': 'new_client',
+        'broker_factory': 'new_server',
+        'monitor_factory': 'new_monitor',
+        'main_factory': 'start_server_main',
+    }
+
+    if name in functions:
+        return fetch_factories('msgqueue.backends', __file__, functions[name])
+
+    raise AttributeError(f'module {__name__} has no attribute {name}')
+
+
+def known_backends(monitor_only=False):
+    """Return the schemes of the available backends, without importing them"""
+    schemes = [scheme for scheme in BACKENDS if monitor_only or scheme not in MONITOR_ONLY]
+    schemes.extend(scheme for scheme in _backend_entry_points() if scheme not in BACKENDS)
+    return schemes
 
 
 def new_server(uri, database, location='/tmp/queue/', clean_on_exit=True, join=None) -> QueueServer:
     options = parse_uri(uri)
-    return _maybe(broker_factory, options.get('scheme'))(uri, database, location, join, clean_on_exit)
+    return _factory(options.get('scheme'), 'new_server')(uri, database, location, join, clean_on_exit)
 
 
 def new_client(uri, database, name='worker', log_capture=True, timeout=60) -> MessageQueue:
     options = parse_uri(uri)
-    return _maybe(client_factory, options.get('scheme'))(uri, database, name, log_capture, timeout)
+    return _factory(options.get('scheme'), 'new_client')(uri, database, name, log_capture, timeout)
 
 
 def new_monitor(uri, database, *args, **kwargs) -> QueueMonitor:
     options = parse_uri(uri)
-    return _maybe(monitor_factory, options.get('scheme'))(uri, database, *args, **kwargs)
+    return _factory(options.get('scheme'), 'new_monitor')(uri, database, *args, **kwargs)
 
 
 def main(name):
-    return main_factory[name]()
+    """Start the server of a backend, `name` is its scheme or the name of its module"""
+    if name not in BACKENDS:
+        name = ALIASES.get(name, name)
+
+    return _factory(name, 'start_server_main')()
 
 
 def get_main_script():
@@ -1,11 +1,14 @@
+from collections import Counter
 import json
+import random
 import psycopg2
 from threading import RLock
+from typing import List
 
 from msgqueue.uri import parse_uri
-from msgqueue.backends.queue import Message, MessageQueue, QueuePacemaker
+from msgqueue.backends.queue import Message, MessageQueue, QueuePacemaker, ENQUEUED, CLAIMED, ACTIONED, FAILED
 from .server import new_queue
-from .util import _parse
+from .util import _parse, counted, RetryCursor
 
 
 class CKPacemaker(QueuePacemaker):
@@ -28,47 +31,6 @@ class CKPacemaker(QueuePacemaker):
             self.agent_id = self.client.fetchone()[0]
             return self.agent_id
 
-    def update_heartbeat(self):
-        with self.lock:
-            self.client.execute(f"""
-            UPDATE 
-                {self.database}.{self.name}
-            SET 
-                heartbeat = current_timestamp()
-            WHERE
-                uid = %s
-            """, (self.message.uid,))
-
-    def register_message(self, name, message):
-        if message is None:
-            return None
-
-        with self.lock:
-            self.client.execute(f"""
-            UPDATE 
-                {self.database}.system
-            SET 
-                (message, namespace, heartbeat) = (%s, %s, current_timestamp())
-            WHERE
-                uid = %s
-            """, (message.uid, message.namespace, self.agent_id))
-
-        self.name = name
-        self.message = message
-        self.update_heartbeat()
-
-        return message
-
-    def unregister_message(self, uid=None):
-        self.client.execute(f"""
-            UPDATE 
-                {self.database}.system
-            SET 
-                (message, heartbeat)   = (NULL, current_timestamp())
-            WHERE
-                uid = %s
-            """, (self.agent_id,))
-
     def unregister_agent(self):
         with self.lock:
             self.client.execute(f"""
@@ -97,8 +59,44 @@ class CKMQClient(MessageQueue):
     ----------
     uri: str
         cockroach://192.168.0.10:8123
+
+        window: int
+            number of the oldest messages a message is randomly claimed from (default: 1, strict FIFO).
+            Larger windows reduce transaction conflicts when many workers dequeue from the same queue
+            i.e cockroach://192.168.0.10:8123?window=16
+
+        lease: float
+            time in seconds a dequeued message stays assigned to this client without its lease being extended,
+            after that the message is considered lost (default: 3 * timeout)
+            i.e cockroach://192.168.0.10:8123?lease=300
+
+        fair: bool
+            when dequeuing without a namespace, serve the namespaces with unread messages in turn
+            instead of always popping the globally oldest message, namespaces are weighted by
+            `namespace_weights` (default: 1)
+            i.e cockroach://192.168.0.10:8123?fair=1
+
+        heartbeat: str
+            path to the Unix socket of the node level heartbeat agent (see :mod:`msgqueue.heartbeat`),
+            when set the agent sends the heartbeats of this client in bulk with the other local workers
+            i.e cockroach://192.168.0.10:8123?heartbeat=/tmp/msgqueue-heartbeat.sock
+
+        shards: int
+            number of shards new queues are split into (default: 1).
+            Inserts are spread randomly across the shards and dequeues visit the shards in turn,
+            FIFO is only preserved within a shard
+            i.e cockroach://192.168.0.10:8123?shards=8
+
+        counters: bool
+            maintain the number of messages in each state in the counters table in the same statement
+            as the enqueue, dequeue, ack and error so the monitor can read them without scanning the queue.
+            All the clients writing to the queue need to enable it (default: 0)
+            i.e cockroach://192.168.0.10:8123?counters=1
     """
 
+    # number of rows each counter is split into, writers pick one at random so they do not conflict on a single row
+    counter_slots = 8
+
     def __init__(self, uri, database, name='worker', log_capture=True, timeout=60):
         uri = parse_uri(uri)
         self.username = 'root'  # uri.get('username', 'default_user')
@@ -114,7 +112,7 @@ class CKMQClient(MessageQueue):
             host=uri['address']
         )
         self.con.set_session(autocommit=True)
-        self.cursor = self.con.cursor()
+        self.cursor = RetryCursor(self.con.cursor())
         self.name = name
         self.agent_id = None
         self.heartbeat_monitor = None
@@ -123,6 +121,17 @@ class CKMQClient(MessageQueue):
 
         self.capture = log_capture
         self.timeout = timeout
+        self.dequeue_window = int(uri['query'].get('window', 1))
+        self.lease = float(uri['query'].get('lease', 3 * timeout))
+        self.fair = uri['query'].get('fair', '0') not in ('0', 'false')
+        self.namespace_weights = dict()
+        self.fair_schedulers = dict()
+        self.quota_cache = dict()
+        self.heartbeat_address = uri['query'].get('heartbeat')
+        self.shards = int(uri['query'].get('shards', 1))
+        self.counters = uri['query'].get('counters', '0') not in ('0', 'false')
+        self.queue_shards = dict()
+        self.next_shard = random.randrange(0, 2 ** 16)
 
     def join(self):
         self.con.close()
@@ -131,28 +140,73 @@ class CKMQClient(MessageQueue):
     def pacemaker(self, wait_time, capture):
         return CKPacemaker(self, wait_time, capture)
 
-    def enqueue(self, queue, namespace, message, mtype=0, replying_to=None):
+    def _queue_shards(self, queue):
+        """Return the number of shards of a queue, None if the queue does not exist"""
+        shards = self.queue_shards.get(queue)
+
+        if shards is None:
+            with self.lock:
+                try:
+                    self.cursor.execute(f"""
+                    SELECT
+                        max(shards)
+                    FROM {self.database}.qsystem
+                    WHERE
+                        name = %s
+                    """, (queue,))
+                except psycopg2.errors.UndefinedColumn:
+                    # qsystem was created by an older version
+                    return 1 if self._queue_exist(queue) else None
+
+                shards = self.cursor.fetchone()[0]
+
+            if shards is not None:
+                self.queue_shards[queue] = shards
+
+        return shards
+
+    def enqueue(self, queue, namespace, message, mtype=0, replying_to=None, ttl=None):
         """See `~mlbaselines.distributed.queue.MessageQueue`"""
         with self.lock:
+            shards = self._queue_shards(queue)
+
             # need to be root to create database :/
-            if not self._queue_exist(queue):
-                new_queue(self.cursor, self.database, queue, namespace, 'root')
+            if shards is None:
+                shards = self.shards
+                new_queue(self.cursor, self.database, queue, namespace, 'root', shards)
+                self.queue_shards[queue] = shards
 
-            print('enqueue')
+            expire = 'NULL'
+            args = [mtype, False, False, json.dumps(message), replying_to, namespace, random.randrange(0, shards)]
 
-            self.cursor.execute(f"""
+            if ttl is not None:
+                expire = "current_timestamp() + %s * interval '1 second'"
+                args.append(float(ttl))
+
+            self.cursor.execute(*self._counted(queue, f"""
             INSERT INTO  
-                {self.database}.{queue} (mtype, read, actioned, message, replying_to, namespace, retry)
+                {self.database}.{queue} (mtype, read, actioned, message, replying_to, namespace, shard, retry, expire_time)
             VALUES
-                (%s, %s, %s, %s, %s, %s, 0)
-            RETURNING uid
-            """, (mtype, False, False, json.dumps(message), replying_to, namespace))
+                (%s, %s, %s, %s, %s, %s, %s, 0, {expire})
+            RETURNING uid, namespace, mtype
+            """, tuple(args), ENQUEUED))
 
             return self.cursor.fetchone()[0]
 
-    def dequeue(self, queue, namespace, mtype=None):
-        """See `~mlbaselines.distributed.queue.MessageQueue`"""
-        query = ['read = false']
+    def _counted(self, queue, statement, args, transitions):
+        """Update the counters of the messages changed by `statement` in the same statement (see `counted`),
+        the updates are spread over `counter_slots` rows so the clients do not all conflict on the same counter"""
+        if not self.counters:
+            return statement, args
+
+        return counted(self.database, queue, statement, args, transitions, random.randrange(0, self.counter_slots))
+
+    @staticmethod
+    def _dequeue_filters(namespace, mtype=None):
+        query = [
+            'read = false',
+            '(expire_time IS NULL OR expire_time > current_timestamp())'
+        ]
         args = list()
 
         if isinstance(mtype, (list, tuple)):
@@ -167,24 +221,247 @@ class CKMQClient(MessageQueue):
             query.append('namespace = %s')
             args.append(namespace)
 
-        query = ' AND\n'.join(query)
+        return ' AND\n'.join(query), args
+
+    def _agent_id(self):
+        if self.heartbeat_monitor is not None:
+            return self.heartbeat_monitor.agent_id
+        return None
+
+    def _dequeue_statement(self, queue, query):
+        # the claim records who is processing the message and for how long, no other write is necessary
+        return f"""
+        UPDATE {self.database}.{queue} SET
+            (read, read_time, heartbeat, agent, lease_until) = (
+                true, current_timestamp(), current_timestamp(), %s,
+                current_timestamp() + {float(self.lease)} * interval '1 second')
+        WHERE
+            {query}
+        ORDER BY
+            time ASC
+        LIMIT 1
+        RETURNING *
+        """
+
+    def _quota_filter(self, queue):
+        """Filter out the messages of the namespaces that reached their quota
+
+        The usage is read from the quota rows, it is only exact inside the transaction
+        of the claim (see `_reserving`)
+        """
+        if not self._has_quotas(queue):
+            return None, []
+
+        self.cursor.execute(f"""
+        SELECT
+            namespace
+        FROM {self.database}.quotas
+        WHERE
+            queue = %s AND
+            inflight >= max_inflight
+        """, (queue,))
+        full = [r[0] for r in self.cursor.fetchall()]
+
+        if '' in full:
+            # the quota of the whole queue is reached
+            return 'false', []
+
+        if not full:
+            return None, []
+
+        return 'namespace NOT IN %s', [tuple(full)]
+
+    def _reserving(self, queue, claim):
+        """Call `claim()` and count the message it returns against the quotas of `queue`
+
+        Reading the full namespaces, claiming the message and incrementing its quotas are done in the same
+        transaction, concurrent claims conflict on the quota rows and are retried instead of going over the quota
+        """
+        if not self._has_quotas(queue):
+            return claim()
+
+        def reserve(cursor):
+            msg = claim()
+
+            if msg is not None:
+                cursor.execute(f"""
+                UPDATE {self.database}.quotas SET
+                    inflight = inflight + 1
+                WHERE
+                    queue = %s AND
+                    namespace IN (%s, '')
+                """, (queue, msg.namespace or ''))
+
+            return msg
+
+        return self.cursor.transaction(reserve)
+
+    def _release_quota(self, queue, namespaces):
+        """Free the quota slots of the messages that are done being processed"""
+        if not namespaces or not self._has_quotas(queue):
+            return
+
+        released = Counter(namespace for namespace in namespaces if namespace)
+        released[''] += len(namespaces)
+
+        values = ', '.join(['(%s::STRING, %s::INT)'] * len(released))
+        self.cursor.execute(f"""
+        UPDATE {self.database}.quotas SET
+            inflight = greatest(quotas.inflight - released.count, 0)
+        FROM
+            (VALUES {values}) AS released (namespace, count)
+        WHERE
+            quotas.queue = %s AND
+            quotas.namespace = released.namespace
+        """, (*[v for item in released.items() for v in item], queue))
+
+    def _shard_filters(self, queue, namespace, mtype=None):
+        """Generate the filters of each shard of the queue, starting from a different shard every call
+        to spread the load across the shards"""
+        query, args = self._dequeue_filters(namespace, mtype)
+
+        quota, quota_args = self._quota_filter(queue)
+        if quota is not None:
+            query = f'{query} AND\n{quota}'
+            args = args + quota_args
+        shards = self._queue_shards(queue) or 1
+
+        if shards == 1:
+            yield query, args
+            return
+
+        start = self.next_shard
+        self.next_shard += 1
+
+        for i in range(shards):
+            yield f'shard = %s AND\n{query}', [(start + i) % shards] + args
+
+    def dequeue(self, queue, namespace, mtype=None):
+        """See `~mlbaselines.distributed.queue.MessageQueue`"""
+        if namespace is None and self.fair:
+            return self._dequeue_fair(queue, mtype)
+
         with self.lock:
             try:
-                select = f"""
-                UPDATE {self.database}.{queue} SET
-                    (read, read_time) = (true, current_timestamp())
+                msg = self._reserving(queue, lambda: self._dequeue_shards(queue, namespace, mtype))
+                return self._register_message(queue, msg)
+
+            except psycopg2.errors.UndefinedTable:
+                return None
+
+    def _dequeue_shards(self, queue, namespace, mtype):
+        for query, args in self._shard_filters(queue, namespace, mtype):
+            if self.dequeue_window > 1:
+                msg = self._dequeue_window(queue, query, args)
+            else:
+                self.cursor.execute(*self._counted(
+                    queue, self._dequeue_statement(queue, query), (self._agent_id(), *args), CLAIMED))
+                msg = self.cursor.fetchone()
+
+            if msg is not None:
+                return _parse(msg)
+
+        return None
+
+    def _dequeue_window(self, queue, query, args, attempts=3):
+        """Claim a random message among the oldest unread messages
+
+        Selecting the candidates is a read only statement, the claim itself is a point update
+        conditional on the message still being unread.
+        Workers only conflict when they pick the same row instead of all of them
+        fighting over the oldest one.
+        """
+        for _ in range(attempts):
+            self.cursor.execute(f"""
+            SELECT
+                uid
+            FROM
+                {self.database}.{queue}
+            WHERE
+                {query}
+            ORDER BY
+                time ASC
+            LIMIT {self.dequeue_window}
+            """, tuple(args))
+
+            candidates = [r[0] for r in self.cursor.fetchall()]
+            if not candidates:
+                return None
+
+            random.shuffle(candidates)
+            for uid in candidates:
+                msg = self._claim(queue, uid)
+
+                if msg is not None:
+                    return msg
+
+        return None
+
+    def _claim(self, queue, uid, quota=None, quota_args=()):
+        """Claim a message if it is still unread and its namespace is not excluded by `quota`"""
+        quota = f'AND {quota}' if quota is not None else ''
+
+        self.cursor.execute(*self._counted(queue, f"""
+        UPDATE {self.database}.{queue} SET
+            (read, read_time, heartbeat, agent, lease_until) = (
+                true, current_timestamp(), current_timestamp(), %s,
+                current_timestamp() + {float(self.lease)} * interval '1 second')
+        WHERE
+            uid = %s AND
+            read = false
+            {quota}
+        RETURNING *
+        """, (self._agent_id(), uid, *quota_args), CLAIMED))
+
+        return self.cursor.fetchone()
+
+    def dequeue_any(self, queues, namespace, mtype=None):
+        """Look for the oldest message of every queue in a single query and claim the one of the first non empty queue
+
+        See `~mlbaselines.distributed.queue.MessageQueue`
+        """
+        with self.lock:
+            queues = [q for q in queues if self._queue_shards(q) is not None]
+
+            selects = []
+            args = []
+            for rank, queue in enumerate(queues):
+                query, query_args = next(self._shard_filters(queue, namespace, mtype))
+
+                selects.append(f"""
+                (SELECT
+                    {rank} AS rank, uid
+                FROM
+                    {self.database}.{queue}
                 WHERE
                     {query}
                 ORDER BY
                     time ASC
-                LIMIT 1
-                RETURNING *
-                """
-                self.cursor.execute(select, tuple(args))
-                return self._register_message(queue, _parse(self.cursor.fetchone()))
+                LIMIT 1)""")
+                args.extend(query_args)
 
-            except psycopg2.errors.UndefinedTable:
-                return None
+            if not selects:
+                return None, None
+
+            union = '\nUNION ALL\n'.join(selects)
+            self.cursor.execute(f'{union}\nORDER BY rank', tuple(args))
+
+            for rank, uid in self.cursor.fetchall():
+                queue = queues[rank]
+                msg = self._reserving(queue, lambda: _parse(self._claim(queue, uid, *self._quota_filter(queue))))
+
+                if msg is not None:
+                    return queue, self._register_message(queue, msg)
+
+            # all the candidates were claimed by other workers in the meantime
+            return super(CKMQClient, self).dequeue_any(queues, namespace, mtype)
+
+    def explain_dequeue(self, queue, namespace, mtype=None):
+        """Return the query plan used by `dequeue`"""
+        with self.lock:
+            query, args = next(self._shard_filters(queue, namespace, mtype))
+            self.cursor.execute(f'EXPLAIN {self._dequeue_statement(queue, query)}', (self._agent_id(), *args))
+            return '\n'.join(' '.join(str(c) for c in row) for row in self.cursor.fetchall())
 
     def mark_actioned(self, name, uid: Message):
         """See `~mlbaselines.distributed.queue.MessageQueue`"""
@@ -192,34 +469,142 @@ class CKMQClient(MessageQueue):
             uid = uid.uid
 
         with self.lock:
-            self.cursor.execute(f"""
+            self.cursor.execute(*self._counted(name, f"""
             UPDATE {self.database}.{name} SET 
                 (actioned, actioned_time) = (true, current_timestamp())
             WHERE 
-                uid = %s
-            """, (uid,))
+                uid = %s AND
+                actioned = false
+            RETURNING namespace, mtype, error
+            """, (uid,), ACTIONED))
 
+            # failed messages released their quota slot already
+            self._release_quota(name, [row[0] for row in self.cursor.fetchall() if row[2] is None])
             self._unregister_message(uid)
             return uid
 
+    def mark_actioned_all(self, name, messages: List[Message]):
+        """See `~mlbaselines.distributed.queue.MessageQueue`"""
+        if not messages:
+            return
+
+        uids = tuple(m.uid for m in messages)
+
+        with self.lock:
+            self.cursor.execute(*self._counted(name, f"""
+            UPDATE {self.database}.{name} SET 
+                (actioned, actioned_time) = (true, current_timestamp())
+            WHERE 
+                uid IN %s AND
+                actioned = false
+            RETURNING namespace, mtype, error
+            """, (uids,), ACTIONED))
+
+            self._release_quota(name, [row[0] for row in self.cursor.fetchall() if row[2] is None])
+
+            for uid in uids:
+                self._unregister_message(uid)
+
     def mark_error(self, name, uid, error):
         if isinstance(uid, Message):
             uid = uid.uid
 
+        # a message is only counted as failed and releases its quota slot once
+        constraint = ''
+        if self.counters or self._has_quotas(name):
+            constraint = 'AND error IS NULL AND actioned = false'
+
         with self.lock:
-            self.cursor.execute(f"""
+            self.cursor.execute(*self._counted(name, f"""
             UPDATE {self.database}.{name} SET 
                 error = %s
             WHERE 
                 uid = %s
-            """, (json.dumps(error), uid))
+                {constraint}
+            RETURNING namespace, mtype
+            """, (json.dumps(error), uid), FAILED))
+
+            rows = self.cursor.fetchall()
+            if constraint:
+                self._release_quota(name, [row[0] for row in rows])
 
             self._unregister_message(uid)
             return uid
 
+    def get_reply(self, queue, message):
+        """See `~mlbaselines.distributed.queue.MessageQueue`"""
+        single = not isinstance(message, (list, tuple, set))
+        uids = (message,) if single else tuple(message)
+
+        if not uids:
+            return dict()
+
+        with self.lock:
+            try:
+                self.cursor.execute(f"""
+                SELECT 
+                    * 
+                FROM 
+                    {self.database}.{queue}
+                WHERE 
+                    replying_to IN %s
+                """, (uids,))
+
+                replies = {reply.replying_to: reply for reply in map(_parse, self.cursor.fetchall())}
+
+            # the result queue is created by the first reply
+            except psycopg2.errors.UndefinedTable:
+                replies = dict()
+
+        if single:
+            return replies.get(message)
+
+        return replies
+
+    def extend_leases(self, queue, leases):
+        """See `~mlbaselines.distributed.queue.MessageQueue`"""
+        if not leases:
+            return
+
+        default = self._agent_id()
+        args = []
+        for uid, agent, lease in leases:
+            args.extend((uid, agent if agent is not None else default, float(lease)))
+
+        values = ', '.join(['(%s::INT8, %s::INT8, %s::FLOAT8)'] * len(leases))
+
+        with self.lock:
+            self.cursor.execute(f"""
+            UPDATE {self.database}.{queue} SET
+                lease_until = current_timestamp() + leases.lease * interval '1 second'
+            FROM
+                (VALUES {values}) AS leases (uid, agent, lease)
+            WHERE
+                {queue}.uid = leases.uid AND
+                {queue}.actioned = false AND
+                {queue}.agent IS NOT DISTINCT FROM leases.agent
+            """, tuple(args))
+
+    def agent_heartbeat(self, agents):
+        """See `~mlbaselines.distributed.queue.MessageQueue`"""
+        if not agents:
+            return
+
+        with self.lock:
+            self.cursor.execute(f"""
+            UPDATE {self.database}.system SET
+                heartbeat = current_timestamp()
+            WHERE
+                uid IN %s
+            """, (tuple(agents),))
+
+    def contention_stats(self):
+        """Return the number of transactions that were retried because of conflicts and the time lost doing so"""
+        return self.cursor.stats.to_dict()
+
     def monitor(self):
         from .monitor import CKQueueMonitor
-        return CKQueueMonitor(self.database, cursor=self.cursor, lock=self.lock)
+        return CKQueueMonitor(self.database, cursor=self.cursor, lock=self.lock, counters=self.counters)
 
 
 def new_client(*args, **kwargs):
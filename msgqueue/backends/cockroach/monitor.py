@@ -1,17 +1,27 @@
 import psycopg2
+import random
 from threading import RLock
 
 from msgqueue.uri import parse_uri
-from msgqueue.backends.queue import QueueMonitor, Agent, Message, to_dict
+from msgqueue.backends.queue import QueueMonitor, Agent, Message, WaitingTime, QuotaUsage, QueueStats, COUNTER_STATES, to_dict
+from msgqueue.backends.queue import ApproximateCount, sampled_count, REQUEUED, REQUEUED_FAILED
 
-from .util import _parse, _parse_agent
+from .util import _parse, _parse_agent, counted, RetryCursor
 
 
 class CKQueueMonitor(QueueMonitor):
-    def __init__(self, database, uri=None, cursor=None, lock=None):
+    # number of ranges of consecutive messages the samples of the approximate counts are made of
+    sample_blocks = 20
+
+    def __init__(self, database, uri=None, cursor=None, lock=None, counters=False):
         # When using this inside a dashbord it is executed in a multi threaded environment
         # You need to lock the cursor to not get some errors
         self.database = database
+        # read the counts from the counters table (see `CKMQClient`)
+        self.use_counters = counters
+
+        if uri is not None:
+            self.use_counters = parse_uri(uri)['query'].get('counters', '0') not in ('0', 'false')
 
         if cursor is None:
             uri = parse_uri(uri)
@@ -26,12 +36,16 @@ class CKQueueMonitor(QueueMonitor):
                 host=uri['address']
             )
             self.con.set_session(autocommit=True)
-            self.cursor = self.con.cursor()
+            self.cursor = RetryCursor(self.con.cursor())
             self.lock = RLock()
         else:
             self.cursor = cursor
             self.lock = lock
 
+    def contention_stats(self):
+        """Return the number of transactions that were retried because of conflicts and the time lost doing so"""
+        return self.cursor.stats.to_dict()
+
     def _fetch_all(self):
         rows = self.cursor.fetchall()
         records = []
@@ -105,6 +119,7 @@ class CKQueueMonitor(QueueMonitor):
                 query = f"""DELETE FROM {self.database}.{name}"""
 
             self.cursor.execute(query)
+            self._clear_counters(name, namespace)
 
     def _constraint(self, name, value):
         constraint = None
@@ -170,6 +185,40 @@ class CKQueueMonitor(QueueMonitor):
             self.cursor.execute(query, args)
             return self._fetch_all()
 
+    def messages_by_uid(self, name, uids):
+        if not uids:
+            return []
+
+        with self.lock:
+            self.cursor.execute(f"""
+            SELECT 
+                *
+            FROM 
+                {self.database}.{name}
+            WHERE
+                uid IN %s
+            """, (tuple(uids),))
+
+            return self._fetch_all()
+
+    def changed_messages(self, name, since):
+        with self.lock:
+            # the union lets each side use its index
+            self.cursor.execute(f"""
+            SELECT 
+                *
+            FROM 
+                {self.database}.{name}
+            WHERE
+                uid IN (
+                    SELECT uid FROM {self.database}.{name} WHERE read_time > %s
+                    UNION
+                    SELECT uid FROM {self.database}.{name} WHERE actioned_time > %s
+                )
+            """, (since, since))
+
+            return self._fetch_all()
+
     def unread_messages(self, name, namespace, mtype=None):
         with self.lock:
             constraints, args = self.new_filters(namespace, mtype)
@@ -201,22 +250,85 @@ class CKQueueMonitor(QueueMonitor):
 
             return self._fetch_all()
 
-    def unread_count(self, name, namespace, mtype=None):
+    def _clear_counters(self, queue, namespace):
+        """Remove the counters of the messages that were deleted
+
+        The counters of the messages the monitor purges or resets are corrected by the next
+        `reconcile_counters`, done by the :class:`~msgqueue.reaper.Reaper` after each sweep
+        """
+        if not self.use_counters:
+            return
+
+        constraint = '1 = 1'
+        args = tuple()
+        if namespace is not None:
+            constraint = 'namespace = %s'
+            args = (namespace,)
+
+        self.cursor.execute(f"""
+        DELETE FROM {self.database}.counters
+        WHERE
+            queue = %s AND {constraint}
+        """, (queue, *args))
+
+    def counters(self, queue, namespace=None, mtype=None):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        constraints, args = self.new_filters(namespace, mtype)
+
         with self.lock:
-            constraints, args = self.new_filters(namespace, mtype)
             self.cursor.execute(f"""
-            SELECT 
-                COUNT(*)
-            FROM 
-                {self.database}.{name}
-            WHERE 
-                {constraints}
-                AND read = false
-            """, args)
+            SELECT
+                state, sum(count)
+            FROM {self.database}.counters
+            WHERE
+                queue = %s AND {constraints}
+            GROUP BY
+                state
+            """, (queue, *args))
+
+            counts = {state: 0 for state in COUNTER_STATES}
+            counts.update({state: int(count) for state, count in self.cursor.fetchall()})
+            return counts
+
+    def reconcile_counters(self, queue):
+        """See `~msgqueue.backends.queue.QueueMonitor`
+
+        The recount and the overwrite are done in a single transaction,
+        a client updating the counters concurrently makes it retry instead of being overwritten
+        """
+        states = {
+            'unread': 'read = false',
+            'unactioned': 'read = true AND actioned = false',
+            'actioned': 'actioned = true',
+            'failed': 'read = true AND actioned = false AND error IS NOT NULL',
+        }
+
+        def recount(cursor):
+            cursor.execute(f"DELETE FROM {self.database}.counters WHERE queue = %s", (queue,))
+
+            for state, condition in states.items():
+                cursor.execute(f"""
+                INSERT INTO {self.database}.counters (queue, namespace, mtype, state, slot, count)
+                SELECT
+                    %s, coalesce(namespace, ''), mtype, %s, 0, count(*)
+                FROM {self.database}.{queue}
+                WHERE
+                    {condition}
+                GROUP BY
+                    namespace, mtype
+                """, (queue, state))
+
+        with self.lock:
+            self.cursor.transaction(recount)
+
+    def _count(self, name, namespace, mtype, condition, approximate=False):
+        """Count the messages matching `condition`, estimate it from a sample if `approximate`"""
+        if approximate:
+            count = self._sampled_count(name, namespace, mtype, condition)
 
-            return self.cursor.fetchone()[0]
+            if count is not None:
+                return count
 
-    def unactioned_count(self, name, namespace, mtype=None):
         with self.lock:
             constraints, args = self.new_filters(namespace, mtype)
             self.cursor.execute(f"""
@@ -226,41 +338,100 @@ class CKQueueMonitor(QueueMonitor):
                 {self.database}.{name}
             WHERE 
                 {constraints}
-                AND read = true
-                AND actioned = false
+                AND {condition}
             """, args)
 
-            return self.cursor.fetchone()[0]
+            count = self.cursor.fetchone()[0]
+            return ApproximateCount(count) if approximate else count
+
+    def _sampled_count(self, name, namespace, mtype, condition):
+        """Estimate the number of messages matching `condition` without scanning the queue,
+        returns None if the queue is small enough to be counted
+
+        The size of the queue is read from the table statistics, which are refreshed by cockroach as the table
+        changes, the error bound does not account for their staleness.
+        uids are increasing, the sample is made of `sample_blocks` ranges of consecutive messages
+        spread evenly between the oldest and the newest message.
 
-    def read_count(self, name, namespace, mtype=None):
+        Every block has the same weight, the estimate and its error bound assume the messages are spread
+        uniformly over the uids. When they are not (bursts of inserts, ranges emptied by `clear` or `archive`)
+        the blocks of sparse ranges are over-weighted and the error can exceed the bound
+        """
         with self.lock:
-            constraints, args = self.new_filters(namespace, mtype)
-            query = f"""
+            self.cursor.execute(f"""
             SELECT 
-                COUNT(*)
+                row_count
             FROM 
-                {self.database}.{name}
-            WHERE 
-                {constraints}
-                AND read = true
-            """
-            self.cursor.execute(query, args)
-            return self.cursor.fetchone()[0]
+                [SHOW STATISTICS FOR TABLE {self.database}.{name}]
+            ORDER BY 
+                created DESC
+            LIMIT 1
+            """)
+
+            row = self.cursor.fetchone()
+            if row is None or row[0] <= self.sample_size:
+                return None
+
+            total = row[0]
+            self.cursor.execute(f"SELECT min(uid), max(uid) FROM {self.database}.{name}")
+            low, high = self.cursor.fetchone()
+
+            step = (high - low) // self.sample_blocks + 1
+            offset = random.randrange(step)
+            block_size = self.sample_size // self.sample_blocks
+
+            blocks = []
+            bounds = []
+            for i in range(self.sample_blocks):
+                blocks.append(f"""
+                (SELECT * FROM {self.database}.{name} WHERE uid >= %s AND uid < %s ORDER BY uid LIMIT {block_size})
+                """)
+                bounds.extend((low + offset + i * step, low + offset + (i + 1) * step))
 
-    def actioned_count(self, name, namespace, mtype=None):
-        with self.lock:
             constraints, args = self.new_filters(namespace, mtype)
             self.cursor.execute(f"""
-            SELECT 
-                COUNT(*)
-            FROM 
-                {self.database}.{name}
-            WHERE 
-                {constraints}
-                AND actioned = true
-            """, args)
+            SELECT
+                count(*),
+                count(CASE WHEN {constraints} AND {condition} THEN 1 END)
+            FROM (
+                {' UNION ALL '.join(blocks)}
+            ) AS sample
+            """, (*args, *bounds))
+
+            sampled, matched = self.cursor.fetchone()
+            if sampled == 0:
+                return None
+
+            return sampled_count(total, sampled, matched)
+
+    def unread_count(self, name, namespace, mtype=None, approximate=False):
+        if self.use_counters:
+            count = self.counters(name, namespace, mtype)['unread']
+            return ApproximateCount(count) if approximate else count
+
+        return self._count(name, namespace, mtype, 'read = false', approximate)
 
-            return self.cursor.fetchone()[0]
+    def unactioned_count(self, name, namespace, mtype=None, approximate=False):
+        if self.use_counters:
+            count = self.counters(name, namespace, mtype)['unactioned']
+            return ApproximateCount(count) if approximate else count
+
+        return self._count(name, namespace, mtype, 'read = true AND actioned = false', approximate)
+
+    def read_count(self, name, namespace, mtype=None, approximate=False):
+        if self.use_counters:
+            counts = self.counters(name, namespace, mtype)
+            count = counts['unactioned'] + counts['actioned']
+            return ApproximateCount(count) if approximate else count
+
+        return self._count(name, namespace, mtype, 'read = true', approximate)
+
+    def actioned_count(self, name, namespace, mtype=None, approximate=False):
+        if self.use_counters:
+            count = self.counters(name, namespace, mtype)['actioned']
+            return ApproximateCount(count) if approximate else count
+
+        return self._count(name, namespace, mtype, 'actioned = true', approximate)
 
     def reset_queue(self, name, namespace):
         with self.lock:
@@ -268,7 +439,7 @@ class CKQueueMonitor(QueueMonitor):
             self.cursor.execute(f"""
             UPDATE {self.database}.{name}
                 SET 
-                    (read, read_time) = (false, null)
+                    (read, read_time, agent, lease_until) = (false, null, null, null)
                 WHERE 
                     {constraints}
                     AND actioned = false
@@ -280,6 +451,9 @@ class CKQueueMonitor(QueueMonitor):
             for row in rows:
                 records.append(_parse(row))
 
+            if records:
+                self.reconcile_quotas(name)
+
             return records
 
     def reply(self, name, uid):
@@ -293,18 +467,50 @@ class CKQueueMonitor(QueueMonitor):
             FROM 
                 {self.database}.{name}
             WHERE 
-                replying_to = %s AND
+                replying_to = %s
             """, (uid,))
 
             return _parse(self.cursor.fetchone())
 
+    def _claims(self, namespace):
+        """Return the message each agent is processing, the claims are recorded on the message rows"""
+        claims = dict()
+        constraints, args = self.new_filters(namespace, None)
+
+        for queue in self.queues():
+            try:
+                self.cursor.execute(f"""
+                SELECT
+                    agent, uid, namespace
+                FROM
+                    {self.database}.{queue}
+                WHERE
+                    {constraints}
+                    AND read     = true
+                    AND actioned = false
+                    AND agent IS NOT NULL
+                """, args)
+            except psycopg2.errors.UndefinedTable:
+                continue
+
+            for agent, uid, message_namespace in self.cursor.fetchall():
+                claims[agent] = (queue, uid, message_namespace)
+
+        return claims
+
     def agents(self, namespace):
+        """Return the agents, with a namespace only the agents processing a message of the namespace"""
         with self.lock:
+            claims = self._claims(namespace)
+
             constraint = '1 = 1'
             args = tuple()
             if namespace is not None:
-                constraint = 'namespace = %s'
-                args = (namespace,)
+                if not claims:
+                    return []
+
+                constraint = 'uid IN %s'
+                args = (tuple(claims),)
 
             self.cursor.execute(f"""
             SELECT 
@@ -315,30 +521,76 @@ class CKQueueMonitor(QueueMonitor):
                 {constraint}
             """, args)
 
-            return [_parse_agent(a) for a in self.cursor.fetchall()]
+            agents = [_parse_agent(a) for a in self.cursor.fetchall()]
+
+            for agent in agents:
+                if agent.uid in claims:
+                    agent.queue, agent.message, agent.namespace = claims[agent.uid]
+
+            return agents
+
+    def agent_messages(self, queue, agent=None):
+        if isinstance(agent, Agent):
+            agent = agent.uid
+
+        with self.lock:
+            constraint = 'agent IS NOT NULL'
+            args = tuple()
+            if agent is not None:
+                constraint = 'agent = %s'
+                args = (agent,)
+
+            self.cursor.execute(f"""
+            SELECT
+                *
+            FROM
+                {self.database}.{queue}
+            WHERE
+                read     = true  AND
+                actioned = false AND
+                {constraint}
+            """, args)
+
+            return self._fetch_all()
 
     def lost_messages(self, queue, namespace, timeout_s=120, max_retry=3):
+        """Return the messages whose lease expired before they were actioned
+
+        `timeout_s` is deprecated and ignored, the lease duration is set by the client that dequeued the message
+        """
         with self.lock:
+            constraint = ''
+            args = tuple()
+
+            if namespace is not None:
+                constraint = 'AND namespace = %s'
+                args = (namespace,)
+
             self.cursor.execute(f"""
             SELECT
                 *
             FROM
                 {self.database}.{queue}
             WHERE
-                namespace = %s      AND
-                retry < {max_retry} AND
-                current_timestamp() - heartbeat >  {timeout_s} * interval '1 second'
-            """, (namespace,))
+                read        = true  AND
+                actioned    = false AND
+                lease_until < current_timestamp()
+                {constraint}
+            """, args)
 
-            agents = [_parse_agent(agent) for agent in self.cursor.fetchall()]
+            return self._fetch_all()
 
-        msg = []
-        for a in agents:
-            msg.append((a.message, a.queue))
+    def _requeue(self, queue, statement, args, transitions):
+        """Execute a requeue `statement` returning the namespace and mtype of the requeued messages,
+        returns the number of messages requeued"""
+        if self.use_counters:
+            statement, args = counted(self.database, queue, statement, args, transitions)
 
-        return msg
+        self.cursor.execute(statement, args)
+        return len(self.cursor.fetchall())
 
     def requeue_lost_messages(self, queue, namespace, timeout_s=120, max_retry=3):
+        """Requeue the messages whose lease expired, `timeout_s` is deprecated and ignored"""
         with self.lock:
             constraint = ''
             args = tuple()
@@ -347,20 +599,28 @@ class CKQueueMonitor(QueueMonitor):
                 constraint = 'AND namespace = %s'
                 args = (namespace,)
 
-            self.cursor.execute(f"""
-               UPDATE {self.database}.{queue}
-               SET 
-                   (read, read_time, error, retry) = (false, null, null, retry + 1)
-               WHERE
-                   read     = true  AND
-                   actioned = false AND
-                   retry    < %s    AND
-                   current_timestamp() - heartbeat >  {timeout_s} * interval '1 second'         
-                   {constraint}
-               RETURNING uid
-               """, (max_retry,) + args)
-
-            return len([i for i in self.cursor.fetchall()])
+            requeued = 0
+
+            # the failed messages leave the failed counter as well
+            for failed, transitions in (('IS NULL', REQUEUED), ('IS NOT NULL', REQUEUED_FAILED)):
+                requeued += self._requeue(queue, f"""
+                   UPDATE {self.database}.{queue}
+                   SET 
+                       (read, read_time, error, retry, agent, lease_until) = (false, null, null, retry + 1, null, null)
+                   WHERE
+                       read        = true  AND
+                       actioned    = false AND
+                       lease_until < current_timestamp() AND
+                       retry       < %s AND
+                       error       {failed}
+                       {constraint}
+                   RETURNING namespace, mtype
+                   """, (max_retry,) + args, transitions)
+
+            if requeued:
+                self.reconcile_quotas(queue)
+
+            return requeued
 
     def failed_messages(self, queue, namespace):
         with self.lock:
@@ -395,18 +655,292 @@ class CKQueueMonitor(QueueMonitor):
             query = f"""
             UPDATE {self.database}.{queue}
             SET 
-                (read, read_time, error, retry) = (false, null, null, retry + 1)
+                (read, read_time, error, retry, agent, lease_until) = (false, null, null, retry + 1, null, null)
             WHERE
                 read     = true  AND
                 actioned = false AND
                 retry    < %s    AND
                 error    IS NOT NULL
                 {constraint}
-            RETURNING uid
+            RETURNING namespace, mtype
             """
 
-            self.cursor.execute(query, (max_retry,) + args)
-            return len([i for i in self.cursor.fetchall()])
+            return self._requeue(queue, query, (max_retry,) + args, REQUEUED_FAILED)
+
+    def expired_messages(self, queue, namespace, mtype=None):
+        with self.lock:
+            constraints, args = self.new_filters(namespace, mtype)
+            self.cursor.execute(f"""
+            SELECT
+                *
+            FROM
+                {self.database}.{queue}
+            WHERE
+                {constraints}
+                AND read = false
+                AND expire_time <= current_timestamp()
+            """, args)
+
+            return self._fetch_all()
+
+    def expired_count(self, queue, namespace, mtype=None, approximate=False):
+        condition = 'read = false AND expire_time <= current_timestamp()'
+        return self._count(queue, namespace, mtype, condition, approximate)
+
+    def purge_expired_messages(self, queue, namespace, batch_size=1000):
+        constraints, args = self.new_filters(namespace, None)
+        query = f"""
+        DELETE FROM {self.database}.{queue}
+        WHERE
+            {constraints}
+            AND read = false
+            AND expire_time <= current_timestamp()
+        LIMIT {int(batch_size)}
+        """
+
+        # delete in small batches so we do not hold a huge transaction
+        # that would conflict with the workers dequeuing messages
+        removed = 0
+        while True:
+            with self.lock:
+                self.cursor.execute(query, args)
+                count = self.cursor.rowcount
+
+            removed += max(count, 0)
+            if count < batch_size:
+                return removed
+
+    def active_namespaces(self, queue, mtype=None):
+        """Return the namespaces that have unread messages
+
+        The namespaces are enumerated with a skip scan on the dequeue index,
+        the cost depends on the number of namespaces not on the number of messages
+        """
+        constraint, arg = self._constraint('mtype', mtype)
+        args = tuple()
+
+        if constraint is None:
+            constraint = '1 = 1'
+        else:
+            args = (arg, arg)
+
+        with self.lock:
+            try:
+                self.cursor.execute(f"""
+                WITH RECURSIVE active (namespace) AS (
+                    (SELECT
+                        namespace
+                    FROM {self.database}.{queue}
+                    WHERE
+                        read = false AND {constraint}
+                    ORDER BY
+                        namespace
+                    LIMIT 1)
+                UNION ALL
+                    SELECT (
+                        SELECT
+                            m.namespace
+                        FROM {self.database}.{queue} AS m
+                        WHERE
+                            m.read = false AND {constraint} AND m.namespace > active.namespace
+                        ORDER BY
+                            m.namespace
+                        LIMIT 1
+                    )
+                    FROM active
+                    WHERE active.namespace IS NOT NULL
+                )
+                SELECT namespace FROM active WHERE namespace IS NOT NULL
+                """, args)
+            except psycopg2.errors.UndefinedTable:
+                return []
+
+            return [r[0] for r in self.cursor.fetchall()]
+
+    def stats(self, queues=None, namespaces=None):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        if queues is None:
+            queues = self.queues()
+
+        constraints, args = self.new_filters(list(namespaces) if namespaces is not None else None, None)
+        stats = []
+
+        with self.lock:
+            for queue in queues:
+                self.cursor.execute(f"""
+                SELECT
+                    namespace,
+                    count(CASE WHEN read = false THEN 1 END),
+                    count(CASE WHEN read = true THEN 1 END),
+                    count(CASE WHEN read = true AND actioned = false THEN 1 END),
+                    count(CASE WHEN actioned = true THEN 1 END),
+                    count(CASE WHEN read = true AND actioned = false AND error IS NOT NULL THEN 1 END),
+                    count(CASE WHEN read = true AND actioned = false AND lease_until < current_timestamp() THEN 1 END),
+                    max(CASE WHEN read = false THEN extract(epoch FROM current_timestamp()::TIMESTAMP - time) END)
+                FROM {self.database}.{queue}
+                WHERE
+                    {constraints}
+                GROUP BY
+                    namespace
+                """, args)
+
+                for namespace, *counts, oldest in self.cursor.fetchall():
+                    stats.append(QueueStats(queue, namespace, *counts, float(oldest or 0)))
+
+        return stats
+
+    def waiting_times(self, queue, namespace=None):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        constraints, args = self.new_filters(namespace, None)
+
+        with self.lock:
+            self.cursor.execute(f"""
+            SELECT
+                namespace,
+                count(*),
+                avg(extract(epoch FROM read_time - time)),
+                max(extract(epoch FROM read_time - time))
+            FROM {self.database}.{queue}
+            WHERE
+                {constraints} AND read = true
+            GROUP BY
+                namespace
+            """, args)
+
+            stats = {
+                n: WaitingTime(count, float(mean or 0), float(longest or 0))
+                for n, count, mean, longest in self.cursor.fetchall()}
+
+            self.cursor.execute(f"""
+            SELECT
+                namespace,
+                max(extract(epoch FROM current_timestamp()::TIMESTAMP - time))
+            FROM {self.database}.{queue}
+            WHERE
+                {constraints} AND read = false
+            GROUP BY
+                namespace
+            """, args)
+
+            for n, oldest in self.cursor.fetchall():
+                stats.setdefault(n, WaitingTime(0, 0, 0)).oldest = float(oldest or 0)
+
+            return stats
+
+    def set_quota(self, queue, namespace=None, max_inflight=None):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        with self.lock:
+            if max_inflight is None:
+                self.cursor.execute(f"""
+                DELETE FROM {self.database}.quotas
+                WHERE
+                    queue = %s AND
+                    namespace = %s
+                """, (queue, namespace or ''))
+                return
+
+            self.cursor.execute(f"""
+            UPSERT INTO {self.database}.quotas (queue, namespace, max_inflight)
+            VALUES
+                (%s, %s, %s)
+            """, (queue, namespace or '', int(max_inflight)))
+
+            # a new quota starts from the messages already being processed
+            self.reconcile_quotas(queue)
+
+    def quotas(self, queue):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        with self.lock:
+            try:
+                self.cursor.execute(f"""
+                SELECT
+                    namespace, max_inflight
+                FROM {self.database}.quotas
+                WHERE
+                    queue = %s
+                """, (queue,))
+            except psycopg2.errors.UndefinedTable:
+                return dict()
+
+            return {n or None: m for n, m in self.cursor.fetchall()}
+
+    def quota_usage(self, queue):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        with self.lock:
+            try:
+                self.cursor.execute(f"""
+                SELECT
+                    namespace, inflight, max_inflight
+                FROM {self.database}.quotas
+                WHERE
+                    queue = %s
+                """, (queue,))
+            except psycopg2.errors.UndefinedTable:
+                return dict()
+
+            return {n or None: QuotaUsage(inflight, m) for n, inflight, m in self.cursor.fetchall()}
+
+    def reconcile_quotas(self, queue):
+        """Recount the messages being processed of each quota
+
+        The clients keep a counter of the messages being processed,
+        it drifts when messages are requeued or when a client dies before releasing its messages
+        """
+        with self.lock:
+            self.cursor.execute(f"""
+            UPDATE {self.database}.quotas SET
+                inflight = (
+                    SELECT count(*) FROM {self.database}.{queue} AS inflight
+                    WHERE
+                        inflight.read     = true  AND
+                        inflight.actioned = false AND
+                        inflight.error    IS NULL AND
+                        (quotas.namespace = '' OR inflight.namespace = quotas.namespace))
+            WHERE
+                queue = %s
+            """, (queue,))
+
+    def acquire_leader(self, name, holder, lease):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        with self.lock:
+            self.cursor.execute(f"""
+            INSERT INTO {self.database}.leaders (name, holder, lease_until)
+            VALUES
+                (%s, %s, current_timestamp() + %s * interval '1 second')
+            ON CONFLICT (name) DO UPDATE SET
+                (holder, lease_until) = (excluded.holder, excluded.lease_until)
+            WHERE
+                leaders.holder = excluded.holder OR
+                leaders.lease_until < current_timestamp()
+            RETURNING holder
+            """, (name, holder, float(lease)))
+
+            return self.cursor.fetchone() is not None
+
+    def release_leader(self, name, holder):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        with self.lock:
+            self.cursor.execute(f"""
+            DELETE FROM {self.database}.leaders
+            WHERE
+                name   = %s AND
+                holder = %s
+            """, (name, holder))
+
+    def leader(self, name):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        with self.lock:
+            self.cursor.execute(f"""
+            SELECT
+                holder
+            FROM {self.database}.leaders
+            WHERE
+                name        = %s AND
+                lease_until > current_timestamp()
+            """, (name,))
+
+            row = self.cursor.fetchone()
+            return row[0] if row is not None else None
 
     def log(self, agent, ltype=0):
         if isinstance(agent, Agent):
@@ -426,5 +960,5 @@ class CKQueueMonitor(QueueMonitor):
             return ''.join([r[0] for r in self.cursor.fetchall()])
 
 
-def new_monitor(*args, **kwargs):
-    return CKQueueMonitor(*args, **kwargs)
+def new_monitor(uri, database, *args, **kwargs):
+    return CKQueueMonitor(database, uri, *args, **kwargs)
@@ -13,7 +13,7 @@ from msgqueue.uri import parse_uri
 from msgqueue.logs import debug, info, error, warning
 
 
-VERSION = '19.1.1'
+VERSION = '21.2.17'
 
 COCKROACH_HASH = {
     'posix': '051b9f3afd3478b62e3fce0d140df6f091b4a1e4ef84f05c3f1c3588db2495fa',
@@ -86,6 +86,9 @@ def system_schema(clients, db_name):
         permissions.append(f'GRANT ALL ON TABLE {db_name}.qsystem TO {client};')
         permissions.append(f'GRANT ALL ON TABLE {db_name}.system TO {client};')
         permissions.append(f'GRANT ALL ON TABLE {db_name}.logs TO {client};')
+        permissions.append(f'GRANT ALL ON TABLE {db_name}.leaders TO {client};')
+        permissions.append(f'GRANT ALL ON TABLE {db_name}.quotas TO {client};')
+        permissions.append(f'GRANT ALL ON TABLE {db_name}.counters TO {client};')
 
     permissions = '\n'.join(permissions)
 
@@ -103,8 +106,10 @@ def system_schema(clients, db_name):
     );
     CREATE TABLE IF NOT EXISTS {db_name}.qsystem (
         namespace       character(64),
-        name            character(64)
+        name            character(64),
+        shards          INT         DEFAULT 1
     );
+    ALTER TABLE {db_name}.qsystem ADD COLUMN IF NOT EXISTS shards INT DEFAULT 1;
     CREATE TABLE IF NOT EXISTS {db_name}.logs (
         uid             SERIAL      PRIMARY KEY,
         agent           INTEGER,
@@ -113,6 +118,31 @@ def system_schema(clients, db_name):
         namespace       character(64)
     );
 
+    CREATE TABLE IF NOT EXISTS {db_name}.leaders (
+        name            STRING      PRIMARY KEY,
+        holder          STRING,
+        lease_until     TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS {db_name}.quotas (
+        queue           STRING,
+        namespace       STRING,
+        max_inflight    INT,
+        inflight        INT         DEFAULT 0,
+        PRIMARY KEY (queue, namespace)
+    );
+    ALTER TABLE {db_name}.quotas ADD COLUMN IF NOT EXISTS inflight INT DEFAULT 0;
+
+    CREATE TABLE IF NOT EXISTS {db_name}.counters (
+        queue           STRING,
+        namespace       STRING,
+        mtype           INT,
+        state           STRING,
+        slot            INT,
+        count           INT,
+        PRIMARY KEY (queue, namespace, mtype, state, slot)
+    );
+
     CREATE INDEX IF NOT EXISTS system_index
     ON {db_name}.system (
         uid         ASC,
@@ -134,7 +164,7 @@ def system_schema(clients, db_name):
     """
 
 
-def message_queue_schema(clients, db_name, queue_name):
+def message_queue_schema(clients, db_name, queue_name, shards=1):
     """Create a message queue table
 
     uid          : message uid to update messages
@@ -144,6 +174,14 @@ def message_queue_schema(clients, db_name, queue_name):
     actioned     : was the message actioned
     actioned_time: when was the message actioned
     message      : the message
+    expire_time  : when does the message expire if it was not read
+    shard        : shard the message was inserted in
+    agent        : agent processing the message
+    lease_until  : when is the message considered lost if it was not actioned
+
+    When the queue has more than one shard, the primary key is hash sharded and the
+    dequeue indexes are prefixed by the shard so inserts are spread across ranges
+    instead of all landing at the tail of the table.
     """
     assert queue_name != 'system', 'system name is reserved'
     assert queue_name != 'logs', 'logs name is reserved'
@@ -157,10 +195,15 @@ def message_queue_schema(clients, db_name, queue_name):
         permissions.append(f'GRANT ALL ON TABLE {db_name}.logs TO {client};')
     permissions = '\n'.join(permissions)
 
+    primary_key = 'PRIMARY KEY (uid)'
+    if shards > 1:
+        primary_key = f'PRIMARY KEY (uid) USING HASH WITH BUCKET_COUNT = {int(shards)}'
+
     return f"""
     SET DATABASE = {db_name};
+    SET experimental_enable_hash_sharded_indexes = on;
     CREATE TABLE IF NOT EXISTS {db_name}.{queue_name} (
-        uid             SERIAL      PRIMARY KEY,
+        uid             SERIAL,
         time            TIMESTAMP   DEFAULT current_timestamp(),
         mtype           INT,
         read            BOOLEAN,
@@ -172,24 +215,121 @@ def message_queue_schema(clients, db_name, queue_name):
         retry           INT,
         error           JSONB,
         namespace       character(64),
-        heartbeat       TIMESTAMP   DEFAULT current_timestamp()
+        heartbeat       TIMESTAMP   DEFAULT current_timestamp(),
+        expire_time     TIMESTAMP,
+        shard           INT         DEFAULT 0,
+        agent           INTEGER,
+        lease_until     TIMESTAMP,
+        {primary_key}
     );
 
-    CREATE INDEX IF NOT EXISTS messages_index
+    {message_queue_indexes(db_name, queue_name, shards)}
+
+    {permissions}
+    """
+
+
+def message_queue_indexes(db_name, queue_name, shards=1):
+    """Indexes following the access paths of the message queue
+
+    dequeue_index      : pop the oldest unread message of a namespace
+    dequeue_all_index  : pop the oldest unread message when no namespace is specified
+    lease_index        : find messages that are being processed and their lease expired (lost messages)
+    expire_index       : find the unread messages that expired
+    reply_index        : find the replies of a message
+    time_index         : find the messages inserted since a time in all the namespaces (mirror)
+    read_time_index    : find the messages read since a time (mirror)
+    actioned_time_index: find the messages actioned since a time (mirror)
+
+    Sharded queues are dequeued one shard at a time, the dequeue indexes are prefixed by the shard.
+    The lease, expire and time indexes are ordered by a timestamp and scanned across shards,
+    they are hash sharded instead so their writes do not all land at their tail
+    """
+    shard = ''
+    hashed = ''
+    if shards > 1:
+        shard = 'shard       ASC,'
+        hashed = f'USING HASH WITH BUCKET_COUNT = {int(shards)}'
+
+    return f"""
+    CREATE INDEX IF NOT EXISTS dequeue_index
     ON {db_name}.{queue_name} (
-        read        DESC, 
-        time        DESC,
-        actioned    DESC,
+        {shard}
+        namespace   ASC,
         mtype       ASC,
-        replying_to DESC,
-        namespace   DESC
-    );
+        time        ASC
+    ) WHERE read = false;
 
-    {permissions}
+    CREATE INDEX IF NOT EXISTS dequeue_all_index
+    ON {db_name}.{queue_name} (
+        {shard}
+        mtype       ASC,
+        time        ASC
+    ) WHERE read = false;
+
+    CREATE INDEX IF NOT EXISTS reply_index
+    ON {db_name}.{queue_name} (
+        replying_to ASC
+    ) WHERE replying_to IS NOT NULL;
+
+    SET experimental_enable_hash_sharded_indexes = on;
+    CREATE INDEX IF NOT EXISTS lease_index
+    ON {db_name}.{queue_name} (
+        lease_until ASC,
+        namespace   ASC
+    ) {hashed} WHERE read = true AND actioned = false;
+
+    CREATE INDEX IF NOT EXISTS expire_index
+    ON {db_name}.{queue_name} (
+        expire_time ASC
+    ) {hashed} WHERE read = false;
+
+    CREATE INDEX IF NOT EXISTS time_index
+    ON {db_name}.{queue_name} (
+        time        ASC
+    ) {hashed};
+
+    CREATE INDEX IF NOT EXISTS read_time_index
+    ON {db_name}.{queue_name} (
+        read_time   ASC
+    ) {hashed} WHERE read_time IS NOT NULL;
+
+    CREATE INDEX IF NOT EXISTS actioned_time_index
+    ON {db_name}.{queue_name} (
+        actioned_time ASC
+    ) {hashed} WHERE actioned_time IS NOT NULL;
     """
 
 
-def new_queue(client, db_name, queue, namespace, username='root'):
+def upgrade_queue_schema(db_name, queue_name, shards=1):
+    """Bring a queue created by an older version up to date"""
+    rebuilt = ''
+    if shards > 1:
+        # older versions did not shard the lease and expire indexes
+        rebuilt = (
+            f'DROP INDEX IF EXISTS {db_name}.{queue_name}@lease_index;\n'
+            f'    DROP INDEX IF EXISTS {db_name}.{queue_name}@expire_index;')
+
+    return f"""
+    ALTER TABLE {db_name}.{queue_name} ADD COLUMN IF NOT EXISTS expire_time TIMESTAMP;
+    ALTER TABLE {db_name}.{queue_name} ADD COLUMN IF NOT EXISTS shard INT DEFAULT 0;
+    ALTER TABLE {db_name}.{queue_name} ADD COLUMN IF NOT EXISTS agent INTEGER;
+    ALTER TABLE {db_name}.{queue_name} ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP;
+
+    DROP INDEX IF EXISTS {db_name}.{queue_name}@messages_index;
+    DROP INDEX IF EXISTS {db_name}.{queue_name}@inflight_index;
+    {rebuilt}
+    {message_queue_indexes(db_name, queue_name, shards)}
+
+    -- messages being processed by older clients get the default worker timeout to finish
+    UPDATE {db_name}.{queue_name} SET
+        lease_until = heartbeat + interval '5 minutes'
+    WHERE
+        read = true AND actioned = false AND lease_until IS NULL;
+    """
+
+
+def new_queue(client, db_name, queue, namespace, username='root', shards=1):
     """Create a new queue
 
     Parameters
@@ -202,14 +342,46 @@ def new_queue(client, db_name, queue, namespace, username='root'):
 
     clients: str
         create permission for all the clients
+
+    shards: int
+        number of shards the queue is split into
     """
     client.execute(
-        message_queue_schema([username], db_name, queue))
+        message_queue_schema([username], db_name, queue, shards))
+
+    client.execute(f"""
+    INSERT INTO {db_name}.qsystem (namespace, name, shards)
+    VALUES (%s, %s, %s)
+    """, (namespace, queue, shards))
+
+
+def upgrade_queues(client, db_name):
+    """Migrate all the existing queues of a database to the current schema
+
+    Parameters
+    ----------
+    client: cursor
+        cursor to the database
 
+    db_name: str
+        database name
+
+    Returns
+    -------
+    the list of queues that were upgraded
+    """
     client.execute(f"""
-    INSERT INTO {db_name}.qsystem (namespace, name)
-    VALUES (%s, %s)
-    """, (namespace, queue))
+    SELECT
+        name, max(shards)
+    FROM {db_name}.qsystem
+    GROUP BY name;
+    """)
+
+    queues = [(q.strip(), shards or 1) for q, shards in client.fetchall()]
+    for queue, shards in queues:
+        client.execute(upgrade_queue_schema(db_name, queue, shards))
+
+    return [q for q, _ in queues]
 
 
 class CockRoachDB(QueueServer):
@@ -342,7 +514,7 @@ class CockRoachDB(QueueServer):
             f'{self.bin} sql --insecure --host={self.addrs}', input=statement, shell=True)
         debug(out.decode('utf8').strip())
 
-    def new_queue(self, db_name, queue_name, namespace, client='root'):
+    def new_queue(self, db_name, queue_name, namespace, client='root', shards=1):
         """Create a new queue
 
         Parameters
@@ -355,8 +527,18 @@ class CockRoachDB(QueueServer):
 
         clients: str
             create permission for all the clients
+
+        shards: int
+            number of shards the queue is split into
         """
-        new_queue(self.client, db_name, queue_name, namespace, username='root')
+        new_queue(self.cursor, db_name, queue_name, namespace, username='root', shards=shards)
+
+    def upgrade_queues(self, db_name=None):
+        """Migrate the existing queues to the current schema, see :func:`upgrade_queues`"""
+        if db_name is None:
+            db_name = self.database
+
+        return upgrade_queues(self.cursor, db_name)
 
     def stop(self):
         self.properties['running'] = False
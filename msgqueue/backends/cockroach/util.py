@@ -1,5 +1,12 @@
+import random
+import time
+from dataclasses import dataclass, asdict
+
+from msgqueue.logs import debug
 from msgqueue.backends.queue import Message, Agent
 
+RETRYABLE_ERROR = '40001'
+
 
 def _parse(result):
     if result is None:
@@ -8,8 +15,191 @@ def _parse(result):
     return Message(*result)
 
 
+def counted(database, queue, statement, args, transitions, slot=0):
+    """Update the counters of the messages changed by `statement` in the same statement
+
+    `statement` returns the namespace and mtype of the messages it changed
+    and `transitions` are the changes of the counters for each of them.
+    If the statement is retried so is the counter update, the counters never drift from the writes
+    """
+    values = ', '.join(f"('{state}', {delta})" for state, delta in transitions)
+    return f"""
+    WITH changed AS ({statement}),
+    counted AS (
+        INSERT INTO {database}.counters (queue, namespace, mtype, state, slot, count)
+        SELECT
+            %s, coalesce(changed.namespace, ''), changed.mtype, t.state, %s, sum(t.delta)::INT
+        FROM
+            changed, (VALUES {values}) AS t (state, delta)
+        GROUP BY
+            changed.namespace, changed.mtype, t.state
+        ON CONFLICT (queue, namespace, mtype, state, slot)
+        DO UPDATE SET count = counters.count + excluded.count
+    )
+    SELECT * FROM changed
+    """, (*args, queue, slot)
+
+
 def _parse_agent(result):
     if result is None:
         return None
 
     return Agent(*result)
+
+
+@dataclass
+class ContentionStats:
+    transactions: int = 0       # Number of transactions executed
+    conflicts: int = 0          # Number of transactions that had to be retried at least once
+    retries: int = 0            # Number of retries
+    failures: int = 0           # Number of transactions that failed after exhausting their retries
+    time_lost: float = 0        # Time spent in aborted attempts and backing off (seconds)
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def is_retryable(error):
+    return getattr(error, 'pgcode', None) == RETRYABLE_ERROR
+
+
+class RetryCursor:
+    """Cursor retrying the statements and transactions that fail on serialization conflicts
+
+    A single statement is executed as is, as an implicit transaction cockroach retries it itself
+    when it can, the conflicts it returns are retried by re-executing the statement.
+    :meth:`transaction` groups several statements, it follows cockroach `SAVEPOINT cockroach_restart` protocol.
+    Both are retried with a bounded exponential backoff.
+    Results are fetched before the transaction is committed, so `fetchone` and `fetchall`
+    behave as with a regular cursor.
+
+    Schema statements (CREATE, ALTER, DROP, SET, GRANT) are executed as is, without retries.
+
+    Parameters
+    ----------
+    cursor: psycopg2 cursor
+        cursor of a connection in autocommit mode
+
+    max_retries: int
+        number of retries before the error is raised
+
+    base_delay: float
+        backoff of the first retry in seconds, doubled every retry
+
+    max_delay: float
+        maximum backoff in seconds
+    """
+    schema_statements = ('CREATE', 'ALTER', 'DROP', 'SET', 'GRANT')
+
+    def __init__(self, cursor, max_retries=10, base_delay=0.005, max_delay=0.5):
+        self.cursor = cursor
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = ContentionStats()
+        self.in_transaction = False
+        self.rows = None
+        self.rowcount = -1
+        self.description = None
+
+    @property
+    def connection(self):
+        return self.cursor.connection
+
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay * random.uniform(0.5, 1)
+
+    def _run(self, statement, args):
+        self.cursor.execute(statement, args)
+        self.rowcount = self.cursor.rowcount
+        self.description = self.cursor.description
+
+        rows = None
+        if self.cursor.description is not None:
+            rows = self.cursor.fetchall()
+
+        self.rows = rows
+        return rows
+
+    def _retry(self, attempt_fun, restart):
+        """Call `attempt_fun()` until it does not fail on a serialization conflict, `restart()` is called
+        before every retry"""
+        stats = self.stats
+        stats.transactions += 1
+        attempt = 0
+
+        while True:
+            start = time.time()
+            try:
+                return attempt_fun()
+
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    if is_retryable(e):
+                        stats.failures += 1
+
+                    raise
+
+                restart()
+
+                if attempt == 0:
+                    stats.conflicts += 1
+
+                delay = self.backoff(attempt)
+                debug(f'transaction conflict, retrying in {delay:.4f}s ({e.pgerror})')
+                time.sleep(delay)
+
+                attempt += 1
+                stats.retries += 1
+                stats.time_lost += time.time() - start
+
+    def execute(self, statement, args=None):
+        if self.in_transaction:
+            return self._run(statement, args)
+
+        if isinstance(statement, str) and statement.lstrip().upper().startswith(self.schema_statements):
+            self.rows = None
+            self.cursor.execute(statement, args)
+            return None
+
+        # the implicit transaction of a failed statement is already rolled back
+        return self._retry(lambda: self._run(statement, args), lambda: None)
+
+    def transaction(self, fun):
+        """Execute `fun(cursor)` inside a transaction, `fun` is called again if the transaction is retried"""
+        def attempt():
+            result = fun(self)
+            rows, rowcount, description = self.rows, self.rowcount, self.description
+            self.cursor.execute('RELEASE SAVEPOINT cockroach_restart')
+            self.cursor.execute('COMMIT')
+            self.rows, self.rowcount, self.description = rows, rowcount, description
+            return result
+
+        self.cursor.execute('BEGIN')
+        self.cursor.execute('SAVEPOINT cockroach_restart')
+        self.in_transaction = True
+
+        try:
+            return self._retry(attempt, lambda: self.cursor.execute('ROLLBACK TO SAVEPOINT cockroach_restart'))
+
+        except Exception:
+            self.cursor.execute('ROLLBACK')
+            raise
+
+        finally:
+            self.in_transaction = False
+
+    def fetchone(self):
+        if not self.rows:
+            return None
+
+        return self.rows.pop(0)
+
+    def fetchall(self):
+        rows = self.rows or []
+        self.rows = None
+        return rows
+
+    def close(self):
+        return self.cursor.close()
@@ -0,0 +1,11 @@
+from .client import new_client as new_local_client
+from .monitor import new_monitor as new_local_monitor
+from .server import new_server as new_local_server
+from .server import start_server_main
+
+# Backends that can be used behind the sidecar i.e local+mongo://192.168.0.10:8123
+BACKENDS = ('mongo', 'cockroach')
+
+new_client = {f'local+{backend}': new_local_client for backend in BACKENDS}
+new_server = {f'local+{backend}': new_local_server for backend in BACKENDS}
+new_monitor = {f'local+{backend}': new_local_monitor for backend in BACKENDS}
@@ -0,0 +1,238 @@
+from functools import partial
+from itertools import count
+from multiprocessing.connection import Client
+import threading
+from typing import List
+
+from msgqueue.uri import parse_uri
+from msgqueue.backends.queue import Message, MessageQueue, QueuePacemaker
+
+from .server import MONITOR
+from .util import backend_uri, socket_address
+
+
+class _Reply:
+    def __init__(self, rid):
+        self.rid = rid
+        self.event = threading.Event()
+        self.ok = None
+        self.value = None
+
+    def set(self, ok, value):
+        self.ok = ok
+        self.value = value
+        self.event.set()
+
+    def result(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise TimeoutError(f'no reply from the sidecar after {timeout}s')
+
+        if not self.ok:
+            raise self.value
+
+        return self.value
+
+
+class _SidecarMonitor:
+    """Monitor of a `LocalClient`, the methods the workers call in their loop go through the sidecar,
+    the other methods connect to the database directly the first time they are used"""
+    def __init__(self, client):
+        self.client = client
+        self.direct = None
+
+    def __getattr__(self, item):
+        if item in MONITOR:
+            return partial(self.client.invoke, 'monitor', item)
+
+        if self.direct is None:
+            from msgqueue.backends import new_monitor
+            self.direct = new_monitor(backend_uri(self.client.uri), self.client.database)
+
+        return getattr(self.direct, item)
+
+
+class LocalPacemaker(QueuePacemaker):
+    def register_agent(self, agent_name):
+        self.agent_id = self.agent.invoke('register_agent', agent_name)
+        return self.agent_id
+
+    def unregister_agent(self):
+        self.agent.invoke('unregister_agent')
+
+    def insert_log_line(self, line, ltype=0):
+        if self.agent_id is None or self.agent.conn is None:
+            return
+
+        # do not wait for the log line to be inserted
+        self.agent.request('insert_log_line', line, ltype)
+
+
+class LocalClient(MessageQueue):
+    """Queue client going through the sidecar of the host (see :class:`~msgqueue.backends.local.server.Sidecar`)
+    instead of connecting to the database directly.
+
+    Requests are pipelined, many threads can have requests in flight on the same connection.
+
+    Parameters
+    ----------
+    uri: str
+        local+mongo://192.168.0.10:8123
+
+        socket: str
+            path to the Unix socket of the sidecar (default: /tmp/msgqueue-<address>-<port>.sock)
+
+        lease: float
+            time in seconds a dequeued message stays assigned to this client without its lease being extended,
+            after that the message is considered lost (default: 3 * timeout)
+            i.e local+mongo://192.168.0.10:8123?lease=300
+
+        fair: bool
+            when dequeuing without a namespace, serve the namespaces with unread messages in turn
+            instead of always popping the globally oldest message, namespaces are weighted by
+            `namespace_weights` (default: 1)
+            i.e local+mongo://192.168.0.10:8123?fair=1
+    """
+
+    def __init__(self, uri, database, name='worker', log_capture=True, timeout=60):
+        options = parse_uri(uri)
+        self.uri = uri
+        self.name = name
+        self.database = database
+        self.heartbeat_monitor = None
+        self.capture = log_capture
+        self.timeout = timeout
+        self.lease = float(options['query'].get('lease', 3 * timeout))
+        self.fair = options['query'].get('fair', '0') not in ('0', 'false')
+        self.namespace_weights = dict()
+        self.fair_schedulers = dict()
+        self.heartbeat_address = options['query'].get('heartbeat')
+
+        self.address = socket_address(uri)
+        self.conn = Client(self.address, family='AF_UNIX')
+        self.lock = threading.Lock()
+        self.requests = count()
+        self.pending = dict()
+        self._monitor = None
+
+        self.receiver = threading.Thread(target=self._receive, daemon=True)
+        self.receiver.start()
+        self.invoke('hello', self.database, self.lease, self.timeout)
+
+    def _receive(self):
+        try:
+            while True:
+                rid, ok, value = self.conn.recv()
+
+                with self.lock:
+                    reply = self.pending.pop(rid, None)
+
+                # None if the caller stopped waiting for it
+                if reply is not None:
+                    reply.set(ok, value)
+
+        except (OSError, EOFError) as e:
+            with self.lock:
+                self.conn = None
+                pending, self.pending = self.pending, dict()
+
+            for reply in pending.values():
+                reply.set(False, ConnectionError(f'sidecar `{self.address}` disconnected: {e}'))
+
+    def request(self, method, *args, **kwargs) -> _Reply:
+        """Send a request to the sidecar without waiting for its result"""
+        with self.lock:
+            if self.conn is None:
+                raise ConnectionError(f'sidecar `{self.address}` disconnected')
+
+            reply = _Reply(next(self.requests))
+            self.pending[reply.rid] = reply
+            self.conn.send((reply.rid, method, args, kwargs))
+
+        return reply
+
+    def invoke(self, method, *args, **kwargs):
+        """Send a request to the sidecar and wait at most `timeout` seconds for its result"""
+        reply = self.request(method, *args, **kwargs)
+
+        try:
+            return reply.result(self.timeout)
+        except TimeoutError:
+            with self.lock:
+                self.pending.pop(reply.rid, None)
+            raise
+
+    def pacemaker(self, wait_time, capture):
+        return LocalPacemaker(self, wait_time, capture)
+
+    def join(self):
+        return self.heartbeat_monitor.join()
+
+    def enqueue(self, queue, namespace, message, mtype=0, replying_to=None, ttl=None):
+        return self.invoke('enqueue', queue, namespace, message, mtype, replying_to, ttl)
+
+    def dequeue(self, queue, namespace, mtype=None):
+        if namespace is None and self.fair:
+            return self._dequeue_fair(queue, mtype)
+
+        return self._register_message(queue, self.invoke('dequeue', queue, namespace, mtype))
+
+    def dequeue_any(self, queues, namespace, mtype=None):
+        queue, msg = self.invoke('dequeue_any', list(queues), namespace, mtype)
+        return queue, self._register_message(queue, msg)
+
+    def active_namespaces(self, queue, mtype=None):
+        return self.invoke('active_namespaces', queue, mtype)
+
+    def get_reply(self, queue, message):
+        return self.invoke('get_reply', queue, message)
+
+    def explain_dequeue(self, queue, namespace, mtype=None):
+        return self.invoke('explain_dequeue', queue, namespace, mtype)
+
+    def mark_actioned(self, queue, uid: Message = None):
+        if isinstance(uid, Message):
+            uid = uid.uid
+
+        result = self.invoke('mark_actioned', queue, uid)
+        self._unregister_message(uid)
+        return result
+
+    def mark_actioned_all(self, queue, messages: List[Message]):
+        result = self.invoke('mark_actioned_all', queue, messages)
+
+        for msg in messages:
+            self._unregister_message(msg.uid)
+
+        return result
+
+    def reply(self, queue, namespace, work_messages: dict, work_reply, mtype=None):
+        return self.invoke('reply', queue, namespace, work_messages, work_reply, mtype)
+
+    def mark_error(self, queue, uid, error):
+        if isinstance(uid, Message):
+            uid = uid.uid
+
+        result = self.invoke('mark_error', queue, uid, error)
+        self._unregister_message(uid)
+        return result
+
+    def extend_leases(self, queue, leases):
+        default = None
+        if self.heartbeat_monitor is not None:
+            default = self.heartbeat_monitor.agent_id
+
+        leases = [(uid, agent if agent is not None else default, lease) for uid, agent, lease in leases]
+        return self.invoke('extend_leases', queue, leases)
+
+    def agent_heartbeat(self, agents):
+        return self.invoke('agent_heartbeat', list(agents))
+
+    def monitor(self):
+        if self._monitor is None:
+            self._monitor = _SidecarMonitor(self)
+
+        return self._monitor
+
+
+def new_client(*args, **kwargs):
+    return LocalClient(*args, **kwargs)
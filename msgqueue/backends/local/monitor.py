@@ -0,0 +1,7 @@
+from .util import backend_uri
+
+
+def new_monitor(uri, database, *args, **kwargs):
+    """Monitors are not on the hot path, they connect to the database directly"""
+    from msgqueue.backends import new_monitor
+    return new_monitor(backend_uri(uri), database, *args, **kwargs)
@@ -0,0 +1,338 @@
+from collections import defaultdict
+from multiprocessing.connection import Listener
+import os
+import queue as pyqueue
+import threading
+
+from msgqueue.logs import info, debug, warning
+from msgqueue.uri import parse_uri
+from msgqueue.backends.queue import QueueServer
+
+from .util import backend_uri, socket_address
+
+
+# Methods of `MessageQueue` the workers can call through the sidecar
+FORWARDED = {
+    'enqueue',
+    'dequeue',
+    'dequeue_any',
+    'active_namespaces',
+    'explain_dequeue',
+    'get_reply',
+    'mark_actioned',
+    'mark_actioned_all',
+    'mark_error',
+    'reply',
+    'extend_leases',
+    'agent_heartbeat',
+}
+
+# Methods of `QueueMonitor` the workers call in their loop, they are forwarded through the sidecar
+MONITOR = {
+    'stats',
+    'queues',
+    'quotas',
+    'requeue_failed_messages',
+    'requeue_lost_messages',
+    'purge_expired_messages',
+    'leader',
+}
+
+# Methods of `QueuePacemaker` the workers can call through the sidecar
+PACEMAKER = {
+    'register_agent',
+    'unregister_agent',
+    'insert_log_line',
+}
+
+
+class _Session:
+    """State of a worker connected to the sidecar"""
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.database = None
+        self.lease = None
+        self.timeout = 60
+        # pacemaker of the worker, it is never started it is only used to hold the agent_id
+        self.pacemaker = None
+
+    def send(self, rid, ok, result):
+        with self.lock:
+            try:
+                self.conn.send((rid, ok, result))
+            except (OSError, EOFError):
+                debug('worker disconnected before receiving its reply')
+            except Exception as e:
+                # the result could not be pickled, nothing was written to the connection
+                error = RuntimeError(f'the sidecar could not send the result: {type(e).__name__}: {e}')
+
+                try:
+                    self.conn.send((rid, False, error))
+                except (OSError, EOFError):
+                    debug('worker disconnected before receiving its reply')
+
+
+class Sidecar:
+    """Serve the `MessageQueue` API of a backend to the workers of a host through a Unix socket
+
+    All the workers of a host share a small pool of database connections.
+    Each connection is owned by a thread that takes the pending requests in batches,
+    the heartbeats of the batch are merged into a single write and its lease extensions
+    into a single write per queue.
+
+    Parameters
+    ----------
+    uri: str
+        local+mongo://192.168.0.10:8123
+
+        socket: str
+            path of the Unix socket to listen on (default: /tmp/msgqueue-<address>-<port>.sock)
+
+        pool: int
+            number of database connections per database (default: 2)
+
+    batch_size: int
+        maximum number of requests processed together
+    """
+    def __init__(self, uri, batch_size=32):
+        options = parse_uri(uri)
+        self.uri = backend_uri(uri)
+        self.address = socket_address(uri)
+        self.pool_size = int(options['query'].get('pool', 2))
+        self.batch_size = batch_size
+        self.requests = pyqueue.Queue()
+        self.stopped = threading.Event()
+        self.listener = None
+        self.threads = []
+
+    def start(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+        self.listener = Listener(self.address, family='AF_UNIX')
+        os.chmod(self.address, 0o600)
+
+        self.threads = [threading.Thread(target=self._accept, daemon=True)]
+        self.threads.extend(threading.Thread(target=self._process, daemon=True) for _ in range(self.pool_size))
+
+        for thread in self.threads:
+            thread.start()
+
+        info(f'sidecar for {self.uri} listening on {self.address}')
+
+    def stop(self):
+        self.stopped.set()
+
+        for _ in range(self.pool_size):
+            self.requests.put(None)
+
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+    def wait(self):
+        for thread in self.threads:
+            thread.join()
+
+    def _accept(self):
+        while not self.stopped.is_set():
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                break
+
+            threading.Thread(target=self._receive, args=(_Session(conn),), daemon=True).start()
+
+    def _receive(self, session):
+        try:
+            while True:
+                rid, method, args, kwargs = session.conn.recv()
+
+                if method == 'hello':
+                    session.database, session.lease, session.timeout = args
+                    session.send(rid, True, None)
+
+                elif method in FORWARDED or method in PACEMAKER or (method == 'monitor' and args[0] in MONITOR):
+                    self.requests.put((session, rid, method, args, kwargs))
+
+                else:
+                    session.send(rid, False, AttributeError(f'`{method}` is not supported by the sidecar'))
+
+        except (OSError, EOFError):
+            debug('worker disconnected')
+
+        finally:
+            session.conn.close()
+
+    def _next_batch(self):
+        request = self.requests.get()
+        if request is None:
+            return None
+
+        batch = [request]
+        while len(batch) < self.batch_size:
+            try:
+                request = self.requests.get_nowait()
+            except pyqueue.Empty:
+                break
+
+            if request is None:
+                # let the other threads see the stop request
+                self.requests.put(None)
+                break
+
+            batch.append(request)
+
+        return batch
+
+    def _process(self):
+        # database -> client, each thread owns its connections
+        clients = dict()
+
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+
+            try:
+                self._execute_batch(clients, batch)
+            except Exception as e:
+                warning(f'sidecar batch failed: {e}')
+
+    def _client(self, clients, database):
+        client = clients.get(database)
+
+        if client is None:
+            from msgqueue.backends import new_client
+            client = new_client(self.uri, database, name='sidecar', log_capture=False)
+            clients[database] = client
+
+        return client
+
+    def _execute_batch(self, clients, batch):
+        # database -> [(session, rid, agents)]
+        heartbeats = defaultdict(list)
+        # (database, queue) -> [(session, rid, leases)]
+        leases = defaultdict(list)
+
+        for session, rid, method, args, kwargs in batch:
+            if method == 'agent_heartbeat' and not kwargs:
+                heartbeats[session.database].append((session, rid, args[0]))
+
+            elif method == 'extend_leases' and not kwargs:
+                queue, group = args
+                leases[(session.database, queue)].append((session, rid, group))
+
+            else:
+                self._execute(clients, session, rid, method, args, kwargs)
+
+        for database, requests in heartbeats.items():
+            agents = [agent for _, _, group in requests for agent in group]
+            client = self._client(clients, database)
+            self._reply_all(requests, client.agent_heartbeat, agents)
+
+        for (database, queue), requests in leases.items():
+            group = [lease for _, _, group in requests for lease in group]
+            client = self._client(clients, database)
+            self._reply_all(requests, client.extend_leases, queue, group)
+
+    @staticmethod
+    def _reply_all(requests, fun, *args):
+        try:
+            ok, result = True, fun(*args)
+        except Exception as e:
+            ok, result = False, e
+
+        for session, rid, _ in requests:
+            session.send(rid, ok, result)
+
+    def _execute(self, clients, session, rid, method, args, kwargs):
+        try:
+            client = self._client(clients, session.database)
+
+            if method in PACEMAKER:
+                if session.pacemaker is None:
+                    session.pacemaker = client.pacemaker(session.timeout, False)
+
+                result = getattr(session.pacemaker, method)(*args, **kwargs)
+
+            elif method == 'monitor':
+                # the monitors of the backends share the connection of their client
+                name, *args = args
+                result = getattr(client.monitor(), name)(*args, **kwargs)
+
+            else:
+                # calls are made on behalf of the worker, the claims are recorded under its agent and lease
+                lease = client.lease
+                client.heartbeat_monitor = session.pacemaker
+                client.lease = session.lease or lease
+
+                try:
+                    result = getattr(client, method)(*args, **kwargs)
+                finally:
+                    client.heartbeat_monitor = None
+                    client.lease = lease
+
+            session.send(rid, True, result)
+
+        except Exception as e:
+            session.send(rid, False, e)
+
+
+class LocalServer(QueueServer):
+    """Start the database server of the backend with a sidecar in front of it
+
+    This is mostly useful for testing, in production the sidecar runs on each worker node
+    and connects to a remote database (see `start_server_main`)
+    """
+    def __init__(self, uri, database, location, join=None, clean_on_exit=True):
+        from msgqueue.backends import new_server
+
+        self.uri = uri
+        self.database = database
+        self.backend = new_server(backend_uri(uri), database, location, clean_on_exit, join)
+        self.sidecar = Sidecar(uri)
+
+    def start(self, wait=True):
+        self.backend.start(wait=wait)
+        self.sidecar.start()
+
+    def stop(self):
+        self.sidecar.stop()
+        self.backend.stop()
+
+    def __getattr__(self, item):
+        # expose the administration methods of the backend server i.e `upgrade_queues`
+        if item == 'backend':
+            raise AttributeError(item)
+
+        return getattr(self.backend, item)
+
+
+def new_server(uri, database, location, join=None, clean_on_exit=True):
+    return LocalServer(uri, database, location, join, clean_on_exit)
+
+
+def start_server_main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--uri', type=str, required=True, help='uri of the backend i.e local+mongo://192.168.0.10:8123')
+    parser.add_argument('--batch-size', type=int, default=32)
+    args = parser.parse_args()
+
+    sidecar = Sidecar(args.uri, args.batch_size)
+    sidecar.start()
+
+    try:
+        sidecar.wait()
+    except KeyboardInterrupt:
+        sidecar.stop()
+
+
+if __name__ == '__main__':
+    start_server_main()
@@ -0,0 +1,27 @@
+from msgqueue.uri import parse_uri
+
+
+SCHEME_PREFIX = 'local+'
+
+
+def backend_uri(uri):
+    """Return the uri of the backend the sidecar connects to i.e local+mongo://... => mongo://..."""
+    if uri.startswith(SCHEME_PREFIX):
+        return uri[len(SCHEME_PREFIX):]
+
+    return uri
+
+
+def socket_address(uri):
+    """Return the path of the Unix socket of the sidecar serving `uri`
+
+    The path can be set with the `socket` option, by default it is derived from the backend address
+    so workers and sidecar agree on it without configuration
+    """
+    options = parse_uri(uri)
+    address = options['query'].get('socket')
+
+    if address is not None:
+        return address
+
+    return f'/tmp/msgqueue-{options.get("address")}-{options.get("port")}.sock'
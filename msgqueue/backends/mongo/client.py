@@ -1,13 +1,15 @@
+from collections import Counter, defaultdict
 import datetime
+import random
 from typing import List
 
 import pymongo
 
 from msgqueue.logs import warning
 from msgqueue.uri import parse_uri
-from msgqueue.backends.queue import Message, MessageQueue, QueuePacemaker, Reply
+from msgqueue.backends.queue import Message, MessageQueue, QueuePacemaker, Reply, ENQUEUED, CLAIMED, ACTIONED, FAILED
 
-from .util import _parse
+from .util import _parse, _quota_id, _counter_id
 from .server import new_queue
 
 
@@ -27,48 +29,6 @@ class MongoQueuePacemaker(QueuePacemaker):
         }).inserted_id
         return self.agent_id
 
-    def update_heartbeat(self):
-        if self.message is not None:
-            self.client[self.name].update_one({
-                '_id': self.message.uid
-            }, {
-                '$set': {
-                    'heartbeat': datetime.datetime.utcnow()
-                }
-            })
-
-    def register_message(self, name, message: Message):
-        if message is None:
-            return None
-
-        self.client.system.update_one(
-            {'_id': self.agent_id},
-            {
-                '$set': {
-                    'message': message.uid,
-                    'namespace': message.namespace,
-                    'heartbeat': datetime.datetime.utcnow()
-                }
-            }
-        )
-
-        self.name = name
-        self.message = message
-        self.update_heartbeat()
-
-        return message
-
-    def unregister_message(self, uid=None):
-        self.client.system.update_one(
-            {'_id': self.agent_id},
-            {
-                '$set': {
-                    'message': None,
-                    'heartbeat': datetime.datetime.utcnow()
-                }
-            }
-        )
-
     def unregister_agent(self):
         self.client.system.update_one({'_id': self.agent_id}, {
             '$set': {'alive': False}
@@ -92,6 +52,35 @@ class MongoClient(MessageQueue):
     ----------
     uri: str
         mongo://192.168.0.10:8123
+
+        window: int
+            number of the oldest messages a message is randomly claimed from (default: 1, strict FIFO).
+            Larger windows reduce contention when many workers dequeue from the same queue
+            i.e mongo://192.168.0.10:8123?window=16
+
+        lease: float
+            time in seconds a dequeued message stays assigned to this client without its lease being extended,
+            after that the message is considered lost (default: 3 * timeout)
+            i.e mongo://192.168.0.10:8123?lease=300
+
+        fair: bool
+            when dequeuing without a namespace, serve the namespaces with unread messages in turn
+            instead of always popping the globally oldest message, namespaces are weighted by
+            `namespace_weights` (default: 1)
+            i.e mongo://192.168.0.10:8123?fair=1
+
+        heartbeat: str
+            path to the Unix socket of the node level heartbeat agent (see :mod:`msgqueue.heartbeat`),
+            when set the agent sends the heartbeats of this client in bulk with the other local workers
+            i.e mongo://192.168.0.10:8123?heartbeat=/tmp/msgqueue-heartbeat.sock
+
+        counters: bool
+            maintain the number of messages in each state in the counters collection after each enqueue,
+            dequeue, ack and error so the monitor can read them without scanning the queue.
+            The counters are updated right after the message, not atomically with it,
+            :meth:`~msgqueue.backends.mongo.monitor.MongoQueueMonitor.reconcile_counters` corrects their drift.
+            All the clients writing to the queue need to enable it (default: 0)
+            i.e mongo://192.168.0.10:8123?counters=1
     """
 
     def __init__(self, uri, database, name='worker', log_capture=True, timeout=60):
@@ -109,6 +98,14 @@ class MongoClient(MessageQueue):
         self.timeout = timeout
         self.database = database
         self.db = self.client[self.database]
+        self.dequeue_window = int(uri['query'].get('window', 1))
+        self.lease = float(uri['query'].get('lease', 3 * timeout))
+        self.fair = uri['query'].get('fair', '0') not in ('0', 'false')
+        self.namespace_weights = dict()
+        self.fair_schedulers = dict()
+        self.quota_cache = dict()
+        self.counters = uri['query'].get('counters', '0') not in ('0', 'false')
+        self.heartbeat_address = uri['query'].get('heartbeat')
 
     def join(self):
         return self.heartbeat_monitor.join()
@@ -119,14 +116,19 @@ class MongoClient(MessageQueue):
     def _queue_exist(self, queue):
         return queue in self.monitor().queues()
 
-    def enqueue(self, queue, namespace, message, mtype=0, replying_to=None):
+    def enqueue(self, queue, namespace, message, mtype=0, replying_to=None, ttl=None):
         """See `~mlbaselines.distributed.queue.MessageQueue`"""
         if not self._queue_exist(queue):
             new_queue(self.db, namespace, queue)
 
+        now = datetime.datetime.utcnow()
+        expire_time = None
+        if ttl is not None:
+            expire_time = now + datetime.timedelta(seconds=ttl)
+
         message = {
             'namespace': namespace,
-            'time': datetime.datetime.utcnow(),
+            'time': now,
             'mtype': mtype,
             'read': False,
             'read_time': None,
@@ -135,15 +137,63 @@ class MongoClient(MessageQueue):
             'replying_to': replying_to,
             'message': message,
             'retry': 0,
-            'error': None
+            'error': None,
+            'expire_time': expire_time
         }
 
-        return self.db[queue].insert_one(message).inserted_id
+        uid = self.db[queue].insert_one(message).inserted_id
+        self._count(queue, [(namespace, mtype)], ENQUEUED)
+        return uid
 
-    def dequeue(self, queue, namespace, mtype=None):
-        """See `~mlbaselines.distributed.queue.MessageQueue`"""
+    def _count(self, queue, messages, transitions):
+        """Apply the `transitions` of the counters for each (namespace, mtype) of `messages`"""
+        if not self.counters or not messages:
+            return
+
+        changes = defaultdict(int)
+        for namespace, mtype in messages:
+            for state, delta in transitions:
+                changes[(namespace, mtype, state)] += delta
+
+        self.db.counters.bulk_write([
+            pymongo.UpdateOne(
+                {'_id': _counter_id(queue, namespace, mtype, state)},
+                {
+                    '$setOnInsert': {'queue': queue, 'namespace': namespace, 'mtype': mtype, 'state': state},
+                    '$inc': {'count': delta}
+                },
+                upsert=True)
+            for (namespace, mtype, state), delta in changes.items()
+        ], ordered=False)
+
+    def _update_message(self, queue, uid, guard, update, transitions):
+        """Update a message and its counters, the update is conditional on `guard`
+        so a message changing state twice is only counted once.
+        Return the message as it was before the update or None if `guard` did not match,
+        the message is only returned when the queue has counters or quotas"""
+        if not self.counters and not self._has_quotas(queue):
+            self.db[queue].update_one({'_id': uid}, update)
+            return None
+
+        msg = self._guarded_update(queue, uid, guard, update)
+
+        if msg is not None:
+            self._count(queue, [(msg['namespace'], msg.get('mtype'))], transitions)
+
+        return msg
+
+    def _guarded_update(self, queue, uid, guard, update):
+        return self.db[queue].find_one_and_update(
+            {'_id': uid, **guard}, update, projection={'namespace': True, 'mtype': True, 'error': True})
+
+    @staticmethod
+    def _dequeue_query(namespace, mtype=None):
         query = {
             'read': False,
+            '$or': [
+                {'expire_time': None},
+                {'expire_time': {'$gt': datetime.datetime.utcnow()}}
+            ]
         }
 
         if namespace is not None:
@@ -155,35 +205,167 @@ class MongoClient(MessageQueue):
         elif isinstance(mtype, int):
             query['mtype'] = mtype
 
-        msg = self.db[queue].find_one_and_update(
-            query, {
-                '$set': {
-                    'read': True, 'read_time': datetime.datetime.utcnow()}
-            },
-            sort=[
-                ('time', pymongo.ASCENDING),
-            ],
-            return_document=pymongo.ReturnDocument.AFTER
-        )
+        return query
+
+    def _claim(self):
+        """Update claiming a message, it records who is processing the message and for how long
+        so no other write is necessary.
+
+        Times are set by the server to not be subject to clock skew between clients
+        """
+        agent = None
+        if self.heartbeat_monitor is not None:
+            agent = self.heartbeat_monitor.agent_id
+
+        return [{
+            '$set': {
+                'read': True,
+                'read_time': '$$NOW',
+                'heartbeat': '$$NOW',
+                'agent': {'$literal': agent},
+                'lease_until': {'$add': ['$$NOW', int(self.lease * 1000)]}
+            }
+        }]
+
+    def dequeue(self, queue, namespace, mtype=None):
+        """See `~mlbaselines.distributed.queue.MessageQueue`"""
+        if namespace is None and self.fair:
+            return self._dequeue_fair(queue, mtype)
+
+        query = self._dequeue_query(namespace, mtype)
+
+        quotas = None
+        if self._has_quotas(queue):
+            quotas = self._quota_documents(queue)
+            full = [q['namespace'] for q in quotas.values() if q['inflight'] >= q['max_inflight']]
+
+            if '' in full or (namespace is not None and namespace in full):
+                return None
+
+            if namespace is None and full:
+                query['namespace'] = {'$nin': full}
+
+        if self.dequeue_window > 1:
+            msg = self._dequeue_window(queue, query)
+        else:
+            msg = self.db[queue].find_one_and_update(
+                query, self._claim(),
+                sort=[
+                    ('time', pymongo.ASCENDING),
+                ],
+                return_document=pymongo.ReturnDocument.AFTER
+            )
+
+        if msg is not None and quotas is not None and not self._reserve_quota(queue, quotas, msg['namespace']):
+            # another worker took the last slot between our read of the quotas and our claim
+            self._unclaim(queue, msg['_id'])
+            msg = None
+
+        if msg is not None:
+            self._count(queue, [(msg['namespace'], msg['mtype'])], CLAIMED)
+
         return self._register_message(queue, _parse(msg))
 
+    def _quota_documents(self, queue):
+        return {q['_id']: q for q in self.db.quotas.find({'queue': queue})}
+
+    def _reserve_quota(self, queue, quotas, namespace):
+        """Count the claimed message against its quotas, the increment is conditional on the quota not being full
+        so concurrent workers cannot go over it"""
+        reserved = []
+
+        for uid in (_quota_id(queue, namespace), _quota_id(queue)):
+            if uid not in quotas:
+                continue
+
+            rc = self.db.quotas.update_one(
+                {'_id': uid, '$expr': {'$lt': ['$inflight', '$max_inflight']}},
+                {'$inc': {'inflight': 1}})
+
+            if rc.modified_count == 0:
+                for reserved_uid in reserved:
+                    self.db.quotas.update_one({'_id': reserved_uid}, {'$inc': {'inflight': -1}})
+                return False
+
+            reserved.append(uid)
+
+        return True
+
+    def _release_quota(self, queue, namespaces):
+        """Free the quota slots of the messages that are done being processed"""
+        counts = Counter(_quota_id(queue, namespace) for namespace in namespaces if namespace)
+        counts[_quota_id(queue)] += len(namespaces)
+
+        for uid, count in counts.items():
+            self.db.quotas.update_one({'_id': uid}, [{
+                '$set': {'inflight': {'$max': [0, {'$subtract': ['$inflight', count]}]}}
+            }])
+
+    def _unclaim(self, queue, uid):
+        self.db[queue].update_one({'_id': uid}, {
+            '$set': {
+                'read': False,
+                'read_time': None,
+                'heartbeat': None,
+                'agent': None,
+                'lease_until': None
+            }
+        })
+
+    def _dequeue_window(self, queue, query, attempts=3):
+        """Claim a random message among the oldest unread messages
+
+        All the workers are not competing for the same document anymore.
+        The claim is conditional on the message still being unread so a message
+        cannot be claimed twice, if all the candidates were claimed by other workers
+        we fetch a new set of candidates.
+        """
+        for _ in range(attempts):
+            candidates = [m['_id'] for m in self.db[queue].find(
+                query, projection={'_id': True},
+                sort=[('time', pymongo.ASCENDING)],
+                limit=self.dequeue_window)]
+
+            if not candidates:
+                return None
+
+            random.shuffle(candidates)
+            for uid in candidates:
+                msg = self.db[queue].find_one_and_update(
+                    {'_id': uid, 'read': False}, self._claim(),
+                    return_document=pymongo.ReturnDocument.AFTER
+                )
+
+                if msg is not None:
+                    return msg
+
+        return None
+
+    def explain_dequeue(self, queue, namespace, mtype=None):
+        """Return the query plan used by `dequeue`"""
+        cursor = self.db[queue].find(self._dequeue_query(namespace, mtype))
+        return cursor.sort('time', pymongo.ASCENDING).limit(1).explain()
+
     def mark_actioned(self, queue, uid: Message = None):
         """See `~mlbaselines.distributed.queue.MessageQueue`"""
         if isinstance(uid, Message):
             uid = uid.uid
 
-        self.db[queue].find_one_and_update({
-            '_id': uid}, {
+        msg = self._update_message(queue, uid, {'actioned': False}, {
             '$set': {
                 'actioned': True,
                 'actioned_time': datetime.datetime.utcnow()}
-        }
-        )
+        }, ACTIONED)
+
+        # failed messages released their quota slot already
+        if msg is not None and msg.get('error') is None and self._has_quotas(queue):
+            self._release_quota(queue, [msg['namespace']])
+
         self._unregister_message(uid)
         return uid
 
     def _rollback_actioned_all(self, queue, messages):
-        self.db[queue].find_and_modify({
+        self.db[queue].update_many({
             '_id': {
                 '$in': list(map(lambda m: m.uid, messages))
             }}, {
@@ -209,33 +391,86 @@ class MongoClient(MessageQueue):
 
     def mark_actioned_all(self, queue, messages: List[Message]):
         """See `~mlbaselines.distributed.queue.MessageQueue`"""
-        self.db[queue].find_and_modify({
-            '_id': {
-                '$in': list(map(lambda m: m.uid, messages))
-            }}, {
-            '$set': {
-                'actioned': True,
-                'actioned_time': datetime.datetime.utcnow()}
-            }
-        )
-        self._unregister_message(messages[-1].uid)
+        if self.counters or self._has_quotas(queue):
+            # a message is only counted and releases its quota slot in the ack that changed it
+            acked = [self._guarded_update(queue, m.uid, {'actioned': False}, {
+                '$set': {
+                    'actioned': True,
+                    'actioned_time': datetime.datetime.utcnow()}
+            }) for m in messages]
+            acked = [m for m in acked if m is not None]
+
+            self._count(queue, [(m['namespace'], m.get('mtype')) for m in acked], ACTIONED)
+
+            if self._has_quotas(queue):
+                self._release_quota(queue, [m['namespace'] for m in acked if m.get('error') is None])
+        else:
+            self.db[queue].update_many({
+                '_id': {
+                    '$in': list(map(lambda m: m.uid, messages))
+                },
+                'actioned': False}, {
+                '$set': {
+                    'actioned': True,
+                    'actioned_time': datetime.datetime.utcnow()}
+                }
+            )
+
+        for msg in messages:
+            self._unregister_message(msg.uid)
 
     def mark_error(self, queue, uid, error):
         if isinstance(uid, Message):
             uid = uid.uid
 
-        self.db[queue].find_one_and_update({
-            '_id': uid}, {
-                '$set': {
-                    'error': error}
-            }
-        )
+        msg = self._update_message(queue, uid, {'error': None, 'actioned': False}, {
+            '$set': {
+                'error': error}
+        }, FAILED)
+
+        if msg is not None and self._has_quotas(queue):
+            self._release_quota(queue, [msg['namespace']])
+
         self._unregister_message(uid)
         return uid
 
+    def get_reply(self, queue, message):
+        """See `~mlbaselines.distributed.queue.MessageQueue`"""
+        if not isinstance(message, (list, tuple, set)):
+            return _parse(self.db[queue].find_one({'replying_to': message}))
+
+        replies = self.db[queue].find({'replying_to': {'$in': list(message)}})
+        return {reply['replying_to']: _parse(reply) for reply in replies}
+
+    def extend_leases(self, queue, leases):
+        """See `~mlbaselines.distributed.queue.MessageQueue`"""
+        if not leases:
+            return
+
+        default = None
+        if self.heartbeat_monitor is not None:
+            default = self.heartbeat_monitor.agent_id
+
+        self.db[queue].bulk_write([
+            pymongo.UpdateOne(
+                {'_id': uid, 'actioned': False, 'agent': agent if agent is not None else default},
+                [{'$set': {'lease_until': {'$add': ['$$NOW', int(lease * 1000)]}}}])
+            for uid, agent, lease in leases
+        ], ordered=False)
+
+    def agent_heartbeat(self, agents):
+        """See `~mlbaselines.distributed.queue.MessageQueue`"""
+        if not agents:
+            return
+
+        self.db.system.update_many(
+            {'_id': {'$in': list(agents)}},
+            [{'$set': {'heartbeat': '$$NOW'}}]
+        )
+
     def monitor(self):
         from .monitor import MongoQueueMonitor
-        return MongoQueueMonitor(uri=None, database=self.database, cursor=self.client)
+        return MongoQueueMonitor(uri=None, database=self.database, cursor=self.client, counters=self.counters)
 
     def aggregate_monitor(self):
         from .aggregate_monitor import AggregateMonitor
@@ -4,9 +4,10 @@ from bson.objectid import ObjectId
 from threading import RLock
 
 from msgqueue.uri import parse_uri
-from msgqueue.backends.queue import QueueMonitor, Agent, to_dict
+from msgqueue.backends.queue import QueueMonitor, Agent, WaitingTime, QuotaUsage, QueueStats, COUNTER_STATES, to_dict
+from msgqueue.backends.queue import ApproximateCount, sampled_count, REQUEUED, REQUEUED_FAILED
 
-from .util import _parse, _parse_agent
+from .util import _parse, _parse_agent, _quota_id, _inflight_query, _counter_id
 
 
 def mongo_to_dict(a):
@@ -17,11 +18,16 @@ def mongo_to_dict(a):
 
 
 class MongoQueueMonitor(QueueMonitor):
-    def __init__(self, uri, database, cursor=None):
+    def __init__(self, uri, database, cursor=None, counters=False):
         # When using this inside a dashbord it is executed in a multi threaded environment
         # You need to lock the cursor to not get some errors
         self.lock = RLock()
         self.uri = uri
+        # read the counts from the counters collection (see `MongoClient`)
+        self.use_counters = counters
+
+        if uri is not None:
+            self.use_counters = parse_uri(uri)['query'].get('counters', '0') not in ('0', 'false')
 
         if cursor is None:
             mongodb_uri = uri.replace('mongo', 'mongodb')
@@ -94,6 +100,23 @@ class MongoQueueMonitor(QueueMonitor):
             else:
                 self.db[name].drop()
 
+            self._clear_counters(name, namespace)
+
+    def messages_by_uid(self, name, uids):
+        with self.lock:
+            return [_parse(msg) for msg in self.db[name].find({'_id': {'$in': list(uids)}})]
+
+    def changed_messages(self, name, since):
+        with self.lock:
+            query = {
+                '$or': [
+                    {'read_time': {'$gt': since}},
+                    {'actioned_time': {'$gt': since}},
+                ]
+            }
+
+            return [_parse(msg) for msg in self.db[name].find(query)]
+
     def unread_messages(self, name, namespace, mtype=None):
         with self.lock:
             query = {
@@ -132,51 +155,138 @@ class MongoQueueMonitor(QueueMonitor):
                 query[name] = value
         return query
 
-    def unread_count(self, name, namespace, mtype=None):
-        with self.lock:
-            query = {
-                'read': False
-            }
+    def _clear_counters(self, queue, namespace):
+        """Remove the counters of the messages that were deleted
 
-            self.add_filter(query, 'namespace', namespace)
-            self.add_filter(query, 'mtype', mtype)
-            return self.db[name].count(query)
+        The counters of the messages the monitor purges or resets are corrected by the next
+        `reconcile_counters`, done by the :class:`~msgqueue.reaper.Reaper` after each sweep
+        """
+        if self.use_counters:
+            self.db.counters.delete_many(self.add_filter({'queue': queue}, 'namespace', namespace))
+
+    def counters(self, queue, namespace=None, mtype=None):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        query = {'queue': queue}
+        self.add_filter(query, 'namespace', namespace)
+        self.add_filter(query, 'mtype', mtype)
 
-    def unactioned_count(self, name, namespace, mtype=None):
+        counts = {state: 0 for state in COUNTER_STATES}
         with self.lock:
-            query = {
-                'read': True,
-                'actioned': False,
-            }
+            for counter in self.db.counters.find(query):
+                counts[counter['state']] += counter['count']
 
-            self.add_filter(query, 'namespace', namespace)
-            self.add_filter(query, 'mtype', mtype)
-            return self.db[name].count(query)
+        return counts
 
-    def read_count(self, name, namespace, mtype=None):
-        with self.lock:
-            query = {
-                'read': True
-            }
+    def reconcile_counters(self, queue):
+        """See `~msgqueue.backends.queue.QueueMonitor`
 
-            self.add_filter(query, 'namespace', namespace)
-            self.add_filter(query, 'mtype', mtype)
-            return self.db[name].count(query)
+        The clients update the counters in a separate write after changing the message,
+        a client that dies in between, the resets of the monitor or the TTL index removing expired messages
+        make the counters drift
+        """
+        def count_if(*conditions):
+            return {'$sum': {'$cond': [{'$and': list(conditions)}, 1, 0]}}
+
+        read = {'$eq': ['$read', True]}
+        unactioned = {'$eq': ['$actioned', False]}
+
+        pipeline = [{'$group': {
+            '_id': {'namespace': '$namespace', 'mtype': '$mtype'},
+            'unread': count_if({'$eq': ['$read', False]}),
+            'unactioned': count_if(read, unactioned),
+            'actioned': count_if({'$eq': ['$actioned', True]}),
+            'failed': count_if(read, unactioned, {'$ne': [{'$ifNull': ['$error', None]}, None]}),
+        }}]
 
-    def actioned_count(self, name, namespace, mtype=None):
         with self.lock:
-            query = {
-                'read': True,
-                'actioned': True,
-            }
+            updates = []
+            ids = []
+            for row in self.db[queue].aggregate(pipeline):
+                namespace, mtype = row['_id'].get('namespace'), row['_id'].get('mtype')
+
+                for state in COUNTER_STATES:
+                    ids.append(_counter_id(queue, namespace, mtype, state))
+                    updates.append(pymongo.UpdateOne(
+                        {'_id': ids[-1]},
+                        {
+                            '$setOnInsert': {'queue': queue, 'namespace': namespace, 'mtype': mtype, 'state': state},
+                            '$set': {'count': row[state]}
+                        },
+                        upsert=True))
+
+            # the counters are overwritten in place so readers never see them missing
+            if updates:
+                self.db.counters.bulk_write(updates, ordered=False)
+
+            # no message left for these namespaces and types
+            self.db.counters.update_many(
+                {'queue': queue, '_id': {'$nin': ids}},
+                {'$set': {'count': 0}})
+
+    def _count(self, name, query, approximate=False):
+        """Count the messages matching `query`, estimate it from a sample if `approximate`"""
+        with self.lock:
+            if approximate:
+                # read from the collection metadata, it does not scan the collection
+                total = self.db[name].estimated_document_count()
+
+                if total > self.sample_size:
+                    result = list(self.db[name].aggregate([
+                        {'$sample': {'size': self.sample_size}},
+                        {'$facet': {
+                            'sampled': [{'$count': 'count'}],
+                            'matched': [{'$match': query}, {'$count': 'count'}]
+                        }}
+                    ]))[0]
+
+                    # $count does not output anything when there is nothing to count
+                    sampled = result['sampled'][0]['count'] if result['sampled'] else 0
+                    matched = result['matched'][0]['count'] if result['matched'] else 0
+
+                    if sampled > 0:
+                        return sampled_count(total, sampled, matched)
+
+            count = self.db[name].count_documents(query)
+            return ApproximateCount(count) if approximate else count
+
+    def _state_query(self, namespace, mtype, **state):
+        query = dict(state)
+        self.add_filter(query, 'namespace', namespace)
+        self.add_filter(query, 'mtype', mtype)
+        return query
 
-            self.add_filter(query, 'namespace', namespace)
-            self.add_filter(query, 'mtype', mtype)
-            return self.db[name].count(query)
+    def unread_count(self, name, namespace, mtype=None, approximate=False):
+        if self.use_counters:
+            count = self.counters(name, namespace, mtype)['unread']
+            return ApproximateCount(count) if approximate else count
+
+        return self._count(name, self._state_query(namespace, mtype, read=False), approximate)
+
+    def unactioned_count(self, name, namespace, mtype=None, approximate=False):
+        if self.use_counters:
+            count = self.counters(name, namespace, mtype)['unactioned']
+            return ApproximateCount(count) if approximate else count
+
+        return self._count(name, self._state_query(namespace, mtype, read=True, actioned=False), approximate)
+
+    def read_count(self, name, namespace, mtype=None, approximate=False):
+        if self.use_counters:
+            counts = self.counters(name, namespace, mtype)
+            count = counts['unactioned'] + counts['actioned']
+            return ApproximateCount(count) if approximate else count
+
+        return self._count(name, self._state_query(namespace, mtype, read=True), approximate)
+
+    def actioned_count(self, name, namespace, mtype=None, approximate=False):
+        if self.use_counters:
+            count = self.counters(name, namespace, mtype)['actioned']
+            return ApproximateCount(count) if approximate else count
+
+        return self._count(name, self._state_query(namespace, mtype, read=True, actioned=True), approximate)
 
     def agent_count(self):
         with self.lock:
-            return self.db.system.count()
+            return self.db.system.count_documents({})
 
     def reset_queue(self, name, namespace):
         with self.lock:
@@ -190,26 +300,71 @@ class MongoQueueMonitor(QueueMonitor):
                 query,
                 {'$set': {
                     'read': False,
-                    'read_time': None
+                    'read_time': None,
+                    'agent': None,
+                    'lease_until': None
                 }}
             )
 
+            if rc.modified_count:
+                self.reconcile_quotas(name)
+
     def dump(self, name, namespace):
         rows = self.db[name].find({'namespace': namespace})
         for row in rows:
             print(_parse(row))
 
+    def _claims(self, namespace):
+        """Return the message each agent is processing, the claims are recorded on the message documents"""
+        claims = dict()
+        query = {
+            'read': True,
+            'actioned': False,
+            'agent': {'$ne': None}
+        }
+        self.add_filter(query, 'namespace', namespace)
+
+        for queue in self.queues():
+            for msg in self.db[queue].find(query, projection={'agent': True, 'namespace': True}):
+                claims[msg['agent']] = (queue, msg['_id'], msg.get('namespace'))
+
+        return claims
+
+    def _agents(self, namespace, query):
+        """Return the agents matching `query`, with a namespace only the agents processing a message of the namespace"""
+        with self.lock:
+            claims = self._claims(namespace)
+
+            if namespace is not None:
+                query['_id'] = {'$in': list(claims)}
+
+            agents = [_parse_agent(agent) for agent in self.db.system.find(query)]
+
+            for agent in agents:
+                if agent.uid in claims:
+                    agent.queue, agent.message, agent.namespace = claims[agent.uid]
+
+            return agents
+
     def agents(self, namespace):
+        return self._agents(namespace, dict())
+
+    def agent_messages(self, queue, agent=None):
+        if isinstance(agent, Agent):
+            agent = agent.uid
+
         with self.lock:
-            query = {}
-            self.add_filter(query, 'namespace', namespace)
+            query = {
+                'read': True,
+                'actioned': False,
+                'agent': {'$ne': None}
+            }
+            self.add_filter(query, 'agent', agent)
 
-            agents = self.db.system.find(query)
-            return [_parse_agent(agent) for agent in agents]
+            return [_parse(m) for m in self.db[queue].find(query)]
 
     def dead_agents(self, namespace, timeout_s=120):
-        agents = self.db.system.find({
-            'namespace': namespace,
+        return self._agents(namespace, {
             'heartbeat': {
                 '$lt': datetime.datetime.utcnow() - datetime.timedelta(seconds=timeout_s)
             },
@@ -218,14 +373,16 @@ class MongoQueueMonitor(QueueMonitor):
             }
         })
 
-        return [_parse_agent(agent) for agent in agents]
+    def server_time(self):
+        """Return the current time of the database server"""
+        return self.client.admin.command('isMaster')['localTime']
 
-    def _lost_query(self, namespace, timeout_s=60):
+    def _lost_query(self, namespace):
         query = {
             'read': True,
             'actioned': False,
-            'heartbeat': {
-                '$lt': datetime.datetime.utcnow() - datetime.timedelta(seconds=timeout_s)
+            'lease_until': {
+                '$lt': self.server_time()
             }
         }
 
@@ -233,25 +390,80 @@ class MongoQueueMonitor(QueueMonitor):
         return query
 
     def lost_messages(self, queue, namespace, timeout_s=120):
-        lost = self.db[queue].find(self._lost_query(namespace, timeout_s))
-        return [_parse(msg) for msg in lost]
+        """Return the messages whose lease expired before they were actioned
 
-    def requeue_lost_messages(self, queue, namespace, timeout_s=60, max_retry=3):
-        query = self._lost_query(namespace, timeout_s)
-        query['retry'] = {
-            '$lt': max_retry
+        `timeout_s` is deprecated and ignored, the lease duration is set by the client that dequeued the message
+        """
+        with self.lock:
+            lost = self.db[queue].find(self._lost_query(namespace))
+            return [_parse(msg) for msg in lost]
+
+    _requeue_update = {
+        '$set': {
+            'read': False,
+            'read_time': None,
+            'error': None,
+            'agent': None,
+            'lease_until': None,
+        },
+        '$inc': {
+            'retry': 1
         }
+    }
 
-        self.db[queue].update_many(query, {
-            '$set': {
-                'read': False,
-                'read_time': None,
-                'error': None,
-            },
-            '$inc': {
-                'retry': 1
+    def _requeue(self, queue, query, transitions):
+        """Requeue the messages matching `query`, returns the number of messages requeued
+
+        With counters the messages are requeued one namespace and mtype at a time,
+        the counters are moved by the number of messages each update changed
+        """
+        if not self.use_counters:
+            return self.db[queue].update_many(query, self._requeue_update).modified_count
+
+        groups = list(self.db[queue].aggregate([
+            {'$match': query},
+            {'$group': {'_id': {'namespace': '$namespace', 'mtype': '$mtype'}}}
+        ]))
+
+        requeued = 0
+        for group in groups:
+            namespace, mtype = group['_id'].get('namespace'), group['_id'].get('mtype')
+
+            modified = self.db[queue].update_many(
+                {**query, 'namespace': namespace, 'mtype': mtype}, self._requeue_update).modified_count
+
+            if modified:
+                self.db.counters.bulk_write([
+                    pymongo.UpdateOne(
+                        {'_id': _counter_id(queue, namespace, mtype, state)},
+                        {
+                            '$setOnInsert': {'queue': queue, 'namespace': namespace, 'mtype': mtype, 'state': state},
+                            '$inc': {'count': delta * modified}
+                        },
+                        upsert=True)
+                    for state, delta in transitions
+                ], ordered=False)
+
+            requeued += modified
+
+        return requeued
+
+    def requeue_lost_messages(self, queue, namespace, timeout_s=60, max_retry=3):
+        """Requeue the messages whose lease expired, `timeout_s` is deprecated and ignored"""
+        with self.lock:
+            query = self._lost_query(namespace)
+            query['retry'] = {
+                '$lt': max_retry
             }
-        })
+
+            # the failed messages leave the failed counter as well
+            requeued = self._requeue(queue, {**query, 'error': None}, REQUEUED)
+            requeued += self._requeue(queue, {**query, 'error': {'$ne': None}}, REQUEUED_FAILED)
+
+            if requeued:
+                self.reconcile_quotas(queue)
+
+            return requeued
 
     def _failed_query(self, namespace):
         query = {
@@ -273,17 +485,209 @@ class MongoQueueMonitor(QueueMonitor):
             '$lt': max_retry
         }
 
-        result = self.db[queue].update_many(query, {
-            '$set': {
-                'read': False,
-                'read_time': None,
-                'error': None,
-            },
-            '$inc': {
-                'retry': 1
+        with self.lock:
+            return self._requeue(queue, query, REQUEUED_FAILED)
+
+    def _expired_query(self, namespace, mtype=None):
+        query = {
+            'read': False,
+            'expire_time': {
+                '$lte': datetime.datetime.utcnow()
             }
-        })
-        return result.modified_count
+        }
+
+        self.add_filter(query, 'namespace', namespace)
+        self.add_filter(query, 'mtype', mtype)
+        return query
+
+    def expired_messages(self, queue, namespace, mtype=None):
+        with self.lock:
+            expired = self.db[queue].find(self._expired_query(namespace, mtype))
+            return [_parse(m) for m in expired]
+
+    def expired_count(self, queue, namespace, mtype=None, approximate=False):
+        return self._count(queue, self._expired_query(namespace, mtype), approximate)
+
+    def purge_expired_messages(self, queue, namespace, batch_size=1000):
+        # The TTL index removes expired messages on its own
+        # this is only useful to force the removal right away
+        query = self._expired_query(namespace)
+
+        # delete in small batches so a large backlog does not turn into one long delete
+        removed = 0
+        while True:
+            with self.lock:
+                uids = [m['_id'] for m in self.db[queue].find(query, projection={'_id': True}, limit=int(batch_size))]
+
+                if uids:
+                    # the query is repeated in case the message was read since
+                    removed += self.db[queue].delete_many({**query, '_id': {'$in': uids}}).deleted_count
+
+            if len(uids) < batch_size:
+                return removed
+
+    def active_namespaces(self, queue, mtype=None):
+        """Return the namespaces that have unread messages, it is answered from the dequeue index"""
+        with self.lock:
+            query = {'read': False}
+            self.add_filter(query, 'mtype', mtype)
+            return list(self.db[queue].distinct('namespace', query))
+
+    def stats(self, queues=None, namespaces=None):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        if queues is None:
+            queues = self.queues()
+
+        def count_if(*conditions):
+            return {'$sum': {'$cond': [{'$and': list(conditions)}, 1, 0]}}
+
+        unread = {'$eq': ['$read', False]}
+        read = {'$eq': ['$read', True]}
+        unactioned = {'$eq': ['$actioned', False]}
+        failed = {'$ne': [{'$ifNull': ['$error', None]}, None]}
+        lost = {'$lt': [{'$ifNull': ['$lease_until', '$$NOW']}, '$$NOW']}
+
+        query = self.add_filter(dict(), 'namespace', list(namespaces) if namespaces is not None else None)
+        pipeline = [
+            {'$match': query},
+            {'$group': {
+                '_id': '$namespace',
+                'unread': count_if(unread),
+                'read': count_if(read),
+                'unactioned': count_if(read, unactioned),
+                'actioned': count_if({'$eq': ['$actioned', True]}),
+                'failed': count_if(read, unactioned, failed),
+                'lost': count_if(read, unactioned, lost),
+                'oldest': {'$min': {'$cond': [unread, '$time', None]}},
+            }},
+            {'$addFields': {
+                'oldest_unread': {'$cond': [
+                    {'$eq': [{'$ifNull': ['$oldest', None]}, None]}, 0,
+                    {'$divide': [{'$subtract': ['$$NOW', '$oldest']}, 1000]}]}
+            }},
+        ]
+
+        stats = []
+        with self.lock:
+            for queue in queues:
+                for row in self.db[queue].aggregate(pipeline):
+                    stats.append(QueueStats(
+                        queue, row['_id'], row['unread'], row['read'], row['unactioned'], row['actioned'],
+                        row['failed'], row['lost'], float(row['oldest_unread'])))
+
+        return stats
+
+    def waiting_times(self, queue, namespace=None):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        with self.lock:
+            query = {'read': True}
+            self.add_filter(query, 'namespace', namespace)
+
+            wait = {'$subtract': ['$read_time', '$time']}
+            rows = self.db[queue].aggregate([
+                {'$match': query},
+                {'$group': {
+                    '_id': '$namespace',
+                    'count': {'$sum': 1},
+                    'mean': {'$avg': wait},
+                    'max': {'$max': wait}
+                }}
+            ])
+
+            stats = {
+                r['_id']: WaitingTime(r['count'], (r['mean'] or 0) / 1000, (r['max'] or 0) / 1000) for r in rows}
+
+            query['read'] = False
+            rows = self.db[queue].aggregate([
+                {'$match': query},
+                {'$group': {'_id': '$namespace', 'oldest': {'$min': '$time'}}}
+            ])
+
+            now = self.server_time().replace(tzinfo=None)
+            for r in rows:
+                stats.setdefault(r['_id'], WaitingTime(0, 0, 0)).oldest = (now - r['oldest']).total_seconds()
+
+            return stats
+
+    def set_quota(self, queue, namespace=None, max_inflight=None):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        with self.lock:
+            uid = _quota_id(queue, namespace)
+
+            if max_inflight is None:
+                self.db.quotas.delete_one({'_id': uid})
+                return
+
+            self.db.quotas.update_one({'_id': uid}, {
+                '$set': {
+                    'queue': queue,
+                    'namespace': namespace or '',
+                    'max_inflight': int(max_inflight)
+                },
+                '$setOnInsert': {
+                    'inflight': self.db[queue].count_documents(_inflight_query(namespace))
+                }
+            }, upsert=True)
+
+    def quotas(self, queue):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        with self.lock:
+            return {q['namespace'] or None: q['max_inflight'] for q in self.db.quotas.find({'queue': queue})}
+
+    def quota_usage(self, queue):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        with self.lock:
+            return {
+                q['namespace'] or None: QuotaUsage(q['inflight'], q['max_inflight'])
+                for q in self.db.quotas.find({'queue': queue})}
+
+    def reconcile_quotas(self, queue):
+        """Recount the messages being processed of each quota
+
+        The clients keep a counter of the messages being processed,
+        it drifts when messages are requeued or when a client dies before releasing its messages
+        """
+        with self.lock:
+            for quota in self.db.quotas.find({'queue': queue}):
+                self.db.quotas.update_one({'_id': quota['_id']}, {
+                    '$set': {
+                        'inflight': self.db[queue].count_documents(_inflight_query(quota['namespace'] or None))
+                    }
+                })
+
+    def acquire_leader(self, name, holder, lease):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        with self.lock:
+            try:
+                # the document is only matched if we are the leader or if the lease of the leader expired
+                # otherwise the upsert tries to insert a document with the same _id and fails
+                self.db.leaders.update_one({
+                    '_id': name,
+                    '$or': [
+                        {'holder': holder},
+                        {'$expr': {'$lt': ['$lease_until', '$$NOW']}}
+                    ]
+                }, [{
+                    '$set': {
+                        'holder': holder,
+                        'lease_until': {'$add': ['$$NOW', int(lease * 1000)]}
+                    }
+                }], upsert=True)
+                return True
+
+            except pymongo.errors.DuplicateKeyError:
+                return False
+
+    def release_leader(self, name, holder):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        with self.lock:
+            self.db.leaders.delete_one({'_id': name, 'holder': holder})
+
+    def leader(self, name):
+        """See `~msgqueue.backends.queue.QueueMonitor`"""
+        with self.lock:
+            lease = self.db.leaders.find_one({'_id': name, '$expr': {'$gt': ['$lease_until', '$$NOW']}})
+            return lease['holder'] if lease is not None else None
 
     def log(self, agent, ltype=0):
         from bson import ObjectId
@@ -14,32 +14,67 @@ from msgqueue.uri import parse_uri
 
 _base = os.path.dirname(os.path.realpath(__file__))
 
+# the claims, leases and heartbeats use pipeline updates and $$NOW
+MIN_VERSION = (4, 2)
+
 
 class MongoStartError(Exception):
     pass
 
 
-def new_queue(db, namespace, name):
-    queue = db[name]
+# Index created by older versions that do not match the access paths anymore
+LEGACY_INDEXES = [
+    'namespace_-1_read_-1_mtype_-1',
+    'time_1',
+    'replied_id_-1',
+    'actioned_-1',
+    'expire_time_1',
+    'inflight_index',
+]
 
-    # Pop index
-    index = [
-        ('namespace', pymongo.DESCENDING),
-        ('read', pymongo.DESCENDING),
-        ('mtype', pymongo.DESCENDING),
-    ]
 
-    queue.create_index(index)
+def create_indexes(queue):
+    """Create the indexes following the access paths of the message queue"""
+    unread = {'read': False}
 
-    # Other
-    index = [
+    # Pop index, pop the oldest unread message of a namespace
+    queue.create_index([
+        ('namespace', pymongo.ASCENDING),
+        ('mtype', pymongo.ASCENDING),
         ('time', pymongo.ASCENDING),
-        ('replied_id', pymongo.DESCENDING),
-        ('actioned', pymongo.DESCENDING),
-    ]
+    ], name='dequeue_index', partialFilterExpression=unread)
+
+    # Pop the oldest unread message when no namespace is specified
+    queue.create_index([
+        ('mtype', pymongo.ASCENDING),
+        ('time', pymongo.ASCENDING),
+    ], name='dequeue_all_index', partialFilterExpression=unread)
+
+    # Messages being processed whose lease expired (lost messages)
+    queue.create_index([
+        ('lease_until', pymongo.ASCENDING),
+        ('namespace', pymongo.ASCENDING),
+    ], name='lease_index', partialFilterExpression={'read': True, 'actioned': False})
+
+    # Replies of a message
+    queue.create_index([('replying_to', pymongo.ASCENDING)], name='reply_index')
 
-    for i in index:
-        queue.create_index([i])
+    # Messages inserted, read or actioned since a time in all the namespaces (mirror synchronization)
+    queue.create_index([('time', pymongo.ASCENDING)], name='time_index')
+    queue.create_index([('read_time', pymongo.ASCENDING)], name='read_time_index')
+    queue.create_index([('actioned_time', pymongo.ASCENDING)], name='actioned_time_index')
+
+    # Expired messages that were never read are removed by mongodb itself
+    queue.create_index(
+        [('expire_time', pymongo.ASCENDING)],
+        name='expire_index',
+        expireAfterSeconds=0,
+        partialFilterExpression=unread)
+
+
+def new_queue(db, namespace, name):
+    queue = db[name]
+    create_indexes(queue)
 
     db.namespaces.insert_one({
         'namespace': namespace,
@@ -47,6 +82,33 @@ def new_queue(db, namespace, name):
     })
 
 
+def upgrade_queues(db):
+    """Migrate all the existing queues of a database to the current indexes
+
+    Returns
+    -------
+    the list of queues that were upgraded
+    """
+    queues = list(set(n['name'] for n in db.namespaces.find()))
+
+    for name in queues:
+        queue = db[name]
+        existing = queue.index_information()
+
+        for index in LEGACY_INDEXES:
+            if index in existing:
+                queue.drop_index(index)
+
+        create_indexes(queue)
+
+        # messages being processed by older clients get the default worker timeout to finish
+        queue.update_many(
+            {'read': True, 'actioned': False, 'lease_until': None},
+            [{'$set': {'lease_until': {'$add': [{'$ifNull': ['$heartbeat', '$$NOW']}, 5 * 60 * 1000]}}}])
+
+    return queues
+
+
 class MongoDB(QueueServer):
     def __init__(self, uri, database, location, clean_on_exit=True):
         options = parse_uri(uri)
@@ -149,7 +211,10 @@ class MongoDB(QueueServer):
             return False
 
     def _setup(self, client='track_client'):
-        pass
+        version = pymongo.MongoClient(host=self.address, port=self.port).server_info()['version']
+
+        if tuple(int(v) for v in version.split('.')[:2]) < MIN_VERSION:
+            raise MongoStartError(f'MongoDB {version} is not supported, msgqueue requires MongoDB >= 4.2')
 
     def new_queue(self, db, namespace, name):
         client = pymongo.MongoClient(
@@ -158,6 +223,17 @@ class MongoDB(QueueServer):
 
         new_queue(client[db], namespace, name)
 
+    def upgrade_queues(self, db=None):
+        """Migrate the existing queues to the current indexes, see :func:`upgrade_queues`"""
+        if db is None:
+            db = self.database
+
+        client = pymongo.MongoClient(
+            host=self.address,
+            port=self.port)
+
+        return upgrade_queues(client[db])
+
     def stop(self):
         self.properties['running'] = False
         self._process.terminate()
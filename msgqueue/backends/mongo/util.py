@@ -15,3 +15,27 @@ def _parse(result):
     result.pop('_id')
 
     return Message(**result)
+
+
+def _quota_id(queue, namespace=None):
+    """Id of the document holding the quota of a namespace, an empty namespace is the quota of the whole queue"""
+    return f'{queue}/{namespace or ""}'
+
+
+def _inflight_query(namespace=None):
+    """Messages being processed, they count toward the quotas"""
+    query = {
+        'read': True,
+        'actioned': False,
+        'error': None
+    }
+
+    if namespace is not None:
+        query['namespace'] = namespace
+
+    return query
+
+
+def _counter_id(queue, namespace, mtype, state):
+    """Id of the document counting the messages of a namespace and type in a given state"""
+    return f'{queue}/{namespace or ""}/{mtype}/{state}'
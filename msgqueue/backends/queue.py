@@ -1,9 +1,14 @@
+from collections import defaultdict
 from dataclasses import dataclass, asdict, field
 from datetime import datetime
+import hashlib
+import math
 import threading
-from typing import Union, List, Dict
+from typing import Union, List, Dict, Optional, Tuple
 from msgqueue.logs import warning
+from msgqueue.scheduler import DeficitRoundRobin
 import signal
+import socket
 import time
 
 
@@ -47,6 +52,10 @@ class Message:
     error: str                      # Error if any
     namespace: str = None           # Namespace the message is coming from
     heartbeat: datetime = None      # Last time we had a proof of life
+    expire_time: datetime = None    # Time after which the message is dropped if still unread
+    shard: int = None               # Shard the message was inserted in
+    agent: int = None               # Agent processing the message
+    lease_until: datetime = None    # Time after which the message is considered lost if not actioned
     g0: str = None
     g1: str = None
 
@@ -58,6 +67,103 @@ class Message:
         return asdict(self)
 
 
+@dataclass
+class WaitingTime:
+    """Time messages of a namespace waited in the queue before being dequeued"""
+    count: int          # Number of messages dequeued
+    mean: float         # Average waiting time in seconds
+    max: float          # Longest waiting time in seconds
+    oldest: float = 0   # Age in seconds of the oldest message still waiting
+
+    def to_dict(self):
+        return asdict(self)
+
+
+@dataclass
+class QueueStats:
+    """Number of messages of a namespace in each state"""
+    queue: str                  # Name of the queue
+    namespace: str              # Namespace the counts are for
+    unread: int = 0             # Messages waiting to be dequeued
+    read: int = 0               # Messages that were dequeued
+    unactioned: int = 0         # Messages dequeued but not actioned yet
+    actioned: int = 0           # Messages done being processed
+    failed: int = 0             # Messages not actioned whose processing raised an error
+    lost: int = 0               # Messages not actioned whose lease expired
+    oldest_unread: float = 0    # Age in seconds of the oldest unread message
+
+    def to_dict(self):
+        return asdict(self)
+
+
+@dataclass
+class QuotaUsage:
+    """Number of messages being processed compared to the quota"""
+    inflight: int       # Number of messages being processed
+    max_inflight: int   # Maximum number of messages that can be processed at once
+
+    @property
+    def utilization(self):
+        return self.inflight / self.max_inflight if self.max_inflight else 1
+
+    def to_dict(self):
+        return dict(asdict(self), utilization=self.utilization)
+
+
+class ApproximateCount(int):
+    """Count returned by the `*_count` methods of the monitors when `approximate=True`
+
+    The exact count is within ``count - error`` and ``count + error`` with 95% confidence,
+    an error of 0 means the count is exact
+    """
+    def __new__(cls, count, error=0):
+        obj = super(ApproximateCount, cls).__new__(cls, count)
+        obj.error = error
+        return obj
+
+    @property
+    def exact(self):
+        return self.error == 0
+
+    def __repr__(self):
+        return f'ApproximateCount({int(self)}, error={self.error})'
+
+
+def sampled_count(total, sampled, matched, z=1.96) -> ApproximateCount:
+    """Extrapolate the number of matching messages of a queue from a uniform sample
+
+    The error is the largest distance to the bounds of the Wilson score interval of the
+    proportion of matching messages, scaled by the size of the queue
+
+    Parameters
+    ----------
+    total: int
+        number of messages in the queue
+
+    sampled: int
+        number of messages in the sample
+
+    matched: int
+        number of messages of the sample matching the count condition
+
+    z: float
+        quantile of the normal distribution of the confidence level (1.96 for 95%)
+    """
+    if sampled >= total:
+        return ApproximateCount(matched)
+
+    p = matched / sampled
+    zn = z * z / sampled
+    center = (p + zn / 2) / (1 + zn)
+    half = z * math.sqrt(p * (1 - p) / sampled + zn / (4 * sampled)) / (1 + zn)
+
+    # finite population correction, the sample was drawn without replacement
+    fpc = math.sqrt((total - sampled) / (total - 1))
+    error = total * max(p - (center - half), (center + half) - p) * fpc
+
+    return ApproximateCount(round(total * p), math.ceil(error))
+
+
 @dataclass
 class Reply:
     """Represent a message reply, it means the message should be queued if and only if
@@ -114,14 +220,45 @@ class QueueServer:
 
 
 class QueuePacemaker(threading.Thread):
+    """Keep the agent alive and extend the leases of the messages it is processing
+
+    Parameters
+    ----------
+    agent: MessageQueue
+        client the pacemaker is keeping alive
+
+    wait_time: float
+        time between two heartbeats
+
+    capture: bool
+        capture the output of the agent
+
+    Notes
+    -----
+    The heartbeat interval is shortened to a third of the lease so a lease is always extended before it expires.
+    When the client is configured with a node level heartbeat agent (see :mod:`msgqueue.heartbeat`)
+    the pacemaker forwards its messages to the agent and only writes to the database if the agent is not reachable
+    """
     def __init__(self, agent, wait_time, capture):
         threading.Thread.__init__(self)
         self.stopped = threading.Event()
-        self.wait_time = wait_time
         self.agent = agent
         self.agent_id = None
         self.capture = capture
+        self.queue = None
         self.message = None
+        self.lease = getattr(agent, 'lease', None) or 3 * wait_time
+        self.wait_time = min(wait_time, self.lease / 3)
+        self.local_agent = None
+
+        address = getattr(agent, 'heartbeat_address', None)
+        if address is not None:
+            from msgqueue.heartbeat import HeartbeatConnection
+            self.local_agent = HeartbeatConnection(address)
+
+        # queue -> {message uid -> local time at which the lease expires}
+        self.leases = defaultdict(dict)
+        self.leases_lock = threading.RLock()
         if capture:
             self.capture_output()
 
@@ -147,25 +284,80 @@ class QueuePacemaker(threading.Thread):
     def register_agent(self, agent_name):
         raise NotImplementedError()
 
+    def start(self):
+        # join synchronously, the agent needs the lease of the worker before any message is registered
+        if self.local_agent is not None:
+            self.local_agent.join(self.agent_id, self.lease)
+
+        super(QueuePacemaker, self).start()
+
     def run(self):
         """Run the trial monitoring every given interval."""
         while not self.stopped.wait(self.wait_time):
+            # the ping fails once the agent died, the pacemaker then sends its own heartbeats
+            if self.local_agent is not None and self.local_agent.ping():
+                continue
+
             self.update_heartbeat()
 
     def update_heartbeat(self):
-        raise NotImplementedError()
+        """Extend the leases that are about to expire in bulk and refresh the agent heartbeat"""
+        now = time.monotonic()
+
+        with self.leases_lock:
+            expiring = dict()
+            for queue, leases in self.leases.items():
+                uids = [uid for uid, until in leases.items() if until - now < 2 * self.wait_time]
+
+                if uids:
+                    expiring[queue] = uids
+
+                for uid in uids:
+                    leases[uid] = now + self.lease
+
+        for queue, uids in expiring.items():
+            self.agent.extend_leases(queue, [(uid, self.agent_id, self.lease) for uid in uids])
+
+        if self.agent_id is not None:
+            self.agent.agent_heartbeat([self.agent_id])
 
     def register_message(self, name, message):
-        raise NotImplementedError()
+        """Keep track of the message being processed
 
-    def unregister_message(self, uid):
-        raise NotImplementedError()
+        The message row records which agent claimed it and its lease when it is dequeued
+        so the agent's current message does not need to be written anywhere else
+        """
+        if message is None:
+            return None
+
+        with self.leases_lock:
+            self.leases[name][message.uid] = time.monotonic() + self.lease
+
+        if self.local_agent is not None:
+            self.local_agent.register(name, message.uid)
+
+        self.queue = name
+        self.message = message
+        return message
+
+    def unregister_message(self, uid=None):
+        with self.leases_lock:
+            for leases in self.leases.values():
+                leases.pop(uid, None)
+
+        if self.local_agent is not None:
+            self.local_agent.unregister(uid)
+
+        self.message = None
 
     def stop(self):
         """Stop monitoring."""
         self.stopped.set()
         self.join()
 
+        if self.local_agent is not None:
+            self.local_agent.close()
+
         if self.capture:
             import sys
             sys.stdout = sys.stdout.file
@@ -178,7 +370,65 @@ class QueuePacemaker(threading.Thread):
         raise NotImplementedError()
 
 
+# States tracked by the counters, a failed message is also unactioned
+COUNTER_STATES = ('unread', 'unactioned', 'actioned', 'failed')
+
+# Changes of the counters when a message is enqueued, dequeued, actioned or fails
+ENQUEUED = (('unread', 1),)
+CLAIMED = (('unread', -1), ('unactioned', 1))
+ACTIONED = (('unactioned', -1), ('actioned', 1))
+FAILED = (('failed', 1),)
+# Changes of the counters when a message being processed or a failed message is requeued by the monitor
+REQUEUED = (('unactioned', -1), ('unread', 1))
+REQUEUED_FAILED = (('failed', -1), ('unactioned', -1), ('unread', 1))
+
+# Keys of the envelope of the messages sent by `MessageQueue.call`
+RPC_REPLY_QUEUE = '__rpc_reply_queue__'
+RPC_PAYLOAD = '__rpc_payload__'
+
+
+class RPCError(Exception):
+    """The worker failed to process a message sent by `MessageQueue.call`"""
+    pass
+
+
+class _RPCWaiter:
+    """In process fast path, the reply is handed over directly when the worker runs in the caller's process"""
+    def __init__(self):
+        self.event = threading.Event()
+        self.uid = None
+        self.payload = None
+
+    def set(self, uid, payload):
+        self.uid = uid
+        self.payload = payload
+        self.event.set()
+
+
+# (reply queue, message uid) -> _RPCWaiter
+_rpc_waiters = dict()
+_rpc_lock = threading.Lock()
+
+
+def unwrap_rpc(message: 'Message'):
+    """Replace the payload of a message sent by `MessageQueue.call` by the caller's payload,
+    returns the queue the reply is expected on or None if the message is not a call"""
+    data = message.message
+
+    if isinstance(data, dict) and RPC_REPLY_QUEUE in data:
+        message.message = data.get(RPC_PAYLOAD)
+        return data[RPC_REPLY_QUEUE]
+
+    return None
+
+
 class MessageQueue:
+    # time in seconds between two refreshes of the namespaces with unread messages in fair mode
+    fair_refresh = 5
+
+    # time in seconds between two checks for quotas on a queue
+    quota_refresh = 5
+
     def __init__(self, uri, database):
         self.uri = uri
         self.database = database
@@ -203,7 +453,7 @@ class MessageQueue:
     def monitor(self):
         raise NotImplementedError()
 
-    def enqueue(self, queue, namespace, message, mtype=0, replying_to=None):
+    def enqueue(self, queue, namespace, message, mtype=0, replying_to=None, ttl=None):
         """Insert a new message inside the queue
 
         Parameters
@@ -222,6 +472,10 @@ class MessageQueue:
 
         replying_to: int
             message id this message replies to
+
+        ttl: float
+            time to live in seconds, once expired an unread message will not be dequeued
+            and is eventually removed from the queue (default: never expires)
         """
         raise NotImplementedError()
 
@@ -241,6 +495,183 @@ class MessageQueue:
         """
         raise NotImplementedError()
 
+    def dequeue_any(self, queues: List[str], namespace, mtype: Union[int, List[int]] = None):
+        """Remove the oldest message of the first queue that has one
+
+        Parameters
+        ----------
+        queues: List[str]
+            Queues to pop the message from, in order of preference
+
+        namespace: str
+            Namespace of the message, can be None to dequeue for all
+
+        mtype: Union[int, List[int]
+            type of message to look for (default: none)
+
+        Returns
+        -------
+        a tuple (queue, message), (None, None) if all the queues are empty
+        """
+        for queue in queues:
+            msg = self.dequeue(queue, namespace, mtype)
+
+            if msg is not None:
+                return queue, msg
+
+        return None, None
+
+    def active_namespaces(self, queue, mtype: Union[int, List[int]] = None) -> List[str]:
+        """Return the namespaces that have unread messages"""
+        return self.monitor().active_namespaces(queue, mtype)
+
+    def _has_quotas(self, queue):
+        """Return True if the queue has quotas, the answer is cached for `quota_refresh` seconds"""
+        has_quotas, refreshed = self.quota_cache.get(queue, (False, 0))
+
+        if time.time() - refreshed > self.quota_refresh:
+            has_quotas = bool(self.monitor().quotas(queue))
+            self.quota_cache[queue] = has_quotas, time.time()
+
+        return has_quotas
+
+    @property
+    def rpc_queue(self):
+        """Queue the replies to the calls of this client are pushed to
+
+        The queue is shared by all the clients of a host and reused across restarts, replies are matched
+        to their call by uid, so the number of reply queues is bounded by the number of hosts.
+        Consumed replies are marked as actioned, they can be removed with ``monitor.clear(client.rpc_queue, None)``
+        """
+        queue = getattr(self, '_rpc_queue', None)
+
+        if queue is None:
+            # hostnames can contain characters that are not valid in a table name
+            host = hashlib.sha1(socket.gethostname().encode()).hexdigest()[:16]
+            queue = f'rpc_{host}'
+            self._rpc_queue = queue
+
+        return queue
+
+    def call(self, queue, namespace, payload, mtype=0, timeout=None, interval=0.01):
+        """Push a message and wait for the return value of the worker processing it
+
+        The request and its reply are regular messages so they have the same durability as the rest of the queue,
+        the reply is pushed to the reply queue of the host of this client (see `rpc_queue`).
+        When the worker runs in the same process the reply is also handed over in memory
+        so the caller does not have to wait for its next poll.
+
+        Parameters
+        ----------
+        queue: str
+            queue the workers pull from
+
+        namespace: str
+            namespace of the message
+
+        payload: json
+            message given to the worker handler
+
+        mtype: int
+            type of the message, selects the handler of the worker
+
+        timeout: float
+            time in seconds after which `TimeoutError` is raised, None to wait forever
+
+        interval: float
+            initial time in seconds between two polls of the reply queue, it grows up to 0.5 seconds
+
+        Raises
+        ------
+        RPCError
+            if the handler raised an exception and the message will not be retried
+        """
+        rpc_queue = self.rpc_queue
+        uid = self.enqueue(queue, namespace, {RPC_REPLY_QUEUE: rpc_queue, RPC_PAYLOAD: payload}, mtype=mtype)
+
+        waiter = _RPCWaiter()
+        with _rpc_lock:
+            _rpc_waiters[(rpc_queue, uid)] = waiter
+
+        start = time.time()
+        try:
+            while waiter.payload is None:
+                reply = self.get_reply(rpc_queue, uid)
+
+                if reply is not None:
+                    waiter.set(reply.uid, reply.message)
+                    break
+
+                if timeout is not None and time.time() - start > timeout:
+                    raise TimeoutError(f'no reply to {uid} after {timeout} seconds')
+
+                waiter.event.wait(interval)
+                interval = min(interval * 2, 0.5)
+
+        finally:
+            with _rpc_lock:
+                _rpc_waiters.pop((rpc_queue, uid), None)
+
+        self.mark_actioned(rpc_queue, waiter.uid)
+
+        if 'error' in waiter.payload:
+            raise RPCError(waiter.payload['error'])
+
+        return waiter.payload['result']
+
+    def rpc_reply(self, rpc_queue, message: 'Message', result=None, error=None):
+        """Send the return value of the handler of a message sent by `call` to the caller"""
+        payload = {'result': result} if error is None else {'error': error}
+        uid = self.enqueue(rpc_queue, message.namespace, payload, replying_to=message.uid)
+
+        with _rpc_lock:
+            waiter = _rpc_waiters.get((rpc_queue, message.uid))
+
+        if waiter is not None:
+            waiter.set(uid, payload)
+
+        return uid
+
+    def _dequeue_fair(self, queue, mtype=None):
+        """Dequeue from the namespaces with unread messages in turn so a namespace with a large backlog
+        does not starve the others.
+
+        Each namespace is served with an index seek, namespaces share the work according to
+        `namespace_weights` (default: 1) using deficit round robin.
+        """
+        scheduler, refreshed = self.fair_schedulers.get(queue, (None, 0))
+
+        if scheduler is None or time.time() - refreshed > self.fair_refresh:
+            namespaces = self.active_namespaces(queue, mtype)
+            if not namespaces:
+                return None
+
+            weights = {n: self.namespace_weights.get(n, 1) for n in namespaces}
+            if scheduler is None:
+                scheduler = DeficitRoundRobin(weights)
+            else:
+                scheduler.set_weights(weights)
+
+            refreshed = time.time()
+
+        order = scheduler.order()
+        for namespace in order:
+            msg = self.dequeue(queue, namespace, mtype)
+
+            if msg is not None:
+                scheduler.update(order, namespace)
+                self.fair_schedulers[queue] = scheduler, refreshed
+                return msg
+
+        # the namespaces we knew about are empty, look for new ones next time
+        scheduler.update(order, None)
+        self.fair_schedulers[queue] = scheduler, 0
+        return None
+
+    def explain_dequeue(self, queue, namespace, mtype: Union[int, List[int]] = None):
+        """Return the query plan the database uses to `dequeue` a message"""
+        raise NotImplementedError()
+
     def mark_actioned(self, queue, message: Union[Message, int]):
         """Mark a message as actioned
 
@@ -271,6 +702,26 @@ class MessageQueue:
     def mark_actioned_all(self, queue, messages: List[Message]):
         raise NotImplementedError()
 
+    def extend_leases(self, queue, leases: List[Tuple[int, int, float]]):
+        """Extend the leases of messages being processed, all the leases are extended in a single write
+
+        Parameters
+        ----------
+        queue: str
+            Message queue name
+
+        leases: List[Tuple[int, int, float]]
+            ``(uid, agent, lease)`` of the messages to extend.
+            `agent` is the agent processing the message, None for the agent of the client,
+            the messages requeued and claimed by another agent since are not extended.
+            `lease` is the new lease duration in seconds, starting from now (server time)
+        """
+        raise NotImplementedError()
+
+    def agent_heartbeat(self, agents: List[int]):
+        """Update the heartbeat of agents to signal they are still alive"""
+        raise NotImplementedError()
+
     def mark_error(self, queue, message, error):
         raise NotImplementedError()
 
@@ -281,6 +732,21 @@ class MessageQueue:
         return self.dequeue(*args, **kwargs)
 
     def get_reply(self, queue, message: Union[int, List[int]]):
+        """Return the reply to a message
+
+        Parameters
+        ----------
+        queue: str
+            queue the replies are pushed to
+
+        message: Union[int, List[int]]
+            uid of the message, or a list of uids to fetch their replies with a single query
+
+        Returns
+        -------
+        the reply or None if there is no reply yet, for a list of uids a dictionary uid -> reply
+        with the messages that have a reply
+        """
         raise NotImplementedError()
 
     def _register_message(self, queue, msg):
@@ -298,6 +764,11 @@ class MessageQueue:
 
 
 class QueueMonitor:
+    # the counts are read from the counters maintained by the clients (see `counters`)
+    use_counters = False
+    # number of messages read to estimate the counts when `approximate=True`
+    sample_size = 10000
+
     def __init__(self, uri, database):
         self.uri = uri
         self.database = database
@@ -315,6 +786,10 @@ class QueueMonitor:
     def agents(self, namespace):
         raise NotImplementedError()
 
+    def agent_messages(self, queue, agent: Union[Agent, int] = None):
+        """Return the messages of a queue that are being processed by an agent (all agents if None)"""
+        raise NotImplementedError()
+
     def clear(self, name, namespace):
         """Clear the queue by removing all messages"""
         raise NotImplementedError()
@@ -322,22 +797,39 @@ class QueueMonitor:
     def messages(self, name, namespace, mtype=None, limit=100, time=None):
         raise NotImplementedError()
 
+    def messages_by_uid(self, name, uids) -> List[Message]:
+        """Return the messages of a queue with the given uids, the messages that do not exist are skipped"""
+        raise NotImplementedError()
+
+    def changed_messages(self, name, since) -> List[Message]:
+        """Return the messages of a queue read or actioned after `since`"""
+        raise NotImplementedError()
+
     def unread_messages(self, name, namespace, mtype=None):
         raise NotImplementedError()
 
     def unactioned_messages(self, name, namespace, mtype=None):
         raise NotImplementedError()
 
-    def unread_count(self, name, namespace, mtype=None):
+    def unread_count(self, name, namespace, mtype=None, approximate=False):
+        """Return the number of messages waiting to be dequeued
+
+        With `approximate`, queues larger than `sample_size` are not scanned, the count is read from the
+        counters if they are enabled or estimated from a sample of the queue, it is returned as an
+        :class:`ApproximateCount` with its error bound
+        """
         raise NotImplementedError()
 
-    def unactioned_count(self, name, namespace, mtype=None):
+    def unactioned_count(self, name, namespace, mtype=None, approximate=False):
+        """Return the number of messages dequeued but not actioned yet, see `unread_count` for `approximate`"""
         raise NotImplementedError()
 
-    def actioned_count(self, name, namespace, mtype=None):
+    def actioned_count(self, name, namespace, mtype=None, approximate=False):
+        """Return the number of messages done being processed, see `unread_count` for `approximate`"""
         raise NotImplementedError()
 
-    def read_count(self, name, namespace, mtype=None):
+    def read_count(self, name, namespace, mtype=None, approximate=False):
+        """Return the number of messages that were dequeued, see `unread_count` for `approximate`"""
         raise NotImplementedError()
 
     def reset_queue(self, name, namespace):
@@ -345,10 +837,16 @@ class QueueMonitor:
         raise NotImplementedError()
 
     def lost_messages(self, queue, namespace, timeout_s=120):
-        """Return the list of messages that were assigned to worker that died"""
+        """Return the list of messages that were assigned to worker that died
+
+        The messages are lost once their lease expires, `timeout_s` is deprecated and ignored
+        by the database backends, the lease duration is set by the client that dequeued the message
+        """
         raise NotImplementedError()
 
     def requeue_lost_messages(self, queue, namespace, timeout_s=60, max_retry=3):
+        """Requeue the lost messages that were retried less than `max_retry` times,
+        `timeout_s` is deprecated and ignored, see `lost_messages`"""
         raise NotImplementedError()
 
     def failed_messages(self, namespace, queue):
@@ -358,6 +856,111 @@ class QueueMonitor:
     def requeue_failed_messages(self, queue, namespace, max_retry=3):
         raise NotImplementedError()
 
+    def expired_messages(self, queue, namespace, mtype=None):
+        """Return the list of unread messages that expired before being dequeued"""
+        raise NotImplementedError()
+
+    def expired_count(self, queue, namespace, mtype=None, approximate=False):
+        """Return the number of unread messages that expired and are waiting to be purged,
+        see `unread_count` for `approximate`"""
+        raise NotImplementedError()
+
+    def purge_expired_messages(self, queue, namespace, batch_size=1000):
+        """Remove expired unread messages from the queue, returns the number of messages removed"""
+        raise NotImplementedError()
+
+    def active_namespaces(self, queue, mtype: Union[int, List[int]] = None) -> List[str]:
+        """Return the namespaces that have unread messages"""
+        raise NotImplementedError()
+
+    def stats(self, queues: List[str] = None, namespaces: List[str] = None) -> List[QueueStats]:
+        """Return the number of messages in each state for each namespace of each queue
+
+        The counts of a queue are computed in a single pass, prefer it over calling the `*_count` methods
+        for every queue and namespace.
+
+        Parameters
+        ----------
+        queues: List[str]
+            queues to compute the statistics of, None for all the queues
+
+        namespaces: List[str]
+            namespaces to compute the statistics of, None for all the namespaces
+        """
+        raise NotImplementedError()
+
+    def waiting_times(self, queue, namespace=None) -> Dict[str, WaitingTime]:
+        """Return the waiting time statistics of each namespace, used to check that namespaces are served fairly"""
+        raise NotImplementedError()
+
+    def set_quota(self, queue, namespace=None, max_inflight: int = None):
+        """Limit the number of messages that can be processed at once
+
+        Parameters
+        ----------
+        queue: str
+            Message queue name
+
+        namespace: str
+            namespace the quota applies to, None for a quota on the whole queue
+
+        max_inflight: int
+            maximum number of messages dequeued but not actioned yet, None to remove the quota
+        """
+        raise NotImplementedError()
+
+    def quotas(self, queue) -> Dict[str, int]:
+        """Return the quotas of a queue, the quota of the whole queue uses the None key"""
+        raise NotImplementedError()
+
+    def quota_usage(self, queue) -> Dict[str, QuotaUsage]:
+        """Return the utilization of each quota of a queue"""
+        raise NotImplementedError()
+
+    def reconcile_quotas(self, queue):
+        """Fix the quota usage after messages were requeued or lost"""
+        raise NotImplementedError()
+
+    def counters(self, queue, namespace=None, mtype=None) -> Dict[str, int]:
+        """Return the number of messages in each state (see `COUNTER_STATES`) from the counters
+        maintained by the clients created with the `counters` option, without scanning the queue
+
+        The messages purged or reset by the monitor are accounted for by the next `reconcile_counters`
+        """
+        raise NotImplementedError()
+
+    def reconcile_counters(self, queue):
+        """Recount the messages of a queue and overwrite its counters to correct their drift"""
+        raise NotImplementedError()
+
+    def acquire_leader(self, name: str, holder: str, lease: float) -> bool:
+        """Become or remain the leader of `name` for `lease` seconds
+
+        Parameters
+        ----------
+        name: str
+            name of the role to lead i.e `reaper`
+
+        holder: str
+            unique name of the instance trying to become the leader
+
+        lease: float
+            time in seconds after which the leadership is lost if it is not renewed
+
+        Returns
+        -------
+        True if `holder` is the leader
+        """
+        raise NotImplementedError()
+
+    def release_leader(self, name: str, holder: str):
+        """Give up the leadership so another instance can take over right away"""
+        raise NotImplementedError()
+
+    def leader(self, name: str) -> Optional[str]:
+        """Return the holder of the leadership of `name`, None if nobody holds a lease that did not expire"""
+        raise NotImplementedError()
+
     def log(self, agent: Union[Agent, int], ltype: int = 0):
         """Return the log of an agent"""
         raise NotImplementedError()
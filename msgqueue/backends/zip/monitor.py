@@ -8,14 +8,14 @@ import zipfile
 
 
 from msgqueue.uri import parse_uri
-from msgqueue.backends.queue import QueueMonitor, Agent, Message
+from msgqueue.backends.queue import QueueMonitor, Agent, Message, ApproximateCount
 
 
 def cached(f):
-    def wrapper(self, *args):
+    def wrapper(self, *args, **kwargs):
         with self.lock:
             # start = time.time()
-            r = f(self, *args)
+            r = f(self, *args, **kwargs)
             # print(f'Function {f} took {time.time() - start}')
             return r
     return wrapper
@@ -183,20 +183,25 @@ class ZipQueueMonitor(QueueMonitor):
         return unread
 
     @cached
-    def unread_count(self, name, namespace):
-        return len(self.unread_messages(namespace, name))
+    def unread_count(self, name, namespace, approximate=False):
+        # archives are loaded in memory, the counts are always exact
+        count = len(self.unread_messages(namespace, name))
+        return ApproximateCount(count) if approximate else count
 
     @cached
-    def unactioned_count(self, name, namespace):
-        return len(self.unactioned_messages(namespace, name))
+    def unactioned_count(self, name, namespace, approximate=False):
+        count = len(self.unactioned_messages(namespace, name))
+        return ApproximateCount(count) if approximate else count
 
     @cached
-    def actioned_count(self, name, namespace):
-        return len(self.actioned_messages(namespace, name))
+    def actioned_count(self, name, namespace, approximate=False):
+        count = len(self.actioned_messages(namespace, name))
+        return ApproximateCount(count) if approximate else count
 
     @cached
-    def read_count(self, name, namespace):
-        return len(self.read_messages(namespace, name))
+    def read_count(self, name, namespace, approximate=False):
+        count = len(self.read_messages(namespace, name))
+        return ApproximateCount(count) if approximate else count
 
     @cached
     def dead_agents(self, namespace, timeout_s=60):
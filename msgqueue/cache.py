@@ -0,0 +1,233 @@
+"""Cache the queries of a monitor
+
+Dashboards served to many browser tabs ask the same counts over and over, every call goes to the database
+under the lock of the monitor. :class:`CachedMonitor` wraps any monitor, including the one of
+:func:`~msgqueue.backends.new_monitor_process`, and answers the read queries from a cache:
+
+* each method has its own time to live, the counts are refreshed more often than the list of queues
+* concurrent calls with the same arguments are coalesced into a single query (single flight)
+* the least recently used results are evicted once the cache is full
+* the methods that change the queues (``requeue_*``, ``reset_queue``, ...) invalidate the cache
+
+.. code-block:: python
+
+    from msgqueue.cache import CachedMonitor
+
+    monitor = CachedMonitor(new_monitor(uri, database), ttls={'unread_count': 5})
+    monitor.unread_count('work', 'example')
+
+    # after an out of band change
+    monitor.invalidate(queue='work')
+
+The cached results are shared between the callers and must not be modified.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+# time to live in seconds of the results of the cached methods,
+# the methods that are not listed are forwarded to the monitor without caching
+DEFAULT_TTLS = {
+    'unread_count': 1,
+    'unactioned_count': 1,
+    'read_count': 1,
+    'actioned_count': 1,
+    'expired_count': 1,
+    'stats': 1,
+    'counters': 1,
+    'quota_usage': 1,
+    'messages': 1,
+    'unread_messages': 1,
+    'unactioned_messages': 1,
+    'agent_messages': 1,
+    'lost_messages': 5,
+    'failed_messages': 5,
+    'expired_messages': 5,
+    'waiting_times': 5,
+    'active_namespaces': 5,
+    'quotas': 5,
+    'agents': 5,
+    'dead_agents': 5,
+    'log': 5,
+    'queues': 10,
+    'namespaces': 10,
+}
+
+# methods that change the state of the queues, the cache is invalidated after they are called
+MUTATIONS = {
+    'clear',
+    'archive',
+    'reset_queue',
+    'requeue_lost_messages',
+    'requeue_failed_messages',
+    'purge_expired_messages',
+    'set_quota',
+    'reconcile_quotas',
+    'reconcile_counters',
+}
+
+
+def _freeze(value):
+    """Make the arguments of a call usable as a cache key"""
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+
+    if isinstance(value, set):
+        return frozenset(value)
+
+    return value
+
+
+class _Flight:
+    """Query in progress, the callers asking for the same result wait for it"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+
+        if self.error is not None:
+            raise self.error
+
+        return self.result
+
+
+class CachedMonitor:
+    """Monitor answering the read queries from a cache
+
+    Parameters
+    ----------
+    monitor: QueueMonitor
+        monitor doing the queries
+
+    ttl: float
+        time to live in seconds of all the cached methods, None to use `DEFAULT_TTLS`
+
+    ttls: Dict[str, float]
+        time to live in seconds of specific methods, 0 disables the caching of a method
+
+    max_entries: int
+        maximum number of results kept, the least recently used ones are evicted first
+
+    clock: Callable[[], float]
+        time source of the expiration
+    """
+    def __init__(self, monitor, ttl=None, ttls=None, max_entries=1024, clock=time.monotonic):
+        self.monitor = monitor
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttl is not None:
+            self.ttls = {method: ttl for method in DEFAULT_TTLS}
+        self.ttls.update(ttls or dict())
+        self.max_entries = max_entries
+        self.clock = clock
+        self.lock = threading.Lock()
+        # key -> (expire time, result)
+        self.entries = OrderedDict()
+        # key -> _Flight
+        self.flights = dict()
+        # incremented on invalidation so queries started before it are not cached
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _call(self, method, args, kwargs):
+        ttl = self.ttls[method]
+        fun = getattr(self.monitor, method)
+
+        try:
+            key = (method, _freeze(args), _freeze(kwargs))
+            hash(key)
+        except TypeError:
+            return fun(*args, **kwargs)
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and entry[0] > self.clock():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            flight = self.flights.get(key)
+            leader = flight is None
+
+            if leader:
+                flight = _Flight()
+                self.flights[key] = flight
+                generation = self.generation
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if not leader:
+            return flight.wait()
+
+        try:
+            flight.result = fun(*args, **kwargs)
+        except Exception as e:
+            flight.error = e
+
+        with self.lock:
+            del self.flights[key]
+
+            if flight.error is None and generation == self.generation:
+                self.entries[key] = (self.clock() + ttl, flight.result)
+                self.entries.move_to_end(key)
+
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+
+        flight.done.set()
+        return flight.wait()
+
+    def _mutate(self, method, args, kwargs):
+        try:
+            return getattr(self.monitor, method)(*args, **kwargs)
+        finally:
+            # archive removes a namespace from all the queues
+            queue = None
+            if method != 'archive' and args and isinstance(args[0], str):
+                queue = args[0]
+
+            self.invalidate(queue=queue)
+
+    def invalidate(self, method=None, queue=None):
+        """Drop the cached results of `method` whose first argument is `queue`, None matches everything"""
+        with self.lock:
+            self.generation += 1
+
+            for key in list(self.entries):
+                name, args, _ = key
+
+                if method is not None and name != method:
+                    continue
+
+                # results that are not tied to a queue might include it
+                if queue is not None and args and args[0] != queue and name not in ('stats', 'queues', 'namespaces'):
+                    continue
+
+                del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+
+        if item in MUTATIONS:
+            def mutate(*args, **kwargs):
+                return self._mutate(item, args, kwargs)
+            return mutate
+
+        if item in self.ttls and self.ttls[item] > 0:
+            def cached(*args, **kwargs):
+                return self._call(item, args, kwargs)
+            return cached
+
+        return getattr(self.monitor, item)
@@ -1,26 +1,160 @@
+"""Wait for the replies of the messages pushed to workers
+
+A :class:`Future` waits for the reply of a single message, to wait for many replies use
+:class:`FutureSet`, :func:`gather` or :func:`as_completed`, they fetch the replies of all the pending
+messages of a queue with a single query per tick instead of one query per message.
+
+.. code-block:: python
+
+    futures = [Future(client, 'result', client.push('work', 'example', {'value': i})) for i in range(0, 10000)]
+
+    for future in as_completed(futures):
+        print(future.result)
+"""
+from collections import defaultdict
 import time
 
 
 def check_reply_fun(client, result_queue, message_id):
     def check_ready():
-        return client.reply(result_queue, message_id)
+        return client.get_reply(result_queue, message_id)
     return check_ready
 
 
 class Future:
+    """Reply of a message that will be pushed to `result_queue` by a worker"""
     def __init__(self, client, result_queue, message_id):
+        self.client = client
+        self.result_queue = result_queue
+        self.message_id = message_id
         self.check = check_reply_fun(client, result_queue, message_id)
+        self.reply = None
         self.result = None
 
+    def done(self):
+        return self.reply is not None
+
+    def set_reply(self, reply):
+        self.reply = reply
+        self.result = reply.message
+
     def ready(self):
-        self.result = self.check()
+        if self.reply is None:
+            reply = self.check()
 
-        if self.result is not None:
-            self.result = self.result.message[-1]
+            if reply is not None:
+                self.set_reply(reply)
 
         return self.result
 
-    def wait(self):
-        while self.result is None:
-            time.sleep(0.01)
+    def wait(self, timeout=None, interval=0.01):
+        start = time.time()
+
+        while not self.done():
             self.ready()
+
+            if self.done():
+                break
+
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError(f'no reply to {self.message_id} after {timeout} seconds')
+
+            time.sleep(interval)
+
+        return self.result
+
+
+class FutureSet:
+    """Resolve many futures of the same queue with one query per tick
+
+    Parameters
+    ----------
+    client: MessageQueue
+        client used to fetch the replies
+
+    result_queue: str
+        queue the replies are pushed to
+
+    futures: List[Future]
+        futures to resolve
+
+    chunk_size: int
+        maximum number of message ids in a single query
+    """
+    def __init__(self, client, result_queue, futures=(), chunk_size=1000):
+        self.client = client
+        self.result_queue = result_queue
+        self.chunk_size = chunk_size
+        self.pending = dict()
+
+        for future in futures:
+            self.add(future)
+
+    def add(self, future):
+        if not future.done():
+            self.pending[future.message_id] = future
+
+    def poll(self):
+        """Fetch the replies of the pending futures, returns the futures that were resolved"""
+        resolved = []
+        uids = list(self.pending)
+
+        for i in range(0, len(uids), self.chunk_size):
+            replies = self.client.get_reply(self.result_queue, uids[i:i + self.chunk_size])
+
+            for uid, reply in replies.items():
+                future = self.pending.pop(uid, None)
+
+                if future is not None:
+                    future.set_reply(reply)
+                    resolved.append(future)
+
+        return resolved
+
+    def __len__(self):
+        return len(self.pending)
+
+
+def _group(futures):
+    groups = defaultdict(list)
+
+    for future in futures:
+        groups[(id(future.client), future.result_queue)].append(future)
+
+    return [FutureSet(fs[0].client, fs[0].result_queue, fs) for fs in groups.values()]
+
+
+def as_completed(futures, timeout=None, interval=0.01):
+    """Yield the futures as their replies arrive"""
+    futures = list(futures)
+    start = time.time()
+
+    for future in futures:
+        if future.done():
+            yield future
+
+    sets = _group(futures)
+
+    while any(sets):
+        for future_set in sets:
+            yield from future_set.poll()
+
+        sets = [s for s in sets if s]
+        if not sets:
+            break
+
+        if timeout is not None and time.time() - start > timeout:
+            pending = sum(len(s) for s in sets)
+            raise TimeoutError(f'{pending} futures without reply after {timeout} seconds')
+
+        time.sleep(interval)
+
+
+def gather(futures, timeout=None, interval=0.01):
+    """Wait for all the replies and return the results in the order of `futures`"""
+    futures = list(futures)
+
+    for _ in as_completed(futures, timeout, interval):
+        pass
+
+    return [future.result for future in futures]
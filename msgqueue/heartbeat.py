@@ -0,0 +1,272 @@
+"""Node level heartbeat agent
+
+Every client runs a :class:`~msgqueue.backends.queue.QueuePacemaker` that refreshes its agent heartbeat and
+extends the lease of the message it is processing. With many workers on the same host this results in
+as many small writes per interval.
+
+The heartbeat agent runs once per host, local workers register their in-flight messages with it
+through a Unix socket and the agent extends all the leases and refreshes all the heartbeats
+with a single batched write per queue and per interval.
+
+.. code-block:: bash
+
+    python -m msgqueue.heartbeat --uri cockroach://192.168.0.10:8123 --database db --address /tmp/msgqueue.sock
+
+.. code-block:: python
+
+    # clients pick up the agent through the `heartbeat` uri option
+    client = new_client('cockroach://192.168.0.10:8123?heartbeat=/tmp/msgqueue.sock', 'db')
+
+If the agent is not reachable or dies, the pacemakers fall back to sending their own heartbeats.
+Messages registered by a worker that disconnects are not extended anymore and are requeued once their lease expires.
+"""
+from collections import defaultdict
+from multiprocessing.connection import Listener, Client
+import os
+import threading
+import time
+
+from msgqueue.logs import info, debug, warning
+
+
+class HeartbeatConnection:
+    """Connection from a pacemaker to the local heartbeat agent
+
+    All the methods return False once the agent is not reachable anymore
+    """
+    def __init__(self, address):
+        self.address = address
+        self.lock = threading.Lock()
+        self.conn = None
+
+        try:
+            self.conn = Client(address, family='AF_UNIX')
+        except OSError as e:
+            warning(f'heartbeat agent `{address}` is not reachable: {e}')
+
+    @property
+    def alive(self):
+        return self.conn is not None
+
+    def _send(self, *msg):
+        if self.conn is None:
+            return False
+
+        with self.lock:
+            try:
+                self.conn.send(msg)
+                return True
+
+            except (OSError, EOFError) as e:
+                warning(f'heartbeat agent `{self.address}` disconnected: {e}')
+                self.conn = None
+                return False
+
+    def join(self, agent_id, lease):
+        """Hand over the agent heartbeat to the heartbeat agent"""
+        return self._send('join', agent_id, lease)
+
+    def ping(self):
+        """Check that the agent is still reachable"""
+        return self._send('ping')
+
+    def register(self, queue, uid):
+        """Ask the heartbeat agent to keep the lease of the message alive"""
+        return self._send('register', queue, uid)
+
+    def unregister(self, uid):
+        return self._send('unregister', uid)
+
+    def close(self):
+        if self._send('leave'):
+            self.conn.close()
+            self.conn = None
+
+
+class _Worker:
+    def __init__(self):
+        self.agent_id = None
+        self.lease = None
+        # message uid -> (queue, local time at which the lease expires)
+        self.messages = dict()
+
+
+class HeartbeatAgent:
+    """Coalesce the heartbeats of all the workers of a host
+
+    Parameters
+    ----------
+    uri: str
+        uri of the message queue the workers are using
+
+    database: str
+        database the workers are using
+
+    address: str
+        path of the Unix socket the workers connect to
+
+    interval: float
+        maximum time between two heartbeats, the interval is shortened to a third
+        of the shortest lease of the connected workers
+    """
+    def __init__(self, uri, database, address, interval=60):
+        from msgqueue.backends import new_client
+
+        self.client = new_client(uri, database, name='heartbeat-agent', log_capture=False)
+        self.address = address
+        self.max_interval = interval
+        self.workers = dict()
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        # wakes up the heartbeat loop when the interval changes
+        self.wakeup = threading.Event()
+        self.listener = None
+        self.accepting = None
+
+    @property
+    def interval(self):
+        with self.lock:
+            leases = [w.lease for w in self.workers.values() if w.lease]
+
+        if leases:
+            return min(self.max_interval, min(leases) / 3)
+
+        return self.max_interval
+
+    def start(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+        self.listener = Listener(self.address, family='AF_UNIX')
+        os.chmod(self.address, 0o600)
+
+        self.accepting = threading.Thread(target=self._accept, daemon=True)
+        self.accepting.start()
+        info(f'heartbeat agent listening on {self.address}')
+
+    def _accept(self):
+        while not self.stopped.is_set():
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                break
+
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        worker = _Worker()
+        with self.lock:
+            self.workers[conn] = worker
+
+        try:
+            while True:
+                cmd, *args = conn.recv()
+
+                if cmd == 'leave':
+                    break
+
+                self._process(worker, cmd, *args)
+
+        except (OSError, EOFError):
+            # the worker died, its leases are left to expire
+            debug(f'worker {worker.agent_id} disconnected')
+
+        finally:
+            with self.lock:
+                self.workers.pop(conn, None)
+            conn.close()
+
+    def _process(self, worker, cmd, *args):
+        with self.lock:
+            if cmd == 'join':
+                worker.agent_id, worker.lease = args
+                self.wakeup.set()
+
+            elif cmd == 'ping':
+                pass
+
+            elif cmd == 'register':
+                if worker.lease is None:
+                    warning('message registered before the worker joined, ignoring it')
+                    return
+
+                queue, uid = args
+                worker.messages[uid] = (queue, time.monotonic() + worker.lease)
+
+            elif cmd == 'unregister':
+                worker.messages.pop(args[0], None)
+
+            else:
+                warning(f'unknown heartbeat command `{cmd}`')
+
+    def update_heartbeat(self):
+        """Extend the leases that are about to expire and refresh all the agent heartbeats"""
+        now = time.monotonic()
+        margin = 2 * self.interval
+
+        # queue -> [(uid, agent, lease)]
+        expiring = defaultdict(list)
+        agents = []
+
+        with self.lock:
+            for worker in self.workers.values():
+                if worker.agent_id is not None:
+                    agents.append(worker.agent_id)
+
+                for uid, (queue, until) in worker.messages.items():
+                    if until - now < margin:
+                        expiring[queue].append((uid, worker.agent_id, worker.lease))
+                        worker.messages[uid] = (queue, now + worker.lease)
+
+        # one write per queue for all the workers of the node
+        for queue, leases in expiring.items():
+            self.client.extend_leases(queue, leases)
+
+        self.client.agent_heartbeat(agents)
+
+    def run(self):
+        self.start()
+
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+            if self.stopped.is_set():
+                break
+
+            try:
+                self.update_heartbeat()
+            except Exception as e:
+                warning(f'heartbeat failed: {e}')
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--uri', type=str, required=True)
+    parser.add_argument('--database', type=str, required=True)
+    parser.add_argument('--address', type=str, default='/tmp/msgqueue-heartbeat.sock')
+    parser.add_argument('--interval', type=float, default=60)
+    args = parser.parse_args()
+
+    agent = HeartbeatAgent(args.uri, args.database, args.address, args.interval)
+    try:
+        agent.run()
+    except KeyboardInterrupt:
+        agent.stop()
+
+
+if __name__ == '__main__':
+    main()
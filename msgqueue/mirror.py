@@ -0,0 +1,340 @@
+"""Local replica of the messages of the queues
+
+Dashboards call ``messages(name, namespace)`` over and over and download the whole queue each time.
+:class:`MonitorMirror` keeps an in-process table of the messages of each queue it is asked about
+and only downloads what changed since its last synchronization:
+
+* the messages inserted since the last message seen, using their ``time``
+* the messages read or actioned since the last change seen, using their ``read_time`` and ``actioned_time``
+* the messages being processed, fetched by uid, failures and requeues do not change a timestamp
+  and the messages missing from the result were removed
+* the number of messages of each namespace, from the monitor's ``stats``, a namespace with fewer messages
+  than the table lost unread or actioned messages (purge, TTL, ``clear``) and is downloaded again
+
+The mirror exposes the :class:`~msgqueue.backends.queue.QueueMonitor` API, the queries on the messages
+are answered from the table, the other methods are forwarded to the monitor.
+
+.. code-block:: python
+
+    from msgqueue.mirror import MonitorMirror
+
+    mirror = MonitorMirror(new_monitor(uri, database), max_staleness=1)
+
+    # the first call downloads the queue, the next ones only the deltas
+    mirror.messages('work', 'example')
+    mirror.unread_count('work', 'example')
+
+A namespace that had messages removed and as many inserted between two synchronizations keeps the same count,
+its removed messages are only noticed by the full reload done every ``reload_interval`` seconds.
+"""
+from collections import Counter
+import datetime
+import threading
+import time
+
+from msgqueue.backends.queue import QueueStats, ApproximateCount
+
+
+def _match(message, namespace=None, mtype=None):
+    if namespace is not None:
+        if isinstance(namespace, (list, tuple)):
+            if message.namespace not in namespace:
+                return False
+        elif message.namespace != namespace:
+            return False
+
+    if mtype is not None:
+        if isinstance(mtype, (list, tuple)):
+            return message.mtype in mtype
+        return message.mtype == mtype
+
+    return True
+
+
+def _track_changes(table, messages):
+    """Move the newest read or actioned time of `table` forward, the insert times are a lower bound"""
+    times = [t for m in messages for t in (m.read_time, m.actioned_time) if t is not None]
+    times.extend(t for t in (table.last_change, table.last_time) if t is not None)
+    table.last_change = max(times, default=None)
+
+
+class _Table:
+    """Messages of a queue as of its last synchronization"""
+    def __init__(self):
+        self.lock = threading.RLock()
+        # uid -> Message
+        self.messages = dict()
+        # uids of the messages read but not actioned
+        self.inflight = set()
+        # time of the newest message seen
+        self.last_time = None
+        # newest read or actioned time seen
+        self.last_change = None
+        self.synced_at = None
+        self.loaded_at = None
+
+
+class MonitorMirror:
+    """Monitor answering the queries on the messages from a local replica kept up to date incrementally
+
+    Parameters
+    ----------
+    monitor: QueueMonitor
+        monitor the messages are downloaded from
+
+    max_staleness: float
+        time in seconds after which a query synchronizes the queue before being answered
+
+    reload_interval: float
+        time in seconds after which the queue is downloaded again in full, None to never reload
+
+    lag: float
+        the inserts are fetched from `lag` seconds before the newest message seen, messages are timestamped
+        when they are inserted but might become visible later than newer ones
+
+    clock: Callable[[], float]
+        time source of the synchronizations
+    """
+    def __init__(self, monitor, max_staleness=1, reload_interval=600, lag=5, clock=time.monotonic):
+        self.monitor = monitor
+        self.max_staleness = max_staleness
+        self.reload_interval = reload_interval
+        self.lag = datetime.timedelta(seconds=lag)
+        self.clock = clock
+        self.lock = threading.Lock()
+        # queue -> _Table
+        self.tables = dict()
+        # number of messages downloaded
+        self.fetched = 0
+
+    def _table(self, queue):
+        with self.lock:
+            table = self.tables.get(queue)
+
+            if table is None:
+                table = _Table()
+                self.tables[queue] = table
+
+            return table
+
+    def _load(self, queue, table):
+        messages = self.monitor.messages(queue, None, limit=None)
+        self.fetched += len(messages)
+
+        table.messages = {m.uid: m for m in messages}
+        table.inflight = {m.uid for m in messages if m.read and not m.actioned}
+        table.last_time = max((m.time for m in messages), default=None)
+        table.last_change = None
+        _track_changes(table, messages)
+        table.loaded_at = self.clock()
+
+    def _update(self, queue, table):
+        since = None
+        if table.last_time is not None:
+            since = table.last_time - self.lag
+
+        inserted = self.monitor.messages(queue, None, limit=None, time=since)
+        changed = {m.uid: m for m in inserted}
+
+        # without a previous message all the messages were just downloaded
+        if table.last_change is not None:
+            changed.update(
+                (m.uid, m) for m in self.monitor.changed_messages(queue, table.last_change - self.lag))
+
+        # failed, requeued or removed since the last synchronization
+        processing = table.inflight - set(changed)
+        if processing:
+            changed.update((m.uid, m) for m in self.monitor.messages_by_uid(queue, list(processing)))
+
+        self.fetched += len(changed)
+
+        for uid in processing - set(changed):
+            table.messages.pop(uid, None)
+            table.inflight.discard(uid)
+
+        table.messages.update(changed)
+        for uid, message in changed.items():
+            if message.read and not message.actioned:
+                table.inflight.add(uid)
+            else:
+                table.inflight.discard(uid)
+
+        times = [m.time for m in inserted]
+        if table.last_time is not None:
+            times.append(table.last_time)
+
+        table.last_time = max(times, default=None)
+        _track_changes(table, changed.values())
+        self._remove_deleted(queue, table)
+
+    def _remove_deleted(self, queue, table):
+        """Download again the namespaces that have fewer messages in the queue than in the table"""
+        counts = {s.namespace: s.unread + s.read for s in self.monitor.stats([queue])}
+        mirrored = Counter(m.namespace for m in table.messages.values())
+
+        for namespace, count in mirrored.items():
+            if count <= counts.get(namespace, 0):
+                continue
+
+            messages = self.monitor.messages(queue, namespace, limit=None)
+            self.fetched += len(messages)
+
+            kept = {m.uid for m in messages}
+            removed = [uid for uid, m in table.messages.items() if m.namespace == namespace and uid not in kept]
+
+            for uid in removed:
+                table.messages.pop(uid)
+                table.inflight.discard(uid)
+
+    def sync(self, queue, force=False):
+        """Bring the replica of `queue` up to date, returns its table"""
+        table = self._table(queue)
+
+        with table.lock:
+            now = self.clock()
+
+            if not force and table.synced_at is not None and now - table.synced_at < self.max_staleness:
+                return table
+
+            reload = self.reload_interval is not None and now - (table.loaded_at or 0) > self.reload_interval
+            if table.loaded_at is None or reload:
+                self._load(queue, table)
+            else:
+                self._update(queue, table)
+
+            table.synced_at = self.clock()
+            return table
+
+    def invalidate(self, queue=None):
+        """Download `queue` in full on its next query, None for all the queues"""
+        with self.lock:
+            if queue is None:
+                self.tables.clear()
+            else:
+                self.tables.pop(queue, None)
+
+    def _select(self, queue, namespace, mtype=None, condition=None):
+        table = self.sync(queue)
+
+        with table.lock:
+            return [
+                m for m in table.messages.values()
+                if _match(m, namespace, mtype) and (condition is None or condition(m))
+            ]
+
+    def _count(self, queue, namespace, mtype, condition, approximate):
+        count = len(self._select(queue, namespace, mtype, condition))
+        return ApproximateCount(count) if approximate else count
+
+    def messages(self, name, namespace, limit=None, mtype=None, time=None):
+        if isinstance(name, list):
+            data = []
+            for n in name:
+                data.extend(self.messages(n, namespace, limit, mtype, time))
+            return data
+
+        messages = self._select(name, namespace, mtype, lambda m: time is None or m.time > time)
+        return messages[:limit] if limit is not None else messages
+
+    def unread_messages(self, name, namespace, mtype=None):
+        return self._select(name, namespace, mtype, lambda m: not m.read)
+
+    def unactioned_messages(self, name, namespace, mtype=None):
+        return self._select(name, namespace, mtype, lambda m: m.read and not m.actioned)
+
+    def failed_messages(self, queue, namespace):
+        return self._select(queue, namespace, None, lambda m: m.read and not m.actioned and m.error is not None)
+
+    def lost_messages(self, queue, namespace, timeout_s=120):
+        now = datetime.datetime.utcnow()
+        return self._select(
+            queue, namespace, None,
+            lambda m: m.read and not m.actioned and m.lease_until is not None and m.lease_until < now)
+
+    def expired_messages(self, queue, namespace, mtype=None):
+        now = datetime.datetime.utcnow()
+        return self._select(
+            queue, namespace, mtype,
+            lambda m: not m.read and m.expire_time is not None and m.expire_time <= now)
+
+    def agent_messages(self, queue, agent=None):
+        agent = getattr(agent, 'uid', agent)
+        return self._select(
+            queue, None, None,
+            lambda m: m.read and not m.actioned and m.agent is not None and (agent is None or m.agent == agent))
+
+    def unread_count(self, name, namespace, mtype=None, approximate=False):
+        return self._count(name, namespace, mtype, lambda m: not m.read, approximate)
+
+    def unactioned_count(self, name, namespace, mtype=None, approximate=False):
+        return self._count(name, namespace, mtype, lambda m: m.read and not m.actioned, approximate)
+
+    def read_count(self, name, namespace, mtype=None, approximate=False):
+        return self._count(name, namespace, mtype, lambda m: m.read, approximate)
+
+    def actioned_count(self, name, namespace, mtype=None, approximate=False):
+        return self._count(name, namespace, mtype, lambda m: m.actioned, approximate)
+
+    def expired_count(self, queue, namespace, mtype=None, approximate=False):
+        count = len(self.expired_messages(queue, namespace, mtype))
+        return ApproximateCount(count) if approximate else count
+
+    def active_namespaces(self, queue, mtype=None):
+        return list(set(m.namespace for m in self.unread_messages(queue, None, mtype)))
+
+    def stats(self, queues=None, namespaces=None):
+        """See `~msgqueue.backends.queue.QueueMonitor`, without `queues` only the mirrored queues are reported"""
+        if queues is None:
+            queues = list(self.tables)
+
+        now = datetime.datetime.utcnow()
+        results = []
+
+        for queue in queues:
+            stats = dict()
+
+            for m in self._select(queue, namespaces):
+                s = stats.get(m.namespace)
+                if s is None:
+                    s = stats[m.namespace] = QueueStats(queue, m.namespace)
+
+                if not m.read:
+                    s.unread += 1
+                    s.oldest_unread = max(s.oldest_unread, (now - m.time).total_seconds())
+                    continue
+
+                s.read += 1
+                if m.actioned:
+                    s.actioned += 1
+                    continue
+
+                s.unactioned += 1
+                s.failed += m.error is not None
+                s.lost += m.lease_until is not None and m.lease_until < now
+
+            results.extend(stats.values())
+
+        return results
+
+    def _mutate(self, method, queue, args, kwargs):
+        try:
+            return getattr(self.monitor, method)(*args, **kwargs)
+        finally:
+            # the changes to the pending messages are picked up by the next synchronization
+            # but removed messages are only noticed by a full reload
+            self.invalidate(queue)
+
+    def clear(self, name, namespace):
+        return self._mutate('clear', name, (name, namespace), dict())
+
+    def archive(self, namespace, archive_name, namespace_out=None, format='json'):
+        return self._mutate('archive', None, (namespace, archive_name, namespace_out, format), dict())
+
+    def purge_expired_messages(self, queue, namespace, batch_size=1000):
+        return self._mutate('purge_expired_messages', queue, (queue, namespace, batch_size), dict())
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+
+        return getattr(self.monitor, item)
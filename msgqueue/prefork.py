@@ -0,0 +1,158 @@
+"""Prefork worker supervisor
+
+Heavy imports (torch, pandas, the handlers) are done once in the supervisor,
+the workers are then forked from it so they start warm.
+Database connections cannot be shared across a fork, each child creates its own worker
+and therefore its own client after the fork.
+
+Children that crash are restarted, children can also be recycled after a number of messages
+to bound their memory growth.
+
+.. code-block:: python
+
+    from msgqueue.prefork import PreforkSupervisor
+
+    def make_worker(index):
+        return WorkerReceiver(uri, 'example', index)
+
+    supervisor = PreforkSupervisor(make_worker, workers=8, max_messages=1000, preload=['torch', 'myproject.handlers'])
+    supervisor.run()
+"""
+import importlib
+import os
+import signal
+import threading
+import time
+import traceback
+
+from msgqueue.logs import info, warning, error
+
+# exit code of a child that stopped after `max_messages` and should be replaced
+RECYCLE_EXIT = 3
+
+
+class PreforkSupervisor:
+    """Fork warm worker processes and keep them running
+
+    Parameters
+    ----------
+    worker_factory: Callable[[int], BaseWorker]
+        create the worker of a child, it is called after the fork with the index of the child
+
+    workers: int
+        number of children to keep running
+
+    max_messages: int
+        number of messages after which a child is replaced by a fresh one, None to never recycle
+
+    preload: List[str]
+        modules to import in the supervisor before forking
+
+    restart_delay: float
+        time in seconds to wait before restarting a child that crashed
+    """
+    def __init__(self, worker_factory, workers=4, max_messages=None, preload=(), restart_delay=1):
+        self.worker_factory = worker_factory
+        self.workers = workers
+        self.max_messages = max_messages
+        self.preload = list(preload)
+        self.restart_delay = restart_delay
+        self.stopped = threading.Event()
+        # pid -> index of the child
+        self.children = dict()
+        self.restarts = 0
+        self.recycles = 0
+
+    def _fork(self, index):
+        pid = os.fork()
+
+        if pid != 0:
+            self.children[pid] = index
+            return pid
+
+        # child
+        code = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+            worker = self.worker_factory(index)
+            worker.max_messages = self.max_messages
+            worker.run()
+
+            code = RECYCLE_EXIT if worker.recycled else 0
+        except BaseException:
+            error(traceback.format_exc())
+        finally:
+            os._exit(code)
+
+    def start(self):
+        for module in self.preload:
+            importlib.import_module(module)
+
+        for index in range(self.workers):
+            self._fork(index)
+
+        info(f'started {self.workers} workers')
+
+    def _wait_child(self):
+        """Reap one child and restart it if needed, returns False if no child exited"""
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            # the children were reaped by someone else
+            self.children.clear()
+            return False
+
+        if pid == 0:
+            return False
+
+        index = self.children.pop(pid, None)
+        if index is None:
+            return True
+
+        code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+        if self.stopped.is_set():
+            return True
+
+        if code == RECYCLE_EXIT:
+            self.recycles += 1
+            info(f'recycling worker {index}')
+            self._fork(index)
+
+        elif code != 0:
+            self.restarts += 1
+            warning(f'worker {index} died with {code}, restarting it')
+            time.sleep(self.restart_delay)
+            self._fork(index)
+
+        # children that exit with 0 were shutdown or timed out and are not replaced
+        return True
+
+    def run(self):
+        """Start the children and supervise them until they all shutdown or the supervisor is stopped"""
+        self.start()
+
+        try:
+            while self.children and not self.stopped.is_set():
+                if not self._wait_child():
+                    time.sleep(0.1)
+
+        finally:
+            self.stop()
+
+    def stop(self, timeout=30):
+        """Terminate the children and wait for them to exit"""
+        self.stopped.set()
+
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        start = time.time()
+        while self.children and time.time() - start < timeout:
+            if not self._wait_child():
+                time.sleep(0.1)
@@ -0,0 +1,134 @@
+"""Queue maintenance service
+
+Requeue the failed and lost messages and remove the expired messages of all the queues of a database
+on a schedule so workers do not have to do it in their main loop.
+When the uri enables the `counters` option, the counters of the queues are reconciled after each sweep.
+
+Many reapers can be started for redundancy, they elect a leader through a lease stored in the database
+and only the leader does the sweeps. If the leader dies, its lease expires and another reaper takes over.
+
+.. code-block:: bash
+
+    python -m msgqueue.reaper --uri cockroach://192.168.0.10:8123 --database db --interval 60
+
+Workers started while a reaper holds the lease skip the maintenance by themselves,
+it can also be turned off explicitly:
+
+.. code-block:: python
+
+    worker.maintenance = False
+"""
+import os
+import socket
+import threading
+from uuid import uuid4
+
+from msgqueue.logs import info, warning
+from msgqueue.backends import new_monitor
+
+
+class Reaper:
+    """Sweep the queues of a database when it is the leader
+
+    Parameters
+    ----------
+    uri: str
+        uri of the message queue
+
+    database: str
+        database to sweep
+
+    interval: float
+        time in seconds between two sweeps
+
+    lease: float
+        time after which the leadership is lost if the reaper stops renewing it (default: 3 * interval)
+
+    max_retry: int
+        number of times a failed or lost message is requeued before being left alone
+
+    name: str
+        name of the leader lease, reapers with the same name compete for the same leadership
+    """
+    def __init__(self, uri, database, interval=60, lease=None, max_retry=3, name='reaper'):
+        self.monitor = new_monitor(uri, database)
+        self.interval = interval
+        self.lease = lease or 3 * interval
+        self.max_retry = max_retry
+        self.name = name
+        self.holder = f'{socket.gethostname()}-{os.getpid()}-{uuid4().hex[:8]}'
+        self.stopped = threading.Event()
+        self.leader = False
+
+    def sweep(self, queue):
+        """Requeue the failed and lost messages of a queue and remove the expired ones for all namespaces,
+        then fix the usage of its quotas and its counters"""
+        failed = self.monitor.requeue_failed_messages(queue, None, max_retry=self.max_retry)
+        lost = self.monitor.requeue_lost_messages(queue, None, max_retry=self.max_retry)
+        expired = self.monitor.purge_expired_messages(queue, None)
+        self.monitor.reconcile_quotas(queue)
+
+        if self.monitor.use_counters:
+            self.monitor.reconcile_counters(queue)
+
+        if failed or lost or expired:
+            info(f'{queue}: requeued {failed} failed and {lost} lost messages, removed {expired} expired messages')
+
+        return failed, lost, expired
+
+    def step(self):
+        """Sweep all the queues if this reaper is the leader, returns True if it was"""
+        leader = self.monitor.acquire_leader(self.name, self.holder, self.lease)
+
+        if leader != self.leader:
+            info(f'{self.holder} {"is now" if leader else "is not"} the {self.name} leader')
+            self.leader = leader
+
+        if not leader:
+            return False
+
+        for queue in self.monitor.queues():
+            self.sweep(queue)
+
+        return True
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                try:
+                    self.step()
+                except Exception as e:
+                    warning(f'sweep failed: {e}')
+
+                self.stopped.wait(self.interval)
+
+        finally:
+            # let another reaper take over right away
+            if self.leader:
+                self.monitor.release_leader(self.name, self.holder)
+                self.leader = False
+
+    def stop(self):
+        self.stopped.set()
+
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--uri', type=str, required=True)
+    parser.add_argument('--database', type=str, required=True)
+    parser.add_argument('--interval', type=float, default=60)
+    parser.add_argument('--lease', type=float, default=None)
+    parser.add_argument('--max-retry', type=int, default=3)
+    args = parser.parse_args()
+
+    reaper = Reaper(args.uri, args.database, args.interval, args.lease, args.max_retry)
+    try:
+        reaper.run()
+    except KeyboardInterrupt:
+        reaper.stop()
+
+
+if __name__ == '__main__':
+    main()
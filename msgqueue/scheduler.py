@@ -0,0 +1,63 @@
+import time
+from typing import Dict, List
+
+
+class DeficitRoundRobin:
+    """Share the work between queues proportionally to their weights
+
+    Every round each queue earns a credit equal to its weight, serving a message costs one credit.
+    Queues are tried in decreasing credit order so a queue with no message to serve does not block the others,
+    and a queue that is found empty loses its credit so it cannot hoard service while idle.
+
+    Parameters
+    ----------
+    weights: Dict[str, float]
+        relative weight of each queue i.e ``{'fast': 3, 'slow': 1}``
+
+    Examples
+    --------
+    >>> scheduler = DeficitRoundRobin({'a': 2, 'b': 1})
+    >>> order = scheduler.order()
+    >>> order
+    ['a', 'b']
+    >>> scheduler.update(order, 'a')
+    """
+    def __init__(self, weights: Dict[str, float]):
+        self.weights = dict()
+        self.deficits = dict()
+        self.served = dict()
+        self.start = time.time()
+        self.set_weights(weights)
+
+    def set_weights(self, weights: Dict[str, float]):
+        """Change the queues and their weights, the queues that are kept keep their credit"""
+        smallest = min(weights.values())
+        self.weights = {queue: weight / smallest for queue, weight in weights.items()}
+        self.deficits = {queue: self.deficits.get(queue, 0.0) for queue in weights}
+        self.served = {queue: self.served.get(queue, 0) for queue in weights}
+
+    def order(self) -> List[str]:
+        """Return the queues in the order they should be tried"""
+        if all(deficit < 1 for deficit in self.deficits.values()):
+            for queue, weight in self.weights.items():
+                self.deficits[queue] += weight
+
+        return sorted(self.weights, key=lambda q: self.deficits[q], reverse=True)
+
+    def update(self, order: List[str], queue: str = None):
+        """Record that `queue` was served after trying the queues of `order`, None if all the queues were empty"""
+        for q in order:
+            if q == queue:
+                break
+
+            # queues tried before were empty
+            self.deficits[q] = 0
+
+        if queue is not None:
+            self.deficits[queue] -= 1
+            self.served[queue] += 1
+
+    def rates(self) -> Dict[str, float]:
+        """Return the number of messages served per second for each queue"""
+        elapsed = max(time.time() - self.start, 1e-9)
+        return {queue: count / elapsed for queue, count in self.served.items()}
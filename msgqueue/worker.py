@@ -1,11 +1,12 @@
 import traceback
 import time
 from dataclasses import dataclass
-from typing import Dict
+from typing import Dict, Set
 
 from msgqueue.logs import error, info, warning
+from msgqueue.scheduler import DeficitRoundRobin
 from msgqueue.backends import new_client
-from msgqueue.backends.queue import MessageQueue, Message, ActionRecord, RecordQueue
+from msgqueue.backends.queue import MessageQueue, Message, ActionRecord, RecordQueue, unwrap_rpc
 
 WORK_QUEUE = 'work'
 RESULT_QUEUE = 'result'
@@ -23,7 +24,8 @@ class BaseWorker:
     Parameters
     ----------
     namespaced: bool
-        if true prevent worker form picking up work from other queues
+        if true prevent worker form picking up work from other queues,
+        otherwise the oldest message of any namespace is picked up unless the client uses the `fair` option
 
     timeout: int
         time without message after which the worker will shutdown by itself
@@ -33,7 +35,30 @@ class BaseWorker:
 
     result_queue: str
         Name of the queue where the result are placed
+
+    maintenance: bool
+        if true the worker requeues the failed and lost messages itself before each work item.
+        None (default) decides when the worker starts, the maintenance is skipped if a
+        :class:`~msgqueue.reaper.Reaper` named `reaper_name` holds the leader lease of the database
+
+    work_stealing: bool
+        if true a namespaced worker with no work in its namespace takes work from the most backlogged namespace,
+        it goes back to its own namespace as soon as work appears there
+
+    steal_from: Set[str]
+        namespaces work can be stolen from, None for all the namespaces
+
+    max_messages: int
+        number of work items after which the worker stops to bound its memory growth,
+        None for no limit (see :class:`~msgqueue.prefork.PreforkSupervisor`)
     """
+
+    # time in seconds between two refreshes of the backlog of the other namespaces when stealing work
+    steal_refresh = 5
+
+    # name of the leader lease of the reaper doing the maintenance for the workers
+    reaper_name = 'reaper'
+
     def __init__(self, queue_uri, database, namespace, worker_id, work_queue, result_queue=None):
         self.uri = queue_uri
         self.namespace = namespace
@@ -48,6 +73,15 @@ class BaseWorker:
         self.namespaced = True
         self.timeout = 5 * 60
         self.max_retry = 3
+        self.maintenance = None
+        self.work_stealing = False
+        self.steal_from = None
+        self.max_messages = None
+        self.processed = 0
+        self.backlogs = dict()
+        self.backlogs_time = 0
+        # mtype -> (batch_size, max_wait)
+        self.batching = dict()
         self.dispatcher = {
             SHUTDOWN: self.shutdown_worker
         }
@@ -64,9 +98,32 @@ class BaseWorker:
     def ignore_message(self, message: Message, context: Dict):
         pass
 
-    def new_handler(self, message_type, handler):
+    def new_handler(self, message_type, handler, batch_size=1, max_wait=0):
+        """Register the handler of a message type
+
+        Parameters
+        ----------
+        message_type: int
+            type of the messages processed by the handler
+
+        handler: Callable
+            ``handler(message, context)`` returning the result of the message.
+            When ``batch_size > 1`` it is called with a list of messages and returns a list of results,
+            one per message, a result that is an exception marks its message as failed
+
+        batch_size: int
+            maximum number of messages processed in a single call
+
+        max_wait: float
+            time in seconds to wait for a batch to fill up before processing a partial batch
+        """
         self.dispatcher[message_type] = handler
 
+        if batch_size > 1:
+            self.batching[message_type] = (batch_size, max_wait)
+        else:
+            self.batching.pop(message_type, None)
+
     def pop_workitem(self):
         workitem = None
         wait_time = 0
@@ -79,6 +136,9 @@ class BaseWorker:
                 self.work_queue, namespace,
                 mtype=list(self.dispatcher.keys()))
 
+            if workitem is None and namespace is not None and self.work_stealing:
+                workitem = self.steal_workitem()
+
             if workitem is None:
                 time.sleep(0.01)
                 wait_time += 0.01
@@ -89,6 +149,35 @@ class BaseWorker:
 
         return workitem
 
+    @property
+    def recycled(self):
+        """True if the worker processed `max_messages` work items and should be replaced"""
+        return self.max_messages is not None and self.processed >= self.max_messages
+
+    def steal_workitem(self):
+        """Pop a work item from the compatible namespace with the largest backlog, None if there is nothing to steal"""
+        if time.time() - self.backlogs_time > self.steal_refresh:
+            stats = self.client.monitor().stats([self.work_queue], self.steal_from)
+
+            self.backlogs = {
+                s.namespace: s.unread for s in stats
+                if s.namespace != self.namespace and s.unread > 0}
+            self.backlogs_time = time.time()
+
+        while self.backlogs:
+            victim = max(self.backlogs, key=self.backlogs.get)
+            workitem = self.client.pop(self.work_queue, victim, mtype=list(self.dispatcher.keys()))
+
+            if workitem is not None:
+                self.backlogs[victim] -= 1
+                info(f'{self.client.name} stole a work item from {victim}')
+                return workitem
+
+            # the backlog was drained by other workers since the last refresh
+            self.backlogs.pop(victim)
+
+        return None
+
     def requeue(self, queue=None):
         if queue is None:
             queue = self.work_queue
@@ -105,6 +194,15 @@ class BaseWorker:
         self.client.monitor().requeue_lost_messages(
             queue, namespace, timeout_s=self.timeout, max_retry=self.max_retry)
 
+        expired = self.client.monitor().purge_expired_messages(queue, namespace)
+
+        if expired:
+            info(f'Removed {expired} expired messages from {queue}')
+
+    def reaper_running(self):
+        """True if a reaper holds the leader lease, it sweeps the queues on behalf of the workers"""
+        return self.client.monitor().leader(self.reaper_name) is not None
+
     def push_result(self, result, mtype=RESULT_ITEM, replying_to=None):
         uid = None
         namespace = self.namespace
@@ -113,7 +211,9 @@ class BaseWorker:
             uid = replying_to.uid
             namespace = replying_to.namespace
 
-        self.requeue(self.result_queue)
+        if self.maintenance:
+            self.requeue(self.result_queue)
+
         return self.client.push(
             self.result_queue,
             namespace,
@@ -124,13 +224,27 @@ class BaseWorker:
     def run(self):
         info('starting worker')
 
+        if self.maintenance is None:
+            self.maintenance = not self.reaper_running()
+
+            if not self.maintenance:
+                info(f'{self.reaper_name} is running, skipping the maintenance')
+            else:
+                warning('no reaper is running, the worker sweeps the queues before each work item, '
+                        'start a reaper and set `maintenance = False` to take the sweeps off the workers')
+
         self.running = True
         self.client.push(self.result_queue, self.namespace, {}, mtype=WORKER_JOIN)
 
         with self.client:
             while self.running:
+                if self.recycled:
+                    info(f'recycling worker after {self.processed} messages')
+                    break
+
                 # Check if messages were lost
-                self.requeue()
+                if self.maintenance:
+                    self.requeue()
 
                 # This code should not throw
                 workitem = self.pop_workitem()
@@ -138,6 +252,15 @@ class BaseWorker:
                 if workitem is None:
                     continue
 
+                if workitem.mtype in self.batching:
+                    batch = self.gather_batch(workitem)
+                    self.processed += len(batch)
+                    self.process_batch(batch)
+                    continue
+
+                self.processed += 1
+                rpc_queue = unwrap_rpc(workitem)
+
                 handler = self.dispatcher.get(workitem.mtype, self.unregistered_workitem)
 
                 namespace = self.client.heartbeat_monitor.message.namespace
@@ -150,11 +273,19 @@ class BaseWorker:
 
                     if isinstance(result, ActionRecord):
                         ops = RecordQueue(history=result)
+
+                        # the handler returned operations instead of a value, the caller is still waiting
+                        if rpc_queue is not None:
+                            ops.rpc_reply(rpc_queue, workitem)
+
                         ops.mark_actioned(self.work_queue, workitem)
                         ops.execute(self.client)
                         continue
 
-                    if self.result_queue is not None and result is not None:
+                    if rpc_queue is not None:
+                        self.client.rpc_reply(rpc_queue, workitem, result)
+
+                    elif self.result_queue is not None and result is not None:
                         self.push_result(result, replying_to=workitem)
 
                     self.client.mark_actioned(self.work_queue, workitem)
@@ -168,6 +299,147 @@ class BaseWorker:
                     error_str = traceback.format_exc()
                     error(error_str)
                     self.client.mark_error(self.work_queue, workitem, error_str)
+                    self.reply_error(rpc_queue, workitem, error_str)
 
             # --
             self.client.push(self.result_queue, self.namespace, {}, mtype=WORKER_LEFT)
+
+    def reply_error(self, rpc_queue, workitem, error_str):
+        """Send the error of a failed call to its caller once the message will not be retried anymore,
+        until then the caller keeps waiting for the result of a retry"""
+        if rpc_queue is not None and workitem.retry >= self.max_retry:
+            self.client.rpc_reply(rpc_queue, workitem, error=error_str)
+
+    def gather_batch(self, workitem):
+        """Pop messages of the same type as `workitem` until the batch is full or `max_wait` has elapsed"""
+        batch_size, max_wait = self.batching[workitem.mtype]
+        batch = [workitem]
+        start = time.time()
+
+        namespace = None
+        if self.namespaced:
+            namespace = self.namespace
+
+        while len(batch) < batch_size:
+            msg = self.client.pop(self.work_queue, namespace, mtype=workitem.mtype)
+
+            if msg is not None:
+                batch.append(msg)
+                continue
+
+            if time.time() - start >= max_wait:
+                break
+
+            time.sleep(0.01)
+
+        return batch
+
+    def process_batch(self, batch):
+        """Call the handler once for the whole batch, then ack, fail or reply to each message from its result"""
+        handler = self.dispatcher[batch[0].mtype]
+        rpc_queues = [unwrap_rpc(workitem) for workitem in batch]
+
+        self.context['namespace'] = batch[0].namespace
+        self.context['client'] = self.client
+
+        try:
+            results = handler(batch, self.context)
+
+            if results is None:
+                results = [None] * len(batch)
+
+            if len(results) != len(batch):
+                raise RuntimeError(f'handler returned {len(results)} results for {len(batch)} messages')
+
+        except KeyboardInterrupt:
+            info('Task interrupted')
+            for workitem in batch:
+                self.client.mark_error(self.work_queue, workitem, 'interrupted by KeyboardInterrupt')
+            self.client.push(self.result_queue, self.namespace, {}, mtype=WORKER_LEFT)
+            raise
+
+        except Exception:
+            error_str = traceback.format_exc()
+            error(error_str)
+            for workitem, rpc_queue in zip(batch, rpc_queues):
+                self.client.mark_error(self.work_queue, workitem, error_str)
+                self.reply_error(rpc_queue, workitem, error_str)
+            return
+
+        if self.result_queue is not None and self.maintenance:
+            self.requeue(self.result_queue)
+
+        actioned = []
+        for workitem, rpc_queue, result in zip(batch, rpc_queues, results):
+            if isinstance(result, Exception):
+                error(f'{workitem.uid} failed: {result}')
+                self.client.mark_error(self.work_queue, workitem, repr(result))
+                self.reply_error(rpc_queue, workitem, repr(result))
+                continue
+
+            if rpc_queue is not None:
+                self.client.rpc_reply(rpc_queue, workitem, result)
+
+            elif self.result_queue is not None and result is not None:
+                self.client.push(
+                    self.result_queue, workitem.namespace, result, mtype=RESULT_ITEM, replying_to=workitem.uid)
+
+            actioned.append(workitem)
+
+        if actioned:
+            self.client.mark_actioned_all(self.work_queue, actioned)
+
+
+class MultiQueueWorker(BaseWorker):
+    """Worker pulling work items from several queues, sharing its time between them according to their weights
+
+    Queues are served with deficit round robin (see :class:`~msgqueue.scheduler.DeficitRoundRobin`),
+    when a queue is empty its share goes to the other queues so the worker is never idle while there is work.
+
+    Parameters
+    ----------
+    work_queues: Dict[str, float]
+        queues to pull work items from with their weights i.e ``{'fast': 3, 'slow': 1}``
+    """
+    def __init__(self, queue_uri, database, namespace, worker_id, work_queues: Dict[str, float], result_queue=None):
+        self.work_queues = dict(work_queues)
+        self.scheduler = DeficitRoundRobin(self.work_queues)
+
+        # work_queue is the queue of the work item being processed
+        super(MultiQueueWorker, self).__init__(
+            queue_uri, database, namespace, worker_id, next(iter(self.work_queues)), result_queue)
+
+    def pop_workitem(self):
+        workitem = None
+        wait_time = 0
+        namespace = None
+        if self.namespaced:
+            namespace = self.namespace
+
+        while workitem is None:
+            order = self.scheduler.order()
+            queue, workitem = self.client.dequeue_any(order, namespace, mtype=list(self.dispatcher.keys()))
+            self.scheduler.update(order, queue)
+
+            if workitem is None:
+                time.sleep(0.01)
+                wait_time += 0.01
+            else:
+                self.work_queue = queue
+
+            if wait_time > self.timeout:
+                self.shutdown_worker(None, None)
+                break
+
+        return workitem
+
+    def requeue(self, queue=None):
+        if queue is not None:
+            return super(MultiQueueWorker, self).requeue(queue)
+
+        for queue in self.work_queues:
+            super(MultiQueueWorker, self).requeue(queue)
+
+    def service_rates(self) -> Dict[str, float]:
+        """Return the number of work items pulled per second from each queue"""
+        return self.scheduler.rates()
@@ -26,6 +26,7 @@ if __name__ == '__main__':
             'msgqueue.backends',
             'msgqueue.backends.cockroach',
             'msgqueue.backends.mongo',
+            'msgqueue.backends.local',
         ],
         data_files=data,
         setup_requires=['setuptools'],
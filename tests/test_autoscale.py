@@ -0,0 +1,62 @@
+import time
+from multiprocessing import Process
+
+import pytest
+
+from msgqueue.logs import set_verbose_level
+from msgqueue.backends import known_backends
+from msgqueue.autoscale import Autoscaler
+from msgqueue.worker import BaseWorker, WORK_ITEM
+
+from tests.test_client import Environment, DATABASE
+
+set_verbose_level(10)
+backends = known_backends()
+
+NAMESPACE = 'TESTNAME'
+QUEUE = 'TESTWORK'
+
+
+class SlowWorker(BaseWorker):
+    def __init__(self, uri, worker_id):
+        super(SlowWorker, self).__init__(uri, DATABASE, NAMESPACE, worker_id, QUEUE)
+        self.new_handler(WORK_ITEM, self.do_work)
+
+    def do_work(self, message, context):
+        time.sleep(0.1)
+
+
+def run_worker(uri, worker_id):
+    SlowWorker(uri, worker_id).run()
+
+
+def spawn_worker(uri, worker_id):
+    p = Process(target=run_worker, args=(uri, worker_id))
+    p.start()
+    return p
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_autoscaler(backend):
+    with Environment(backend) as env:
+        for i in range(0, 20):
+            env.client.push(QUEUE, NAMESPACE, {'i': i}, WORK_ITEM)
+
+        scaler = Autoscaler(
+            env.uri, DATABASE, QUEUE, NAMESPACE, spawn=lambda i: spawn_worker(env.uri, i),
+            min_workers=1, max_workers=3, target_backlog=5, cooldown=0)
+
+        # the backlog needs more workers than allowed
+        assert scaler.step() == 3
+        assert len(scaler.workers) == 3
+
+        while env.monitor.unread_count(QUEUE, NAMESPACE) > 0:
+            time.sleep(0.1)
+
+        # the backlog is gone, the extra workers are drained
+        assert scaler.step() == -2
+        assert scaler.draining == 2
+
+        scaler.shutdown(timeout=30)
+        assert scaler.workers == []
+        assert env.monitor.actioned_count(QUEUE, NAMESPACE, WORK_ITEM) == 20
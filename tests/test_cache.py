@@ -0,0 +1,148 @@
+import threading
+import time
+
+import pytest
+
+from msgqueue.backends.queue import QueueMonitor
+from msgqueue.cache import CachedMonitor
+
+
+class CountingMonitor(QueueMonitor):
+    """Monitor recording the queries it receives"""
+    def __init__(self, delay=0):
+        super(CountingMonitor, self).__init__(None, 'db')
+        self.calls = []
+        self.unread = 10
+        self.delay = delay
+
+    def unread_count(self, name, namespace, mtype=None, approximate=False):
+        self.calls.append(('unread_count', name, namespace))
+        time.sleep(self.delay)
+
+        if namespace == 'error':
+            raise RuntimeError('query failed')
+
+        return self.unread
+
+    def stats(self, queues=None, namespaces=None):
+        self.calls.append(('stats', queues))
+        return []
+
+    def requeue_failed_messages(self, queue, namespace, max_retry=3):
+        self.calls.append(('requeue_failed_messages', queue))
+        self.unread += 1
+        return 1
+
+    def agent_count(self):
+        self.calls.append(('agent_count',))
+        return 0
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl():
+    clock = Clock()
+    monitor = CountingMonitor()
+    cache = CachedMonitor(monitor, ttls={'unread_count': 2}, clock=clock)
+
+    assert cache.unread_count('q', 'a') == 10
+    monitor.unread = 20
+    assert cache.unread_count('q', 'a') == 10
+    assert len(monitor.calls) == 1
+
+    # different arguments are cached separately
+    assert cache.unread_count('q', 'b') == 20
+
+    clock.now = 3
+    assert cache.unread_count('q', 'a') == 20
+    assert len(monitor.calls) == 3
+    assert (cache.hits, cache.misses) == (1, 3)
+
+    # methods without a time to live are not cached
+    cache.agent_count()
+    cache.agent_count()
+    assert len(monitor.calls) == 5
+
+
+def test_single_flight():
+    monitor = CountingMonitor(delay=0.2)
+    cache = CachedMonitor(monitor)
+    results = []
+
+    threads = [threading.Thread(target=lambda: results.append(cache.unread_count('q', 'a'))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results == [10] * 8
+    assert len(monitor.calls) == 1, 'concurrent calls are coalesced into one query'
+
+
+def test_single_flight_error():
+    monitor = CountingMonitor(delay=0.2)
+    cache = CachedMonitor(monitor)
+    errors = []
+
+    def query():
+        try:
+            cache.unread_count('q', 'error')
+        except RuntimeError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=query) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(errors) == 4
+    assert len(monitor.calls) == 1
+
+    # errors are not cached
+    with pytest.raises(RuntimeError):
+        cache.unread_count('q', 'error')
+    assert len(monitor.calls) == 2
+
+
+def test_lru():
+    monitor = CountingMonitor()
+    cache = CachedMonitor(monitor, max_entries=2)
+
+    cache.unread_count('q', 'a')
+    cache.unread_count('q', 'b')
+    cache.unread_count('q', 'a')
+    cache.unread_count('q', 'c')
+    assert len(cache) == 2
+
+    # b was the least recently used
+    cache.unread_count('q', 'a')
+    cache.unread_count('q', 'b')
+    assert [c[2] for c in monitor.calls] == ['a', 'b', 'c', 'b']
+
+
+def test_invalidate():
+    monitor = CountingMonitor()
+    cache = CachedMonitor(monitor)
+
+    cache.unread_count('q', 'a')
+    cache.unread_count('other', 'a')
+    cache.stats(['q'])
+
+    assert cache.requeue_failed_messages('q', 'a') == 1
+    assert cache.unread_count('q', 'a') == 11, 'mutations invalidate the results of the queue'
+    assert cache.unread_count('other', 'a') == 10
+    assert len(monitor.calls) == 5
+
+    cache.stats(['q'])
+    assert len(monitor.calls) == 6
+
+    cache.invalidate('unread_count')
+    cache.unread_count('other', 'a')
+    assert len(monitor.calls) == 7
@@ -0,0 +1,59 @@
+import pytest
+
+from msgqueue.logs import set_verbose_level
+from msgqueue.backends import known_backends
+from msgqueue.future import Future, FutureSet, gather, as_completed
+
+from tests.test_client import Environment
+
+set_verbose_level(10)
+backends = known_backends()
+
+NAMESPACE = 'TESTNAME'
+WORK_QUEUE = 'TESTWORK'
+RESULT_QUEUE = 'TESTRESULT'
+WORK_ITEM = 1
+RESULT_ITEM = 2
+
+
+def reply_to(client, uids):
+    for uid in uids:
+        client.push(RESULT_QUEUE, NAMESPACE, {'reply': str(uid)}, RESULT_ITEM, replying_to=uid)
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_future_set(backend):
+    with Environment(backend) as env:
+        client = env.client
+        uids = [client.push(WORK_QUEUE, NAMESPACE, {'i': i}, WORK_ITEM) for i in range(0, 20)]
+        futures = [Future(client, RESULT_QUEUE, uid) for uid in uids]
+
+        calls = []
+        get_reply = client.get_reply
+        client.get_reply = lambda *args: calls.append(args) or get_reply(*args)
+
+        future_set = FutureSet(client, RESULT_QUEUE, futures, chunk_size=8)
+        assert future_set.poll() == []
+
+        reply_to(client, uids[:10])
+        assert len(future_set.poll()) == 10
+        assert len(future_set) == 10
+
+        # one query per chunk of pending messages
+        assert len(calls) == 3 + 2
+
+        reply_to(client, uids[10:])
+        completed = list(as_completed(futures, timeout=10))
+        assert len(completed) == 20
+
+        assert gather(futures) == [{'reply': str(uid)} for uid in uids]
+        assert futures[0].wait(timeout=1) == {'reply': str(uids[0])}
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_future_timeout(backend):
+    with Environment(backend) as env:
+        uid = env.client.push(WORK_QUEUE, NAMESPACE, {'i': 0}, WORK_ITEM)
+
+        with pytest.raises(TimeoutError):
+            gather([Future(env.client, RESULT_QUEUE, uid)], timeout=0.1)
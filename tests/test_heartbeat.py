@@ -0,0 +1,76 @@
+import threading
+import time
+
+import pytest
+
+from msgqueue.logs import set_verbose_level
+from msgqueue.backends import known_backends, new_client
+from msgqueue.heartbeat import HeartbeatAgent, HeartbeatConnection
+
+from tests.test_client import Environment, DATABASE
+
+set_verbose_level(10)
+backends = known_backends()
+
+WORK_ITEM = 1
+
+NAMESPACE = 'TESTNAME'
+QUEUE = 'TESTQUEUE'
+
+
+def test_heartbeat_agent_unreachable(tmp_path):
+    conn = HeartbeatConnection(str(tmp_path / 'missing.sock'))
+
+    assert not conn.alive
+    assert not conn.register(QUEUE, 1)
+
+
+def test_heartbeat_agent_died(tmp_path):
+    from multiprocessing.connection import Listener
+
+    address = str(tmp_path / 'heartbeat.sock')
+    listener = Listener(address, family='AF_UNIX')
+
+    conn = HeartbeatConnection(address)
+    agent = listener.accept()
+    assert conn.ping()
+
+    # the pacemaker notices the agent is gone on its next ping and falls back to its own heartbeats
+    agent.close()
+    listener.close()
+    assert not conn.ping()
+    assert not conn.alive
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_heartbeat_agent(backend, tmp_path):
+    with Environment(backend) as env:
+        address = str(tmp_path / 'heartbeat.sock')
+
+        agent = HeartbeatAgent(env.uri, DATABASE, address)
+        thread = threading.Thread(target=agent.run, daemon=True)
+        thread.start()
+        time.sleep(0.5)
+
+        for i in range(0, 4):
+            env.client.push(QUEUE, NAMESPACE, {'i': i}, WORK_ITEM)
+
+        workers = [new_client(f'{env.uri}?lease=1&heartbeat={address}', DATABASE, f'worker-{i}') for i in range(0, 4)]
+
+        for worker in workers:
+            worker.__enter__()
+            assert worker.heartbeat_monitor.local_agent.alive
+            worker.pop(QUEUE, NAMESPACE)
+
+        # the agent keeps the leases of all the workers alive
+        time.sleep(3)
+        assert env.monitor.lost_messages(QUEUE, NAMESPACE) == []
+
+        for worker in workers:
+            worker.__exit__(None, None, None)
+
+        # workers left without acking their messages, the leases expire
+        time.sleep(2)
+        assert len(env.monitor.lost_messages(QUEUE, NAMESPACE)) == 4
+
+        agent.stop()
@@ -0,0 +1,34 @@
+import subprocess
+import sys
+
+HEAVY = ('pymongo', 'bson', 'psycopg2')
+
+
+def imported_modules(code):
+    """Run `code` in a fresh interpreter and return the heavy modules it imported"""
+    script = f'{code}\nimport sys\nprint(",".join(m for m in {HEAVY} if m in sys.modules))'
+    out = subprocess.check_output([sys.executable, '-c', script], text=True)
+    return set(filter(None, out.strip().split(',')))
+
+
+def test_import_does_not_load_backends():
+    assert imported_modules('import msgqueue') == set()
+
+
+def test_known_backends_does_not_load_backends():
+    assert imported_modules('from msgqueue.backends import known_backends; known_backends()') == set()
+
+
+def test_backend_loaded_on_first_use():
+    modules = imported_modules(
+        'from msgqueue.backends import _factory; _factory("mongo", "new_client")')
+
+    assert 'psycopg2' not in modules
+
+
+def test_main_accepts_module_name():
+    from msgqueue.backends import ALIASES, main_factory
+    from msgqueue.backends.local import start_server_main
+
+    assert ALIASES['local'] == 'local+mongo'
+    assert main_factory['local'] is start_server_main
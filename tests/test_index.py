@@ -0,0 +1,51 @@
+import pytest
+
+from msgqueue.logs import set_verbose_level
+from msgqueue.backends import known_backends
+
+from tests.test_client import Environment
+
+set_verbose_level(10)
+backends = known_backends()
+
+WORK_ITEM = 1
+RESULT_ITEM = 2
+
+NAMESPACE = 'TESTNAME'
+QUEUE = 'TESTQUEUE'
+
+
+def is_index_seek(backend, plan):
+    if backend.endswith('mongo'):
+        plan = str(plan['queryPlanner']['winningPlan'])
+        return 'IXSCAN' in plan and 'COLLSCAN' not in plan
+
+    return 'dequeue_index' in plan and 'FULL SCAN' not in plan
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_dequeue_index_seek(backend):
+    with Environment(backend) as env:
+        client = env.client
+
+        for i in range(0, 10):
+            client.push(QUEUE, NAMESPACE, {'i': i}, WORK_ITEM)
+
+        plan = client.explain_dequeue(QUEUE, NAMESPACE, WORK_ITEM)
+        assert is_index_seek(backend, plan)
+
+        plan = client.explain_dequeue(QUEUE, NAMESPACE, (WORK_ITEM, RESULT_ITEM))
+        assert is_index_seek(backend, plan)
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_upgrade_queues(backend):
+    with Environment(backend) as env:
+        client = env.client
+        client.push(QUEUE, NAMESPACE, {'i': 0}, WORK_ITEM)
+
+        assert env.server.upgrade_queues() == [QUEUE]
+
+        # upgrading twice is a no-op
+        assert env.server.upgrade_queues() == [QUEUE]
+        assert client.pop(QUEUE, NAMESPACE).message == {'i': 0}
@@ -0,0 +1,184 @@
+import dataclasses
+import datetime
+
+import pytest
+
+from msgqueue.backends import known_backends
+from msgqueue.backends.queue import QueueMonitor, QueueStats, Message
+from msgqueue.mirror import MonitorMirror
+
+from tests.test_client import Environment
+
+backends = known_backends()
+
+NAMESPACE = 'TESTNAME'
+QUEUE = 'TESTQUEUE'
+WORK_ITEM = 1
+
+
+class MemoryMonitor(QueueMonitor):
+    """Monitor over a list of messages recording how many messages it returns"""
+    def __init__(self):
+        super(MemoryMonitor, self).__init__(None, 'db')
+        self.store = dict()
+        self.returned = 0
+        self.start = datetime.datetime(2020, 1, 1)
+        self.now = self.start + datetime.timedelta(days=1)
+
+    def push(self, namespace='a'):
+        uid = len(self.store)
+        self.store[uid] = Message(
+            uid, self.start + datetime.timedelta(seconds=uid), WORK_ITEM, False, None, False, None,
+            None, {'i': uid}, 0, None, namespace)
+        return uid
+
+    def process(self, uid, actioned=True, error=None):
+        self.now += datetime.timedelta(seconds=1)
+        message = self.store[uid]
+        message.read, message.read_time, message.error = True, self.now, error
+
+        if actioned:
+            message.actioned, message.actioned_time = True, self.now
+
+    def _return(self, messages):
+        self.returned += len(messages)
+        return [dataclasses.replace(m) for m in messages]
+
+    def messages(self, name, namespace, limit=None, mtype=None, time=None):
+        return self._return([
+            m for m in self.store.values()
+            if (time is None or m.time > time) and (namespace is None or m.namespace == namespace)])
+
+    def unread_messages(self, name, namespace, mtype=None):
+        return self._return([m for m in self.store.values() if not m.read])
+
+    def unactioned_messages(self, name, namespace, mtype=None):
+        return self._return([m for m in self.store.values() if m.read and not m.actioned])
+
+    def messages_by_uid(self, name, uids):
+        return self._return([self.store[uid] for uid in uids if uid in self.store])
+
+    def changed_messages(self, name, since):
+        return self._return([
+            m for m in self.store.values()
+            if (m.read_time is not None and m.read_time > since) or
+               (m.actioned_time is not None and m.actioned_time > since)])
+
+    def stats(self, queues=None, namespaces=None):
+        stats = dict()
+        for m in self.store.values():
+            s = stats.setdefault(m.namespace, QueueStats(QUEUE, m.namespace))
+            s.read += m.read
+            s.unread += not m.read
+
+        return list(stats.values())
+
+    def queues(self):
+        return [QUEUE]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_incremental_sync():
+    monitor = MemoryMonitor()
+    for _ in range(0, 100):
+        monitor.push()
+
+    clock = Clock()
+    mirror = MonitorMirror(monitor, max_staleness=1, lag=0, clock=clock)
+    assert len(mirror.messages(QUEUE, None)) == 100
+
+    # the queue is processed, actioned messages are only downloaded once
+    for uid in range(0, 98):
+        monitor.process(uid)
+
+    clock.now = 2
+    assert mirror.actioned_count(QUEUE, None) == 98
+
+    monitor.returned = 0
+    monitor.push('b')
+    clock.now = 4
+
+    assert mirror.unread_count(QUEUE, None) == 3
+    assert mirror.unread_count(QUEUE, 'b') == 1
+    assert monitor.returned < 10, 'only the new and changed messages are downloaded'
+
+    # still fresh, answered from the table
+    mirror.messages(QUEUE, None)
+    assert monitor.returned < 10
+
+    # served from other monitor methods
+    assert mirror.queues() == [QUEUE]
+
+
+def test_removed_messages():
+    monitor = MemoryMonitor()
+    for _ in range(0, 5):
+        monitor.push()
+
+    clock = Clock()
+    mirror = MonitorMirror(monitor, lag=0, clock=clock)
+    assert mirror.unread_count(QUEUE, None) == 5
+
+    monitor.process(0, actioned=False)
+    monitor.process(1, actioned=False)
+    clock.now = 2
+    assert mirror.unactioned_count(QUEUE, None) == 2
+
+    # a message being processed is removed, another fails, neither changes a timestamp
+    del monitor.store[0]
+    monitor.store[1].error = 'error'
+
+    monitor.returned = 0
+    clock.now = 4
+    assert len(mirror.messages(QUEUE, None)) == 4
+    assert [m.uid for m in mirror.failed_messages(QUEUE, None)] == [1]
+    assert monitor.returned == 1, 'only the message being processed is fetched'
+
+    stats = mirror.stats()
+    assert len(stats) == 1 and (stats[0].unread, stats[0].unactioned, stats[0].failed) == (3, 1, 1)
+
+
+def test_removed_unread_messages():
+    monitor = MemoryMonitor()
+    for _ in range(0, 5):
+        monitor.push('a')
+        monitor.push('b')
+
+    clock = Clock()
+    mirror = MonitorMirror(monitor, lag=0, clock=clock)
+    assert mirror.unread_count(QUEUE, None) == 10
+
+    # unread messages are purged, nothing changes a timestamp
+    del monitor.store[0]
+    del monitor.store[2]
+
+    monitor.returned = 0
+    clock.now = 2
+    assert mirror.unread_count(QUEUE, 'a') == 3
+    assert mirror.unread_count(QUEUE, 'b') == 5
+    assert monitor.returned == 3, 'only the namespace that lost messages is downloaded again'
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_mirror(backend):
+    with Environment(backend) as env:
+        for i in range(0, 5):
+            env.client.push(QUEUE, NAMESPACE, {'i': i}, WORK_ITEM)
+
+        mirror = MonitorMirror(env.monitor, max_staleness=0)
+        assert mirror.unread_count(QUEUE, NAMESPACE) == 5
+
+        msg = env.client.pop(QUEUE, NAMESPACE)
+        env.client.mark_actioned(QUEUE, msg)
+        env.client.push(QUEUE, NAMESPACE, {'i': 5}, WORK_ITEM)
+
+        assert mirror.unread_count(QUEUE, NAMESPACE) == env.monitor.unread_count(QUEUE, NAMESPACE)
+        assert mirror.actioned_count(QUEUE, NAMESPACE) == env.monitor.actioned_count(QUEUE, NAMESPACE)
+        assert len(mirror.messages(QUEUE, NAMESPACE)) == 6
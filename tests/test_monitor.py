@@ -2,9 +2,72 @@ import pytest
 
 from msgqueue.logs import set_verbose_level
 from msgqueue.backends import known_backends, new_monitor
+from msgqueue.backends.queue import ApproximateCount, sampled_count
 
 from tests.test_client import Environment
 
 set_verbose_level(10)
 backends = known_backends()
 
+
+NAMESPACE = 'TESTNAME'
+QUEUE = 'TESTQUEUE'
+WORK_ITEM = 1
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_stats(backend):
+    with Environment(backend) as env:
+        client = env.client
+
+        for i in range(0, 5):
+            client.push(QUEUE, NAMESPACE, {'i': i}, WORK_ITEM)
+        client.push(QUEUE, 'other', {'i': 0}, WORK_ITEM)
+
+        done = client.pop(QUEUE, NAMESPACE)
+        client.mark_actioned(QUEUE, done)
+        failed = client.pop(QUEUE, NAMESPACE)
+        client.mark_error(QUEUE, failed, 'error')
+        client.pop(QUEUE, NAMESPACE)
+
+        stats = {s.namespace: s for s in env.monitor.stats([QUEUE])}
+        assert set(stats) == {NAMESPACE, 'other'}
+
+        s = stats[NAMESPACE]
+        assert (s.unread, s.read, s.unactioned, s.actioned, s.failed, s.lost) == (2, 3, 2, 1, 1, 0)
+        assert s.unread == env.monitor.unread_count(QUEUE, NAMESPACE)
+        assert s.unactioned == env.monitor.unactioned_count(QUEUE, NAMESPACE)
+        assert s.oldest_unread >= 0
+
+        assert [s.namespace for s in env.monitor.stats([QUEUE], ['other'])] == ['other']
+
+
+def test_sampled_count():
+    # the whole queue was sampled, the count is exact
+    assert sampled_count(100, 100, 42).exact
+
+    count = sampled_count(1000000, 10000, 2500)
+    assert isinstance(count, ApproximateCount) and count == 250000
+    # ~1% of the queue at 95% confidence
+    assert 8000 < count.error < 10000
+
+    # no matching message in the sample does not mean there is none in the queue
+    assert sampled_count(1000000, 10000, 0).error > 0
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_approximate_count(backend):
+    with Environment(backend) as env:
+        for i in range(0, 20):
+            env.client.push(QUEUE, NAMESPACE, {'i': i}, WORK_ITEM)
+        env.client.pop(QUEUE, NAMESPACE)
+
+        # small queues are counted
+        count = env.monitor.unread_count(QUEUE, NAMESPACE, approximate=True)
+        assert count == 19 and count.exact
+
+        # estimated from a sample, no message was actioned so none can be sampled
+        env.monitor.sample_size = 10
+        count = env.monitor.actioned_count(QUEUE, NAMESPACE, approximate=True)
+        assert isinstance(count, ApproximateCount) and count == 0
+        assert env.monitor.unread_count(QUEUE, NAMESPACE, approximate=True) <= 20
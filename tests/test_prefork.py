@@ -0,0 +1,42 @@
+import pytest
+
+from msgqueue.logs import set_verbose_level
+from msgqueue.backends import known_backends
+from msgqueue.prefork import PreforkSupervisor
+from msgqueue.worker import BaseWorker, WORK_ITEM
+
+from tests.test_client import Environment, DATABASE
+
+set_verbose_level(10)
+backends = known_backends()
+
+NAMESPACE = 'TESTNAME'
+QUEUE = 'TESTWORK'
+
+
+class CountingWorker(BaseWorker):
+    def __init__(self, uri, worker_id):
+        super(CountingWorker, self).__init__(uri, DATABASE, NAMESPACE, worker_id, QUEUE)
+        self.new_handler(WORK_ITEM, self.do_work)
+        self.timeout = 1
+
+    def do_work(self, message, context):
+        if message.message['i'] == 0 and message.retry == 0:
+            # the worker dies while processing this message
+            import os
+            os._exit(1)
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_prefork_supervisor(backend):
+    with Environment(backend) as env:
+        for i in range(0, 10):
+            env.client.push(QUEUE, NAMESPACE, {'i': i}, WORK_ITEM)
+
+        supervisor = PreforkSupervisor(
+            lambda index: CountingWorker(env.uri, index), workers=2, max_messages=3, restart_delay=0)
+        supervisor.run()
+
+        assert supervisor.restarts == 1
+        assert supervisor.recycles >= 2
+        assert env.monitor.actioned_count(QUEUE, NAMESPACE, WORK_ITEM) == 9
@@ -0,0 +1,66 @@
+import time
+
+import pytest
+
+from msgqueue.logs import set_verbose_level
+from msgqueue.backends import known_backends, new_client
+from msgqueue.reaper import Reaper
+from msgqueue.worker import BaseWorker
+
+from tests.test_client import Environment, DATABASE
+
+set_verbose_level(10)
+backends = known_backends()
+
+WORK_ITEM = 1
+
+NAMESPACE = 'TESTNAME'
+QUEUE = 'TESTQUEUE'
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_reaper(backend):
+    with Environment(backend) as env:
+        client = new_client(f'{env.uri}?lease=1', DATABASE, 'client-reaper')
+
+        client.push(QUEUE, NAMESPACE, {'json': 'lost'}, WORK_ITEM)
+        client.push(QUEUE, NAMESPACE, {'json': 'failed'}, WORK_ITEM)
+
+        client.pop(QUEUE, NAMESPACE)
+        failed = client.pop(QUEUE, NAMESPACE)
+        client.mark_error(QUEUE, failed, 'error')
+        time.sleep(1.5)
+
+        leader = Reaper(env.uri, DATABASE, interval=1)
+        follower = Reaper(env.uri, DATABASE, interval=1)
+
+        # only one reaper sweeps the queues
+        assert leader.step()
+        assert not follower.step()
+        assert env.monitor.unread_count(QUEUE, NAMESPACE) == 2
+
+        # the leader renews its lease
+        assert leader.step()
+
+        # once the leader is gone the follower takes over
+        leader.monitor.release_leader(leader.name, leader.holder)
+        assert follower.step()
+        assert not leader.step()
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_worker_skips_maintenance(backend):
+    with Environment(backend) as env:
+        worker = BaseWorker(
+            env.uri, DATABASE, NAMESPACE, worker_id='worker-test', work_queue=QUEUE, result_queue='TESTRESULT')
+        worker.timeout = 0
+
+        # without reaper the worker does the maintenance itself
+        assert not worker.reaper_running()
+
+        reaper = Reaper(env.uri, DATABASE, interval=1)
+        assert reaper.step()
+        assert worker.reaper_running()
+
+        worker.run()
+        assert worker.maintenance is False
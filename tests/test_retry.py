@@ -0,0 +1,106 @@
+import pytest
+
+from msgqueue.backends.cockroach.util import RetryCursor
+
+
+class SerializationFailure(Exception):
+    pgcode = '40001'
+    pgerror = 'restart transaction'
+
+
+class FakeCursor:
+    """Cursor raising a serialization failure the first `conflicts` times a statement is executed"""
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        self.statements = []
+        self.description = None
+        self.rowcount = -1
+        self.rows = []
+
+    def execute(self, statement, args=None):
+        self.statements.append(statement)
+        self.description = None
+
+        if statement.startswith('UPDATE'):
+            if self.conflicts > 0:
+                self.conflicts -= 1
+                raise SerializationFailure()
+
+            self.description = [('uid',)]
+            self.rows = [(1,)]
+            self.rowcount = 1
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_retry_on_serialization_failure():
+    fake = FakeCursor(conflicts=2)
+    cursor = RetryCursor(fake, base_delay=0.001)
+
+    cursor.execute('UPDATE queue SET read = true RETURNING uid')
+    assert cursor.fetchone() == (1,)
+
+    # a single statement is not wrapped inside an explicit transaction
+    assert fake.statements == ['UPDATE queue SET read = true RETURNING uid'] * 3
+
+    stats = cursor.stats
+    assert stats.transactions == 1
+    assert stats.conflicts == 1
+    assert stats.retries == 2
+    assert stats.failures == 0
+    assert stats.time_lost > 0
+
+
+def test_transaction_retry_on_serialization_failure():
+    fake = FakeCursor(conflicts=2)
+    cursor = RetryCursor(fake, base_delay=0.001)
+
+    def claim(cursor):
+        cursor.execute('SELECT uid FROM queue')
+        cursor.execute('UPDATE queue SET read = true RETURNING uid')
+
+    cursor.transaction(claim)
+    assert cursor.fetchone() == (1,)
+
+    assert fake.statements == [
+        'BEGIN',
+        'SAVEPOINT cockroach_restart',
+        'SELECT uid FROM queue',
+        'UPDATE queue SET read = true RETURNING uid',
+        'ROLLBACK TO SAVEPOINT cockroach_restart',
+        'SELECT uid FROM queue',
+        'UPDATE queue SET read = true RETURNING uid',
+        'ROLLBACK TO SAVEPOINT cockroach_restart',
+        'SELECT uid FROM queue',
+        'UPDATE queue SET read = true RETURNING uid',
+        'RELEASE SAVEPOINT cockroach_restart',
+        'COMMIT',
+    ]
+    assert cursor.stats.retries == 2
+
+
+def test_retry_gives_up():
+    fake = FakeCursor(conflicts=10)
+    cursor = RetryCursor(fake, max_retries=3, base_delay=0.001)
+
+    with pytest.raises(SerializationFailure):
+        cursor.execute('UPDATE queue SET read = true RETURNING uid')
+
+    assert len(fake.statements) == 4
+    assert cursor.stats.retries == 3
+    assert cursor.stats.failures == 1
+
+    with pytest.raises(SerializationFailure):
+        cursor.transaction(lambda c: c.execute('UPDATE queue SET read = true RETURNING uid'))
+
+    assert fake.statements[-1] == 'ROLLBACK'
+    assert not cursor.in_transaction
+
+
+def test_schema_statements_are_not_wrapped():
+    fake = FakeCursor(conflicts=0)
+    cursor = RetryCursor(fake)
+
+    cursor.execute('\n    CREATE TABLE IF NOT EXISTS queue (uid SERIAL)')
+    assert fake.statements == ['\n    CREATE TABLE IF NOT EXISTS queue (uid SERIAL)']
@@ -0,0 +1,45 @@
+from msgqueue.scheduler import DeficitRoundRobin
+
+
+def serve(scheduler, backlog, steps):
+    for _ in range(steps):
+        order = scheduler.order()
+        queue = next((q for q in order if backlog[q] > 0), None)
+        scheduler.update(order, queue)
+
+        if queue is not None:
+            backlog[queue] -= 1
+
+
+def test_weighted_share():
+    scheduler = DeficitRoundRobin({'a': 3, 'b': 1})
+    serve(scheduler, {'a': 1000, 'b': 1000}, 400)
+
+    assert scheduler.served == {'a': 300, 'b': 100}
+
+
+def test_empty_queue_does_not_block():
+    scheduler = DeficitRoundRobin({'a': 3, 'b': 1})
+    serve(scheduler, {'a': 0, 'b': 1000}, 100)
+
+    assert scheduler.served == {'a': 0, 'b': 100}
+
+
+def test_idle_queue_does_not_hoard_credit():
+    scheduler = DeficitRoundRobin({'a': 1, 'b': 1})
+    backlog = {'a': 0, 'b': 1000}
+    serve(scheduler, backlog, 100)
+
+    # a gets work again, it is served at its fair share instead of catching up
+    backlog['a'] = 1000
+    serve(scheduler, backlog, 100)
+    assert scheduler.served == {'a': 50, 'b': 150}
+
+
+def test_set_weights_keeps_credit():
+    scheduler = DeficitRoundRobin({'a': 1, 'b': 1})
+    scheduler.update(scheduler.order(), 'a')
+    scheduler.set_weights({'a': 1, 'c': 1})
+
+    assert scheduler.deficits == {'a': 0, 'c': 0}
+    assert scheduler.order() == ['a', 'c']
@@ -2,7 +2,8 @@ import pytest
 
 from msgqueue.logs import set_verbose_level
 from msgqueue.backends import known_backends
-from msgqueue.worker import BaseWorker, WORK_ITEM, SHUTDOWN, WORKER_JOIN, WORKER_LEFT
+from msgqueue.backends.queue import RPCError, ActionRecord
+from msgqueue.worker import BaseWorker, MultiQueueWorker, WORK_ITEM, RESULT_ITEM, SHUTDOWN, WORKER_JOIN, WORKER_LEFT
 
 from tests.test_client import Environment
 
@@ -89,6 +90,181 @@ def test_base_worker_requeue(backend):
             assert failed_messages[0].retry == 3  # worker left
 
 
+class StealingWorker(BaseWorker):
+    def __init__(self, uri):
+        super(StealingWorker, self).__init__(
+            uri, DATABASE, NAMESPACE, worker_id='worker-test',
+            work_queue=WORK_QUEUE, result_queue=RESULT_QUEUE)
+
+        self.new_handler(WORK_ITEM, self.do_work)
+        self.seen = []
+
+    def do_work(self, message, context):
+        self.seen.append(context['namespace'])
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_work_stealing_worker(backend):
+    with Environment(backend) as env:
+        client = env.client
+
+        for i in range(0, 4):
+            client.push(WORK_QUEUE, 'busy', message={'i': i}, mtype=WORK_ITEM)
+        client.push(WORK_QUEUE, 'other', message={'i': 0}, mtype=WORK_ITEM)
+        client.push(WORK_QUEUE, NAMESPACE, message={'i': 0}, mtype=WORK_ITEM)
+
+        worker = StealingWorker(env.uri)
+        worker.timeout = 1
+        worker.work_stealing = True
+        worker.steal_from = {'busy'}
+        worker.run()
+
+        # the home namespace is served first, then the work is stolen from the compatible namespace only
+        assert worker.seen == [NAMESPACE, 'busy', 'busy', 'busy', 'busy']
+        assert env.monitor.unread_count(WORK_QUEUE, 'other') == 1
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_work_stealing_most_backlogged(backend):
+    with Environment(backend) as env:
+        client = env.client
+
+        client.push(WORK_QUEUE, 'small', message={'i': 0}, mtype=WORK_ITEM)
+        for i in range(0, 4):
+            client.push(WORK_QUEUE, 'busy', message={'i': i}, mtype=WORK_ITEM)
+        client.push(WORK_QUEUE, 'small', message={'i': 1}, mtype=WORK_ITEM)
+
+        worker = StealingWorker(env.uri)
+        worker.timeout = 1
+        worker.work_stealing = True
+        worker.run()
+
+        # the oldest message is in `small` but `busy` has the largest backlog,
+        # it is drained until both namespaces have the same backlog
+        assert worker.seen[:2] == ['busy', 'busy']
+        assert sorted(worker.seen[2:]) == ['busy', 'busy', 'small', 'small']
+
+
+class BatchWorker(BaseWorker):
+    def __init__(self, uri):
+        super(BatchWorker, self).__init__(
+            uri, DATABASE, NAMESPACE, worker_id='worker-test',
+            work_queue=WORK_QUEUE, result_queue=RESULT_QUEUE)
+
+        self.new_handler(WORK_ITEM, self.do_work, batch_size=4, max_wait=0.1)
+        self.batches = []
+
+    def do_work(self, messages, context):
+        self.batches.append(len(messages))
+        return [ValueError('odd') if m.message['v'] % 2 else m.message['v'] + 1 for m in messages]
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_batch_worker(backend):
+    with Environment(backend) as env:
+        client = env.client
+
+        for v in range(0, 6):
+            client.push(WORK_QUEUE, NAMESPACE, message={'v': v}, mtype=WORK_ITEM)
+
+        worker = BatchWorker(env.uri)
+        worker.timeout = 1
+        worker.max_retry = 0
+        worker.run()
+
+        assert worker.batches == [4, 2]
+
+        results = []
+        m = client.pop(RESULT_QUEUE, NAMESPACE, mtype=RESULT_ITEM)
+        while m is not None:
+            results.append(m.message)
+            m = client.pop(RESULT_QUEUE, NAMESPACE, mtype=RESULT_ITEM)
+
+        # each message is acked or failed on its own
+        assert sorted(results) == [1, 3, 5]
+        assert len(client.monitor().failed_messages(WORK_QUEUE, NAMESPACE)) == 3
+        assert env.monitor.unactioned_count(WORK_QUEUE, NAMESPACE) == 3
+
+
+class RPCWorker(BaseWorker):
+    def __init__(self, uri):
+        super(RPCWorker, self).__init__(
+            uri, DATABASE, NAMESPACE, worker_id='worker-test', work_queue=WORK_QUEUE)
+
+        self.new_handler(WORK_ITEM, self.do_work)
+        self.max_retry = 0
+
+    def do_work(self, message, context):
+        if message.message['v'] < 0:
+            raise ValueError('negative')
+
+        if message.message['v'] == 0:
+            return ActionRecord([])
+
+        return message.message['v'] * 2
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_rpc_worker(backend):
+    import threading
+
+    with Environment(backend) as env:
+        worker = RPCWorker(env.uri)
+        worker.timeout = 2
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+
+        # the value returned by the handler is delivered to the caller
+        assert env.client.call(WORK_QUEUE, NAMESPACE, {'v': 21}, mtype=WORK_ITEM, timeout=10) == 42
+
+        with pytest.raises(RPCError):
+            env.client.call(WORK_QUEUE, NAMESPACE, {'v': -1}, mtype=WORK_ITEM, timeout=10)
+
+        # handlers returning operations reply without a value
+        assert env.client.call(WORK_QUEUE, NAMESPACE, {'v': 0}, mtype=WORK_ITEM, timeout=10) is None
+
+        thread.join()
+
+        # replies are durable messages of the reply queue of the caller's host
+        assert len(env.monitor.messages(env.client.rpc_queue, NAMESPACE)) == 3
+
+
+class TestMultiQueueWorker(MultiQueueWorker):
+    def __init__(self, uri, queues):
+        super(TestMultiQueueWorker, self).__init__(
+            uri, DATABASE, NAMESPACE, worker_id='worker-test',
+            work_queues=queues, result_queue=RESULT_QUEUE)
+
+        self.new_handler(WORK_ITEM, self.do_work)
+        self.seen = []
+
+    def do_work(self, message, context):
+        self.seen.append(self.work_queue)
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_multi_queue_worker(backend):
+    with Environment(backend) as env:
+        client = env.client
+
+        for i in range(0, 8):
+            client.push('FAST', NAMESPACE, message={'i': i}, mtype=WORK_ITEM)
+            client.push('SLOW', NAMESPACE, message={'i': i}, mtype=WORK_ITEM)
+
+        queue, msg = client.dequeue_any(['EMPTY', 'SLOW', 'FAST'], NAMESPACE)
+        assert queue == 'SLOW' and msg.message == {'i': 0}
+        client.mark_actioned(queue, msg)
+
+        worker = TestMultiQueueWorker(env.uri, {'FAST': 3, 'SLOW': 1})
+        worker.timeout = 1
+        worker.run()
+
+        # FAST gets 3 times more service while both queues have work
+        assert worker.seen[:8].count('FAST') == 6
+        assert len(worker.seen) == 15
+        assert set(worker.service_rates()) == {'FAST', 'SLOW'}
+
+
 if __name__ == '__main__':
     import traceback
     for b in ['cockroach']: